@@ -0,0 +1,128 @@
+"""
+Compares ways of finding the card image in a card page: the scraper's old path (a full
+BeautifulSoup html.parser tree), BeautifulSoup with a SoupStrainer that only keeps <img>s,
+and the streaming extractors in cardimg_common.cardimg_extraction. Reports pages/sec and
+how much each mode grows the process's peak RSS. Each mode runs in its own process, so
+that one mode's peak doesn't hide another's.
+
+By default the pages are generated stand-ins for scryfall.com and pkmncards.com card pages
+(similar size and layout, card image part way down). Saved real pages can be used instead
+with --pages-dir; each file's name must start with its domain, e.g. scryfall.com-embargo.html.
+
+Usage (from the workspace folder):
+    python localdev/benchmarks/bench_html_extraction.py [--pages-dir DIR] [--iterations N]
+"""
+import argparse, json, resource, subprocess, sys, time
+from pathlib import Path
+
+WORKSPACE_FOLDER = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(WORKSPACE_FOLDER / "src"))
+
+MODES = ["soup", "strainer", "streaming"]
+CHUNK_CHARS = 16 * 1024
+DOMAIN_CONFIGS = {
+    "scryfall.com": "card",
+    "pkmncards.com": {"selector": "card-image", "extractor": "srcset"},
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages-dir", type=Path, help="saved card pages, named <domain>-*.html")
+    parser.add_argument("--iterations", type=int, default=20, help="passes over the pages per mode")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS) # set for child processes
+    args = parser.parse_args()
+    if args.mode:
+        return print(json.dumps(run_mode(args.mode, load_pages(args.pages_dir), args.iterations)))
+
+    pages = load_pages(args.pages_dir)
+    print(f"{len(pages)} pages, {sum(len(html) for (_, html) in pages) // len(pages) // 1024}KB on average, "
+          f"{args.iterations} passes per mode")
+    print(f"{'mode':>10} {'pages/sec':>12} {'peak rss growth':>16}")
+    for mode in MODES:
+        child_args = [sys.executable, __file__, "--mode", mode, "--iterations", str(args.iterations)]
+        if args.pages_dir:
+            child_args += ["--pages-dir", str(args.pages_dir)]
+        result = json.loads(subprocess.run(child_args, capture_output=True, check=True, text=True).stdout)
+        print(f"{mode:>10} {result['pagesPerSecond']:>12.1f} {result['peakRssGrowthKb']:>14}KB")
+
+
+def run_mode(mode:str, pages:list[tuple[str, str]], iterations:int) -> dict:
+    extract = make_extract(mode)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for _ in range(iterations):
+        found = [extract(domain, html) for (domain, html) in pages]
+    elapsed = time.perf_counter() - start
+    if not all(found):
+        raise RuntimeError(f"{mode} didn't find the card image on every page")
+    return {
+        "pagesPerSecond": len(pages) * iterations / elapsed,
+        "peakRssGrowthKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+    }
+
+
+def make_extract(mode:str):
+    if mode == "streaming":
+        from cardimg_common.cardimg_extraction import get_extractor_factory
+        extractor_factories = {domain: get_extractor_factory(config) for (domain, config) in DOMAIN_CONFIGS.items()}
+        def extract(domain, html):
+            chunks = (html[i:i + CHUNK_CHARS] for i in range(0, len(html), CHUNK_CHARS))
+            return extractor_factories[domain]().extract(chunks)
+        return extract
+
+    from bs4 import BeautifulSoup, SoupStrainer
+    parse_only = SoupStrainer("img") if mode == "strainer" else None
+    def extract(domain, html):
+        domain_config = DOMAIN_CONFIGS[domain]
+        css_class = domain_config if isinstance(domain_config, str) else domain_config["selector"]
+        soup = BeautifulSoup(html, "html.parser", parse_only=parse_only)
+        return str(soup.find_all("img", class_=css_class)[0]["src"])
+    return extract
+
+
+def load_pages(pages_dir:Path|None) -> list[tuple[str, str]]:
+    if pages_dir is None:
+        return [("scryfall.com", make_scryfall_like_page(i)) for i in range(10)] \
+            + [("pkmncards.com", make_pkmncards_like_page(i)) for i in range(10)]
+    return [
+        (next(domain for domain in DOMAIN_CONFIGS if page_path.name.startswith(domain)),
+         page_path.read_text(encoding="utf-8", errors="replace"))
+        for page_path in sorted(pages_dir.glob("*.html"))
+    ]
+
+
+def make_scryfall_like_page(i:int) -> str:
+    head = "".join(f'<link rel="preload" href="/assets/chunk-{j}.js" as="script">' for j in range(40))
+    nav = "".join(f'<li class="nav-item"><a href="/sets/{j}">Set {j}</a></li>' for j in range(300))
+    prints = "".join(
+        f'<tr><td><a href="/card/set{j}/{i}/embargo">Set {j} #{i}</a></td><td>$0.{j:02}</td></tr>'
+        for j in range(400)
+    )
+    return (
+        f'<!DOCTYPE html><html><head><title>Embargo {i}</title>{head}'
+        f'<script type="application/ld+json">{json.dumps({"prints": list(range(2000))})}</script></head>'
+        f'<body><ul class="nav">{nav}</ul><div class="card-profile">'
+        f'<img class="card mmq border-black" src="https://cards.scryfall.io/large/front/{i}/embargo.jpg?1562" alt="Embargo">'
+        f'<div class="card-text"><p>Embargo {i}</p></div></div><table class="prints">{prints}</table></body></html>'
+    )
+
+
+def make_pkmncards_like_page(i:int) -> str:
+    sidebar = "".join(
+        f'<li><a href="/set/{j}/"><img class="set-symbol" src="/wp-content/uploads/set-{j}.png"></a></li>'
+        for j in range(250)
+    )
+    comments = "".join(f'<div class="comment"><p>Comment {j} on Machoke {i}</p></div>' for j in range(500))
+    upload = f"https://pkmncards.com/wp-content/uploads/machoke-{i}"
+    return (
+        f'<!DOCTYPE html><html><head><title>Machoke {i}</title>'
+        f'<meta property="og:image" content="{upload}.jpg"></head>'
+        f'<body><ul class="sidebar">{sidebar}</ul><article>'
+        f'<img class="card-image wp-post-image" src="{upload}-300x420.jpg" '
+        f'srcset="{upload}-300x420.jpg 300w, {upload}.jpg 734w">'
+        f'</article>{comments}</body></html>'
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Measures cards scraped per second by one cardimg_single_scrape invocation as the number
+of worker threads grows. Card pages and images come from two local fake card sites
+(standing in for two approved domains), and S3/DynamoDB are moto's in-memory fakes.
+
+Usage (from the workspace folder):
+    python localdev/benchmarks/bench_scraper_concurrency.py [--records N] [--latency-ms N]
+        [--requests-per-second N] [worker_count ...]
+"""
+import argparse, io, json, os, sys, time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+WORKSPACE_FOLDER = Path(__file__).parent.parent.parent
+DEFAULT_WORKER_COUNTS = [1, 2, 4, 8]
+BENCH_BUCKET = "bench-card-img-bucket"
+
+os.environ.pop("AWS_ENDPOINT_URL", None)
+os.environ.pop("AWS_PROFILE", None)
+os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["CARDIMG_BUCKET"] = BENCH_BUCKET
+os.environ["SCRAPER_APP_VERSION"] = "bench0"
+sys.path.insert(0, str(WORKSPACE_FOLDER / "src"))
+sys.path.insert(0, str(WORKSPACE_FOLDER / "localdev"))
+
+import boto3
+from moto import mock_aws
+from fake_card_site import FakeCardSite
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("worker_counts", nargs="*", type=int, default=DEFAULT_WORKER_COUNTS)
+    parser.add_argument("--records", type=int, default=20, help="sqs records per invocation")
+    parser.add_argument("--latency-ms", type=float, default=50, help="fake site latency per request")
+    parser.add_argument("--requests-per-second", type=float, default=50, help="rate limit per fake site")
+    args = parser.parse_args()
+
+    with FakeCardSite("card", args.latency_ms / 1000, host="127.0.0.1") as site_a, \
+            FakeCardSite("card-image", args.latency_ms / 1000, host="localhost") as site_b, \
+            mock_aws():
+        os.environ["APPROVED_DOMAINS_TO_CARDIMG_SELECTORS"] = json.dumps({
+            site.netloc: {
+                "selector": site.cardimg_selector,
+                "requestsPerSecond": args.requests_per_second,
+                "burst": 1,
+            }
+            for site in (site_a, site_b)
+        })
+        create_aws_resources()
+        from cardimg_single_scrape import app as cardimg_single_scrape_app
+
+        print(f"{args.records} records per invocation, {args.latency_ms}ms site latency, "
+              f"{args.requests_per_second} requests/sec allowed per site")
+        print(f"{'workers':>8} {'seconds':>10} {'cards/sec':>12}")
+        for worker_count in args.worker_counts:
+            cardimg_single_scrape_app.SCRAPE_MAX_WORKERS = worker_count
+            cardpage_uris = [
+                (site_a if i % 2 else site_b).cardpage_uri(f"w{worker_count}-card-{i}")
+                for i in range(args.records)
+            ]
+            event = make_sqs_event(cardpage_uris, f"bench-batch-{worker_count}")
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                response = cardimg_single_scrape_app.lambda_handler(event, None)
+            elapsed = time.perf_counter() - start
+            if response["batchItemFailures"]:
+                print(f"  warning: {len(response['batchItemFailures'])} records failed")
+            print(f"{worker_count:>8} {elapsed:>10.3f} {args.records / elapsed:>12.2f}")
+
+
+def make_sqs_event(cardpage_uris:list[str], batch_id:str) -> dict:
+    put_pending_batch(batch_id, cardpage_uris)
+    return {
+        "Records": [
+            {
+                "messageId": f"{batch_id}-{i}",
+                "body": json.dumps({"batchId": batch_id, "itemFromBatch": {"Card Page URI": uri}}),
+                "attributes": {"ApproximateReceiveCount": "1"},
+            }
+            for (i, uri) in enumerate(cardpage_uris)
+        ]
+    }
+
+
+def put_pending_batch(batch_id:str, cardpage_uris:list[str]):
+    from cardimg_common.batch_status import (
+        PENDING_STATUS, SUMMARY_ITEM_KEY, status_count_attribute, uri_item_key
+    )
+    with boto3.resource("dynamodb").Table("CardImgBatchStatus").batch_writer() as batch:
+        batch.put_item(Item={
+            "batchId": batch_id,
+            "itemKey": SUMMARY_ITEM_KEY,
+            "totalCount": len(cardpage_uris),
+            status_count_attribute(PENDING_STATUS): len(cardpage_uris),
+        })
+        for uri in cardpage_uris:
+            batch.put_item(Item={
+                "batchId": batch_id,
+                "itemKey": uri_item_key(uri),
+                "cardpageUri": uri,
+                "status": PENDING_STATUS,
+            })
+
+
+def create_aws_resources():
+    boto3.client("s3").create_bucket(Bucket=BENCH_BUCKET)
+    boto3.resource("dynamodb").create_table(
+        TableName="CardImgBatchStatus",
+        KeySchema=[
+            {"AttributeName": "batchId", "KeyType": "HASH"},
+            {"AttributeName": "itemKey", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "batchId", "AttributeType": "S"},
+            {"AttributeName": "itemKey", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    ).wait_until_exists()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures how many csv rows per second cardimg_add_batch (via cardimg_common's
+send_csvrows_to_sqs) can push onto SQS.
+
+By default the queue is an in-process stand-in that sleeps for a fixed latency per
+API call, which approximates the round-trip cost that dominates against real SQS.
+Pass --moto to use moto's in-memory SQS instead (note that moto scans the whole
+queue on every send, so its large runs are slow for reasons unrelated to our code).
+
+Usage (from the workspace folder):
+    python localdev/benchmarks/bench_sqs_fanout.py [--moto] [--latency-ms N] [row_count ...]
+"""
+import argparse, os, sys, threading, time
+from pathlib import Path
+
+WORKSPACE_FOLDER = Path(__file__).parent.parent.parent
+DEFAULT_ROW_COUNTS = [100, 1_000, 10_000]
+
+os.environ.pop("AWS_ENDPOINT_URL", None)
+os.environ.pop("AWS_PROFILE", None)
+os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+sys.path.insert(0, str(WORKSPACE_FOLDER / "src"))
+
+
+class LatencySqsStandIn:
+    """Accepts every message after sleeping for latency_seconds per API call."""
+
+    def __init__(self, latency_seconds:float):
+        self.latency_seconds = latency_seconds
+        self.call_count = 0
+        self.message_count = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody):
+        time.sleep(self.latency_seconds)
+        with self._lock:
+            self.call_count += 1
+            self.message_count += 1
+        return {"MessageId": str(self.message_count)}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency_seconds)
+        with self._lock:
+            self.call_count += 1
+            self.message_count += len(Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def create_queue(self, QueueName):
+        return {"QueueUrl": f"https://sqs.local/{QueueName}"}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("row_counts", nargs="*", type=int, default=DEFAULT_ROW_COUNTS)
+    parser.add_argument("--moto", action="store_true", help="use moto's in-memory SQS")
+    parser.add_argument("--latency-ms", type=float, default=15, help="stand-in latency per call")
+    args = parser.parse_args()
+
+    if args.moto:
+        import boto3
+        from moto import mock_aws
+        with mock_aws():
+            run(boto3.client("sqs"), args.row_counts)
+    else:
+        run(LatencySqsStandIn(args.latency_ms / 1000), args.row_counts)
+
+
+def run(sqs, row_counts:list[int]):
+    from cardimg_common.batch_enqueue import send_csvrows_to_sqs
+
+    print(f"{'rows':>8} {'seconds':>10} {'rows/sec':>12}")
+    for row_count in row_counts:
+        csv_rows = [
+            {"Card Page URI": f"https://scryfall.com/card/bench/{i}/card-{i}"}
+            for i in range(row_count)
+        ]
+        # A fresh queue per run, so one run's backlog doesn't slow down the next
+        queue_url = sqs.create_queue(QueueName=f"benchq-{row_count}")["QueueUrl"]
+        start = time.perf_counter()
+        unqueued_rows = send_csvrows_to_sqs(sqs, csv_rows, "bench-batch", queue_url)
+        elapsed = time.perf_counter() - start
+        if unqueued_rows:
+            print(f"  warning: {len(unqueued_rows)} rows were not queued")
+        print(f"{row_count:>8} {elapsed:>10.3f} {row_count / elapsed:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Counts the DynamoDB write (and read) calls cardimg_single_scrape makes to record the
+statuses of one SQS batch, compared with writing each card's status on its own (as the
+scraper used to).
+Scraping itself is stubbed out; S3/DynamoDB are moto's in-memory fakes.
+
+Usage (from the workspace folder):
+    python localdev/benchmarks/bench_status_writes.py [records_per_sqs_batch] [failing_record_count]
+"""
+import io, json, os, sys
+from collections import Counter
+from contextlib import redirect_stdout
+from pathlib import Path
+
+WORKSPACE_FOLDER = Path(__file__).parent.parent.parent
+BENCH_BUCKET = "bench-card-img-bucket"
+WRITE_OPERATIONS = ("UpdateItem", "PutItem", "BatchWriteItem", "TransactWriteItems")
+READ_OPERATIONS = ("GetItem", "BatchGetItem", "Query")
+
+os.environ.pop("AWS_ENDPOINT_URL", None)
+os.environ.pop("AWS_PROFILE", None)
+os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["CARDIMG_BUCKET"] = BENCH_BUCKET
+os.environ["SCRAPER_APP_VERSION"] = "bench0"
+os.environ["APPROVED_DOMAINS_TO_CARDIMG_SELECTORS"] = '{"scryfall.com": "card", "pkmncards.com": "card-image"}'
+sys.path.insert(0, str(WORKSPACE_FOLDER / "src"))
+
+import boto3
+from moto import mock_aws
+
+def main():
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    failing_record_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BENCH_BUCKET)
+        boto3.resource("dynamodb").create_table(
+            TableName="CardImgBatchStatus",
+            KeySchema=[
+                {"AttributeName": "batchId", "KeyType": "HASH"},
+                {"AttributeName": "itemKey", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "batchId", "AttributeType": "S"},
+                {"AttributeName": "itemKey", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        ).wait_until_exists()
+        from cardimg_common.batch_status import record_status_changes
+        from cardimg_single_scrape import app as cardimg_single_scrape_app
+
+        write_calls = Counter()
+        read_calls = Counter()
+        def count_write_call(model, **kwargs):
+            if model.name in WRITE_OPERATIONS:
+                write_calls[model.name] += 1
+            elif model.name in READ_OPERATIONS:
+                read_calls[model.name] += 1
+        cardimg_single_scrape_app.dynamodb.meta.events.register("before-call.dynamodb", count_write_call)
+
+        failing_paths = {f"/card/bench/{i}/card" for i in range(failing_record_count)}
+        def fake_locate_and_upload_img(parsed_cardpage_uri, make_extractor, rate_limiter, http_session):
+            if parsed_cardpage_uri.path in failing_paths:
+                raise RuntimeError("status code was 500")
+        cardimg_single_scrape_app.locate_and_upload_img = fake_locate_and_upload_img
+
+        cardpage_uris = [f"https://scryfall.com/card/bench/{i}/card" for i in range(record_count)]
+        put_pending_batch("bench-batch", cardpage_uris)
+        event = {
+            "Records": [
+                {
+                    "messageId": f"message-{i}",
+                    "body": json.dumps({"batchId": "bench-batch", "itemFromBatch": {"Card Page URI": uri}}),
+                    "attributes": {"ApproximateReceiveCount": "1"},
+                }
+                for (i, uri) in enumerate(cardpage_uris)
+            ]
+        }
+
+        # Before: one status write per card, as save_job_status_to_dynamo used to do
+        write_calls.clear()
+        read_calls.clear()
+        for uri in cardpage_uris:
+            record_status_changes(cardimg_single_scrape_app.dynamodb, "bench-batch", {uri: "SUCCESS"})
+        per_card_writes = sum(write_calls.values())
+        per_card_reads = sum(read_calls.values())
+        put_pending_batch("bench-batch", cardpage_uris)
+
+        # After: the handler's buffered, coalesced writes
+        write_calls.clear()
+        read_calls.clear()
+        with redirect_stdout(io.StringIO()):
+            cardimg_single_scrape_app.lambda_handler(event, None)
+        coalesced_writes = sum(write_calls.values())
+        coalesced_reads = sum(read_calls.values())
+
+        print(f"{record_count} records in one sqs batch, {failing_record_count} of them failing")
+        print(f"{'mode':>12} {'write calls':>12} {'read calls':>12}")
+        print(f"{'per card':>12} {per_card_writes:>12} {per_card_reads:>12}")
+        print(f"{'coalesced':>12} {coalesced_writes:>12} {coalesced_reads:>12}")
+
+
+def put_pending_batch(batch_id:str, cardpage_uris:list[str]):
+    from cardimg_common.batch_status import (
+        PENDING_STATUS, SUMMARY_ITEM_KEY, status_count_attribute, uri_item_key
+    )
+    with boto3.resource("dynamodb").Table("CardImgBatchStatus").batch_writer() as batch:
+        batch.put_item(Item={
+            "batchId": batch_id,
+            "itemKey": SUMMARY_ITEM_KEY,
+            "totalCount": len(cardpage_uris),
+            status_count_attribute(PENDING_STATUS): len(cardpage_uris),
+        })
+        for uri in cardpage_uris:
+            batch.put_item(Item={
+                "batchId": batch_id,
+                "itemKey": uri_item_key(uri),
+                "cardpageUri": uri,
+                "status": PENDING_STATUS,
+            })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Measures how many csv rows per second cardimg_add_batch can validate, on a synthetic
+csv whose rows repeat a limited set of card page uris (as real batches do). Runs
+once with the validation cache disabled and once with it enabled.
+
+Usage (from the workspace folder):
+    python localdev/benchmarks/bench_uri_validation.py [row_count] [distinct_uri_count]
+"""
+import os, random, sys, time
+from pathlib import Path
+
+WORKSPACE_FOLDER = Path(__file__).parent.parent.parent
+DEFAULT_ROW_COUNT = 100_000
+DEFAULT_DISTINCT_URI_COUNT = 2_000
+
+os.environ.setdefault(
+    "APPROVED_DOMAINS_TO_CARDIMG_SELECTORS",
+    '{"scryfall.com": "card", "pkmncards.com": "card-image"}'
+)
+os.environ.setdefault("PRIORITY_FETCH_QUEUE", "unused")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, str(WORKSPACE_FOLDER / "src"))
+
+def make_synthetic_csv(row_count:int, distinct_uri_count:int) -> str:
+    distinct_uris = [
+        random.choice([
+            f"https://scryfall.com/card/bench/{i}/card-{i}",
+            f"https://www.pkmncards.com/card/card-{i}/",
+            f"https://example.com/card/{i}",
+        ])
+        for i in range(distinct_uri_count)
+    ]
+    rows = (random.choice(distinct_uris) for _ in range(row_count))
+    return "Card Name,Card Page URI\n" + "\n".join(f"Some Card,{uri}" for uri in rows)
+
+
+def main():
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROW_COUNT
+    distinct_uri_count = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DISTINCT_URI_COUNT
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    from cardimg_common import batch_validation
+
+    random.seed(0)
+    event = {"body": make_synthetic_csv(row_count, distinct_uri_count)}
+    cached_validate = batch_validation._validate_cardpage_uri_text
+
+    print(f"{row_count} rows, {distinct_uri_count} distinct uris")
+    print(f"{'mode':>10} {'seconds':>10} {'rows/sec':>12}")
+    for mode in ["uncached", "cached"]:
+        cached_validate.cache_clear()
+        if mode == "uncached":
+            batch_validation._validate_cardpage_uri_text = cached_validate.__wrapped__
+        else:
+            batch_validation._validate_cardpage_uri_text = cached_validate
+        start = time.perf_counter()
+        cardimg_add_batch_app.validate_event(event)
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>10} {elapsed:>10.3f} {row_count / elapsed:>12.1f}")
+    batch_validation._validate_cardpage_uri_text = cached_validate
+
+
+if __name__ == "__main__":
+    main()
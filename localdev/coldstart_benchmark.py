@@ -0,0 +1,180 @@
+"""
+Measures each lambda's cold start, in fresh python processes:
+  init         importing the lambda's app module, as Lambda's init phase does
+  firstInvoke  the first invocation after init, which creates the clients it uses
+  warmInvoke   the next invocation in the same process
+and lists the imports that take longest during init (from python -X importtime).
+
+init is measured without anything else imported first. The invocations run against
+moto, which imports boto3 itself, so they're measured in separate processes. Each
+lambda's event is one that needs only some of its clients: add_batch queues a two row
+csv, single_scrape gets two cards that already have images (so it never touches s3 or a
+card site), view_batch_status reads a batch's summary, and progress_events reads the sample
+stream records that finish that batch.
+
+Run it with `python local_runner.py coldstart [--runs N] [--output results.json]`.
+"""
+import argparse, importlib, json, os, statistics, subprocess, sys, time, types
+from pathlib import Path
+
+import pipeline_benchmark
+
+FUNCTIONS = ["cardimg_add_batch", "cardimg_single_scrape", "cardimg_view_batch_status", "cardimg_progress_events"]
+BENCH_BATCH_ID = "7bbf9329-bad0-4be6-89e1-0490b99330d6"
+STREAM_RECORDS_EVENT = Path(__file__).parent.parent / "events" / "progressevents" / "stream-records.json"
+KNOWN_CARDPAGE_URIS = ["https://scryfall.com/card/mmq/1/embargo", "https://pkmncards.com/card/machoke-1/"]
+
+
+def main(argv:list[str]):
+    parser = argparse.ArgumentParser(prog="local_runner.py coldstart")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per function and measurement")
+    parser.add_argument("--slowest-imports", type=int, default=10, help="imports to list per function")
+    parser.add_argument("--output", type=Path, help="also write the results to this json file")
+    parser.add_argument("--child", nargs=2, metavar=("MEASUREMENT", "FUNCTION"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        (measurement, function) = args.child
+        return print(json.dumps(measure_init(function) if measurement == "init" else measure_invokes(function)))
+
+    results = {}
+    for function in FUNCTIONS:
+        init_runs = [run_child("init", function)[0] for _ in range(args.runs)]
+        invoke_runs = [run_child("invoke", function)[0] for _ in range(args.runs)]
+        (_, importtime_report) = run_child("init", function, importtime=True)
+        results[function] = {
+            "initMs": median_ms(run["init"] for run in init_runs),
+            "firstInvokeMs": median_ms(run["firstInvoke"] for run in invoke_runs),
+            "warmInvokeMs": median_ms(run["warmInvoke"] for run in invoke_runs),
+            "slowestImports": parse_importtime(importtime_report, f"{function}.app", args.slowest_imports),
+        }
+    results = {
+        "functions": results,
+        "config": {"runs": args.runs},
+        "environment": {
+            "gitCommit": pipeline_benchmark.get_git_commit(),
+            "python": sys.version.split()[0],
+        },
+    }
+
+    results_json = json.dumps(results, indent=2)
+    print(results_json)
+    if args.output:
+        args.output.write_text(results_json + "\n")
+
+
+def run_child(measurement:str, function:str, importtime:bool=False) -> tuple[dict, str]:
+    """Runs one measurement in a fresh process, and returns its result and its stderr."""
+    child_args = [sys.executable] + (["-X", "importtime"] if importtime else []) \
+        + [__file__, "--child", measurement, function]
+    completed = subprocess.run(child_args, capture_output=True, check=True, text=True)
+    return json.loads(completed.stdout.splitlines()[-1]), completed.stderr
+
+
+def measure_init(function:str) -> dict:
+    prepare_environment()
+    started_at = time.perf_counter()
+    # An import statement, unlike importlib.import_module, shows up in -X importtime's report
+    __import__(f"{function}.app")
+    return {"init": time.perf_counter() - started_at}
+
+
+def measure_invokes(function:str) -> dict:
+    prepare_environment()
+    import boto3
+    from moto import mock_aws
+    with mock_aws():
+        os.environ["CARD_IMG_FETCH_QUEUE"] = os.environ["PRIORITY_FETCH_QUEUE"] = \
+            pipeline_benchmark.create_aws_resources(boto3)
+        app = importlib.import_module(f"{function}.app")
+        event = make_event(function, app, boto3)
+        durations = []
+        for _ in range(2):
+            started_at = time.perf_counter()
+            # The lambdas' own logs would get in the way of the result line
+            with open("/dev/null", "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    app.lambda_handler(event, None)
+                finally:
+                    sys.stdout = stdout
+            durations.append(time.perf_counter() - started_at)
+    return {"firstInvoke": durations[0], "warmInvoke": durations[1]}
+
+
+def prepare_environment():
+    pipeline_benchmark.prepare_environment(types.SimpleNamespace(requests_per_second=10))
+    # Functions that queue need these set to import at all; invocations replace them with a real queue
+    os.environ.setdefault("CARD_IMG_FETCH_QUEUE", "unused")
+    os.environ.setdefault("PRIORITY_FETCH_QUEUE", "unused")
+
+
+def make_event(function:str, app, boto3) -> dict:
+    """Makes the function's event, and puts whatever it expects to find in moto."""
+    if function == "cardimg_add_batch":
+        return pipeline_benchmark.make_csv_upload_event(KNOWN_CARDPAGE_URIS)
+    from cardimg_common.batch_status import PENDING_STATUS, SUMMARY_ITEM_KEY, uri_item_key
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.put_item(TableName=pipeline_benchmark.BATCH_STATUS_TABLE, Item={
+        "batchId": {"S": BENCH_BATCH_ID}, "itemKey": {"S": SUMMARY_ITEM_KEY},
+        "totalCount": {"N": "2"}, "pendingCount": {"N": "2"}, "statusVersion": {"N": "1"},
+    })
+    if function == "cardimg_view_batch_status":
+        return pipeline_benchmark.make_view_status_event(BENCH_BATCH_ID, None)
+    if function == "cardimg_progress_events":
+        return json.loads(STREAM_RECORDS_EVENT.read_text())
+    for cardpage_uri in KNOWN_CARDPAGE_URIS:
+        s3_prefix = app.get_s3_prefix_for_cardimg(app.canonicalize_cardpage_uri(cardpage_uri))
+        dynamodb.put_item(TableName=pipeline_benchmark.BATCH_STATUS_TABLE, Item={
+            "batchId": {"S": BENCH_BATCH_ID}, "itemKey": {"S": uri_item_key(cardpage_uri)},
+            "cardpageUri": {"S": cardpage_uri}, "status": {"S": PENDING_STATUS},
+        })
+        dynamodb.put_item(TableName=pipeline_benchmark.KNOWN_IMAGES_TABLE, Item={
+            "s3Prefix": {"S": s3_prefix},
+        })
+    return {
+        "Records": [
+            {
+                "messageId": f"message-{i}",
+                "body": json.dumps({"batchId": BENCH_BATCH_ID, "itemFromBatch": {"Card Page URI": cardpage_uri}}),
+                "attributes": {"ApproximateReceiveCount": "1"},
+            }
+            for (i, cardpage_uri) in enumerate(KNOWN_CARDPAGE_URIS)
+        ]
+    }
+
+
+def parse_importtime(importtime_report:str, app_module:str, count:int) -> list[dict]:
+    """
+    Returns the slowest imports (by cumulative time, so including what they import) made by
+    app_module itself, from python -X importtime's report. Modules something else imported
+    first don't show up; they cost this import nothing.
+    """
+    # Each import is reported after the imports it made, which are indented one level more
+    imports = []
+    for line in importtime_report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        (_, cumulative_us, indented_name) = line.removeprefix("import time:").split("|")
+        if not cumulative_us.strip().isdigit():
+            continue
+        imports.append((len(indented_name) - len(indented_name.lstrip()), indented_name.strip(), int(cumulative_us)))
+
+    app_position = next((i for (i, (_, name, _)) in enumerate(imports) if name == app_module), None)
+    if app_position is None:
+        return []
+    app_indent = imports[app_position][0]
+    app_imports = []
+    for (indent, name, cumulative_us) in reversed(imports[:app_position]):
+        if indent <= app_indent:
+            break
+        if indent == app_indent + 2:
+            app_imports.append({"module": name, "cumulativeMs": round(cumulative_us / 1000, 1)})
+    return sorted(app_imports, key=lambda imported: -imported["cumulativeMs"])[:count]
+
+
+def median_ms(seconds:list[float]) -> float:
+    return round(1000 * statistics.median(seconds), 1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+"""
+A local stand-in for a card site like scryfall.com, for benchmarks. Serves card pages
+at /card/<name> whose img tag (with the configured css class) points to an image at
+/img/<name>.jpg on the same server. Every response can be delayed by a fixed latency,
+and a fraction of responses can be turned into 500s.
+"""
+import random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CARD_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><title>{name}</title></head>
+<body>
+<div class="header"><img class="logo" src="/static/logo.svg"></div>
+<div class="card-details">
+<img class="{cardimg_selector}" src="{base_url}/img/{name}.jpg?1700000000" alt="{name}">
+</div>
+</body>
+</html>
+"""
+FAKE_IMG_BYTES = b'\xff\xd8\xff\xe0' + bytes(range(256)) * 64
+
+
+class FakeCardSite:
+    def __init__(self, cardimg_selector:str, latency_seconds:float=0, error_rate:float=0,
+                 host:str="127.0.0.1"):
+        self.cardimg_selector = cardimg_selector
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, 0), self._make_handler())
+        self._server.daemon_threads = True
+        self.netloc = f"{host}:{self._server.server_address[1]}"
+        self.base_url = f"http://{self.netloc}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def cardpage_uri(self, name:str) -> str:
+        return f"{self.base_url}/card/{name}"
+
+    def _make_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with site._lock:
+                    site.request_count += 1
+                time.sleep(site.latency_seconds)
+                if random.random() < site.error_rate:
+                    self._respond(500, "text/plain", b"simulated error")
+                elif self.path.startswith("/card/"):
+                    name = self.path.removeprefix("/card/").strip("/")
+                    page = CARD_PAGE_TEMPLATE.format(
+                        name=name, cardimg_selector=site.cardimg_selector, base_url=site.base_url
+                    )
+                    self._respond(200, "text/html; charset=utf-8", page.encode())
+                elif self.path.startswith("/img/"):
+                    self._respond(200, "image/jpeg", FAKE_IMG_BYTES)
+                else:
+                    self._respond(404, "text/plain", b"not found")
+
+            def _respond(self, status:int, content_type:str, body:bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -1,6 +1,10 @@
 import csv, json, os, sys
 import importlib.util
 from io import StringIO
+from pathlib import Path
+
+# Lambdas import shared code (cardimg_common) from a layer; locally it lives in src/
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
 os.environ["AWS_ENDPOINT_URL"] = "http://localhost:4566"
 os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
@@ -8,7 +12,11 @@ os.environ["AWS_ACCESS_KEY_ID"] = "test"
 os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
 INVOKE_HANDLER_CMD = "invoke_handler"
 CREATE_BATCH_IN_PROGRESS_CMD = "create_batch_in_progress"
-ALL_COMMANDS = [INVOKE_HANDLER_CMD, CREATE_BATCH_IN_PROGRESS_CMD]
+REBUILD_KNOWN_IMAGES_INDEX_CMD = "rebuild_known_images_index"
+BENCHMARK_CMD = "benchmark"
+COLDSTART_CMD = "coldstart"
+ALL_COMMANDS = [INVOKE_HANDLER_CMD, CREATE_BATCH_IN_PROGRESS_CMD, REBUILD_KNOWN_IMAGES_INDEX_CMD, BENCHMARK_CMD,
+                COLDSTART_CMD]
 
 def main():
     if len(sys.argv) < 2 or sys.argv[1] not in ALL_COMMANDS:
@@ -28,25 +36,61 @@ def main():
             print("  python local_runner.py src/lambda/app.py events/event.json")
             sys.exit(1)
         return create_batch_in_progress()
+    elif sys.argv[1] == REBUILD_KNOWN_IMAGES_INDEX_CMD:
+        if len(sys.argv) != 4:
+            print("Usage: python local_runner.py rebuild_known_images_index <bucket_name> <table_name>")
+            print("Example:")
+            print("  python local_runner.py rebuild_known_images_index card-img-bucket CardImgKnownImages")
+            sys.exit(1)
+        return rebuild_known_images_index()
+    elif sys.argv[1] == BENCHMARK_CMD:
+        # Options are parsed by the benchmark itself; see --help
+        return benchmark()
+    elif sys.argv[1] == COLDSTART_CMD:
+        # Options are parsed by the benchmark itself; see --help
+        return coldstart()
     else:
         print("Unrecognized command (this should be unreachable)")
         sys.exit(1)
 
 def create_batch_in_progress():
-    os.environ["CARD_IMG_FETCH_QUEUE"] = "dontworryaboutit" # unused, but module won't load without it
+    import boto3
     workspace_folder = sys.argv[2]
     event_json_path = sys.argv[3]
     batch_id = sys.argv[4]
 
-    module_location = workspace_folder + "/src/cardimg_add_batch/app.py"
-    create_dynamo_record = load_handler_at_entrypoint(module_location, "create_dynamo_record")
+    common_location = workspace_folder + "/src/cardimg_common/"
+    create_batch_summary = load_handler_at_entrypoint(common_location + "batch_status.py", "create_batch_summary")
+    register_csvrows = load_handler_at_entrypoint(common_location + "batch_enqueue.py", "register_csvrows")
 
     with open(event_json_path, 'r') as f:
         event = json.load(f)
         csv_reader = csv.DictReader(StringIO(event['body']))
         csv_data = list(csv_reader)
 
-    create_dynamo_record(csv_data, batch_id)
+    dynamodb = boto3.client("dynamodb")
+    create_batch_summary(dynamodb, batch_id)
+    register_csvrows(dynamodb, csv_data, batch_id)
+
+def rebuild_known_images_index():
+    import boto3
+    from cardimg_common.known_images import KnownImagesIndex
+    bucket_name = sys.argv[2]
+    table_name = sys.argv[3]
+
+    known_images = KnownImagesIndex(boto3.client("dynamodb"), table_name, boto3.client("s3"), bucket_name)
+    indexed_count = known_images.rebuild_from_s3()
+    print(f"Indexed {indexed_count} card images from {bucket_name} into {table_name}")
+
+def benchmark():
+    # Runs against moto and local fake card sites rather than LocalStack (see pipeline_benchmark.py)
+    import pipeline_benchmark
+    pipeline_benchmark.main(sys.argv[2:])
+
+def coldstart():
+    # Measures each function in fresh processes (see coldstart_benchmark.py)
+    import coldstart_benchmark
+    coldstart_benchmark.main(sys.argv[2:])
 
 def invoke_handler():
     handler_path = sys.argv[2]
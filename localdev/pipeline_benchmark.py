@@ -0,0 +1,311 @@
+"""
+Runs the whole pipeline in one process, for throughput comparisons across commits:
+a synthetic csv of N card page uris goes through cardimg_add_batch, the fetch queue is
+drained into cardimg_single_scrape invocations (as the SQS event source would), and a
+client polls cardimg_view_batch_status after every scrape invocation. Batches too big for
+the priority queue are queued by the fetch scheduler, which runs whenever the queue is empty.
+
+AWS is moto's in-memory fake. Requests to the approved domains (scryfall.com and
+pkmncards.com) are routed to local fake card sites (see fake_card_site.py), which add a
+configurable latency and error rate to every response.
+
+Reports rows/sec, each row's latency from upload to scraped, p50/p99 latency of each
+handler and of each instrumented stage (see cardimg_common.instrumentation), and the AWS
+API calls made, as json. Run it with `python local_runner.py benchmark [options]`.
+"""
+import argparse, io, json, os, platform, subprocess, sys, time
+from contextlib import redirect_stdout
+from pathlib import Path
+from urllib.parse import urlparse, urlunparse
+
+WORKSPACE_FOLDER = Path(__file__).parent.parent
+BENCH_BUCKET = "bench-card-img-bucket"
+BENCH_QUEUE = "bench-card-img-fetch-queue"
+BATCH_STATUS_TABLE = "CardImgBatchStatus"
+KNOWN_IMAGES_TABLE = "CardImgKnownImages"
+APPROVED_DOMAINS_TO_SELECTORS = {"scryfall.com": "card", "pkmncards.com": "card-image"}
+
+sys.path.insert(0, str(WORKSPACE_FOLDER / "src"))
+sys.path.insert(0, str(WORKSPACE_FOLDER / "localdev"))
+
+
+def main(argv:list[str]):
+    parser = argparse.ArgumentParser(prog="local_runner.py benchmark")
+    parser.add_argument("--rows", type=int, default=200, help="rows in the synthetic csv")
+    parser.add_argument("--latency-ms", type=float, default=20, help="fake site latency per request")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of fake site responses that are 500s")
+    parser.add_argument("--requests-per-second", type=float, default=50, help="rate limit per approved domain")
+    parser.add_argument("--sqs-batch-size", type=int, default=10, help="records per scrape invocation")
+    parser.add_argument("--output", type=Path, help="also write the results to this json file")
+    args = parser.parse_args(argv)
+
+    prepare_environment(args)
+    # Imported only once the environment is set, since the lambdas read it on import
+    import boto3
+    from moto import mock_aws
+    from fake_card_site import FakeCardSite
+
+    sites = {
+        domain: FakeCardSite(selector, args.latency_ms / 1000, args.error_rate)
+        for (domain, selector) in APPROVED_DOMAINS_TO_SELECTORS.items()
+    }
+    with mock_aws(), sites["scryfall.com"], sites["pkmncards.com"]:
+        # One queue stands in for both the bulk and the priority fetch queues
+        os.environ["CARD_IMG_FETCH_QUEUE"] = os.environ["PRIORITY_FETCH_QUEUE"] = create_aws_resources(boto3)
+        results = run_pipeline(args, sites)
+    results["config"] = {name: value for (name, value) in vars(args).items() if name != "output"}
+    results["environment"] = {"gitCommit": get_git_commit(), "python": platform.python_version()}
+
+    results_json = json.dumps(results, indent=2)
+    print(results_json)
+    if args.output:
+        args.output.write_text(results_json + "\n")
+
+
+def prepare_environment(args):
+    # local_runner points boto3 at LocalStack; the benchmark uses moto instead
+    os.environ.pop("AWS_ENDPOINT_URL", None)
+    os.environ.pop("AWS_PROFILE", None)
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["CARDIMG_BUCKET"] = BENCH_BUCKET
+    os.environ["SCRAPER_APP_VERSION"] = "bench0"
+    os.environ["BATCH_STATUS_TABLE"] = BATCH_STATUS_TABLE
+    os.environ["KNOWN_IMAGES_TABLE"] = KNOWN_IMAGES_TABLE
+    os.environ["EVENT_LOG_SAMPLE_RATE"] = "0"
+    os.environ["APPROVED_DOMAINS_TO_CARDIMG_SELECTORS"] = json.dumps({
+        domain: {"selector": selector, "requestsPerSecond": args.requests_per_second, "burst": 1}
+        for (domain, selector) in APPROVED_DOMAINS_TO_SELECTORS.items()
+    })
+
+
+def run_pipeline(args, sites:dict) -> dict:
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    from cardimg_schedule_fetches import app as cardimg_schedule_fetches_app
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+    for (domain, site) in sites.items():
+        route_to_fake_site(cardimg_single_scrape_app.HTTP_SESSIONS[domain], domain, site)
+    aws_calls = count_aws_calls(["sqs", "s3", "dynamodb"])
+    stage_samples = collect_stage_samples()
+    handler_samples = {"addBatch": [], "scheduleFetches": [], "scrape": [], "viewStatus": []}
+    row_latencies, failed_uris = [], set()
+
+    cardpage_uris = make_cardpage_uris(args.rows)
+    started_at = time.perf_counter()
+    (add_batch_response, elapsed) = invoke(cardimg_add_batch_app.lambda_handler, make_csv_upload_event(cardpage_uris))
+    handler_samples["addBatch"].append(elapsed)
+    if add_batch_response["statusCode"] != 202:
+        raise RuntimeError(f"add_batch returned {add_batch_response['statusCode']}: {add_batch_response['body']}")
+    batch_id = json.loads(add_batch_response["body"])["batchId"]
+
+    def schedule_fetches() -> int:
+        # As the every-minute schedule would, but only once the queue has run dry
+        (schedule_response, elapsed) = invoke(cardimg_schedule_fetches_app.lambda_handler, {})
+        handler_samples["scheduleFetches"].append(elapsed)
+        return schedule_response["queuedRows"]
+
+    etag = None
+    for sqs_records in drain_queue(cardimg_schedule_fetches_app.sqs, args.sqs_batch_size, schedule_fetches):
+        (scrape_response, elapsed) = invoke(cardimg_single_scrape_app.lambda_handler, {"Records": sqs_records})
+        handler_samples["scrape"].append(elapsed)
+        finished_at = time.perf_counter()
+        failed_message_ids = {failure["itemIdentifier"] for failure in scrape_response["batchItemFailures"]}
+        for sqs_record in sqs_records:
+            cardpage_uri = json.loads(sqs_record["body"])["itemFromBatch"]["Card Page URI"]
+            if sqs_record["messageId"] in failed_message_ids:
+                failed_uris.add(cardpage_uri)
+            else:
+                failed_uris.discard(cardpage_uri)
+                row_latencies.append(finished_at - started_at)
+        delete_messages(cardimg_schedule_fetches_app.sqs, sqs_records, failed_message_ids)
+        # A client polling for progress, as the upload page does
+        (view_response, elapsed) = invoke(
+            cardimg_view_batch_status_app.lambda_handler, make_view_status_event(batch_id, etag)
+        )
+        handler_samples["viewStatus"].append(elapsed)
+        etag = view_response["headers"].get("ETag", etag)
+    elapsed = time.perf_counter() - started_at
+
+    (final_status, _) = invoke(cardimg_view_batch_status_app.lambda_handler, make_view_status_event(batch_id, None))
+    return {
+        "rows": args.rows,
+        "seconds": round(elapsed, 3),
+        "rowsPerSecond": round(args.rows / elapsed, 2),
+        "failedRows": len(failed_uris),
+        "statusCounts": json.loads(final_status["body"])["statusCounts"],
+        "rowLatency": summarize(row_latencies),
+        "handlers": {name: summarize(samples) for (name, samples) in handler_samples.items()},
+        "stages": {name: summarize(samples) for (name, samples) in sorted(stage_samples.items())},
+        "awsCalls": dict(sorted(aws_calls.items())),
+        "siteRequests": {domain: site.request_count for (domain, site) in sites.items()},
+    }
+
+
+def invoke(lambda_handler, event:dict) -> tuple[dict, float]:
+    """Invokes a handler with its logs silenced, and returns its response and duration."""
+    started_at = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        response = lambda_handler(event, None)
+    return response, time.perf_counter() - started_at
+
+
+def drain_queue(sqs, batch_size:int, refill):
+    """
+    Yields batches of sqs records the way the SQS event source hands them to the scraper,
+    until the queue is empty and refill (which returns the number of messages it queued)
+    has nothing left to add. Messages whose last receive failed are redelivered straight
+    away (the queue has no visibility timeout), up to the template's maxReceiveCount.
+    """
+    queue_url = os.environ["CARD_IMG_FETCH_QUEUE"]
+    while True:
+        messages = sqs.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=batch_size, MessageSystemAttributeNames=["All"]
+        ).get("Messages", [])
+        if not messages:
+            if refill():
+                continue
+            return
+        yield [
+            {
+                "messageId": message["MessageId"],
+                "receiptHandle": message["ReceiptHandle"],
+                "body": message["Body"],
+                "attributes": message["Attributes"],
+            }
+            for message in messages
+        ]
+
+
+def delete_messages(sqs, sqs_records:list[dict], failed_message_ids:set[str]):
+    from cardimg_single_scrape.app import SQS_MAX_RECEIVE_COUNT
+    # Messages that have failed maxReceiveCount times would go to the dead letter queue
+    done_records = [
+        sqs_record for sqs_record in sqs_records
+        if sqs_record["messageId"] not in failed_message_ids
+            or int(sqs_record["attributes"]["ApproximateReceiveCount"]) >= SQS_MAX_RECEIVE_COUNT
+    ]
+    if done_records:
+        sqs.delete_message_batch(
+            QueueUrl=os.environ["CARD_IMG_FETCH_QUEUE"],
+            Entries=[
+                {"Id": str(i), "ReceiptHandle": sqs_record["receiptHandle"]}
+                for (i, sqs_record) in enumerate(done_records)
+            ]
+        )
+
+
+def route_to_fake_site(http_session, domain:str, site):
+    """Sends the session's requests for https://<domain>/... to the fake site instead."""
+    adapter = http_session.get_adapter(f"https://{domain}/")
+    send = adapter.send
+    def send_to_fake_site(request, **kwargs):
+        parsed_url = urlparse(request.url)
+        if parsed_url.netloc == domain:
+            request.url = urlunparse(parsed_url._replace(scheme="http", netloc=site.netloc))
+        return send(request, **kwargs)
+    adapter.send = send_to_fake_site
+
+
+def count_aws_calls(service_names:list[str]) -> dict[str, int]:
+    """Counts the calls made by each service's client, which every lambda shares in-process."""
+    from cardimg_common.aws_clients import get_client
+    aws_calls = {}
+    def count_call(model, **kwargs):
+        call_name = f"{model.service_model.service_name}.{model.name}"
+        aws_calls[call_name] = aws_calls.get(call_name, 0) + 1
+    for service_name in service_names:
+        get_client(service_name).meta.events.register("before-call", count_call)
+    return aws_calls
+
+
+def collect_stage_samples() -> dict[str, list[float]]:
+    """
+    Keeps the duration of every instrumented span, by handler and stage. Streamed reads
+    (timed_iter) aren't spans of their own, so they aren't in the percentiles.
+    """
+    from cardimg_common.instrumentation import InvocationMetrics
+    stage_samples = {}
+    add_time = InvocationMetrics.add_time
+    def add_time_and_keep_sample(metrics, stage:str, seconds:float, count:int=1):
+        if count:
+            stage_samples.setdefault(f"{metrics.service}.{stage}", []).append(seconds)
+        add_time(metrics, stage, seconds, count)
+    InvocationMetrics.add_time = add_time_and_keep_sample
+    return stage_samples
+
+
+def summarize(samples:list[float]) -> dict:
+    ordered = sorted(samples)
+    def percentile_ms(percent:float) -> float|None:
+        if not ordered:
+            return None
+        # Nearest rank
+        return round(1000 * ordered[max(int(len(ordered) * percent / 100 + .5) - 1, 0)], 2)
+    return {
+        "count": len(ordered),
+        "totalMs": round(1000 * sum(ordered), 1),
+        "p50Ms": percentile_ms(50),
+        "p99Ms": percentile_ms(99),
+    }
+
+
+def make_cardpage_uris(row_count:int) -> list[str]:
+    return [
+        f"https://scryfall.com/card/bench/{i}/card-{i}" if i % 2 else f"https://pkmncards.com/card/bench-card-{i}/"
+        for i in range(row_count)
+    ]
+
+
+def make_csv_upload_event(cardpage_uris:list[str]) -> dict:
+    return {
+        "body": "\n".join(["Card Page URI"] + cardpage_uris) + "\n",
+        "isBase64Encoded": False,
+        "queryStringParameters": None,
+    }
+
+
+def make_view_status_event(batch_id:str, etag:str|None) -> dict:
+    return {
+        "pathParameters": {"batchId": batch_id},
+        "queryStringParameters": {"summary": "true"},
+        "headers": {"If-None-Match": etag} if etag else {},
+    }
+
+
+def create_aws_resources(boto3) -> str:
+    """Creates the bucket, tables and fetch queue, and returns the queue's url."""
+    boto3.client("s3").create_bucket(Bucket=BENCH_BUCKET)
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.create_table(
+        TableName=BATCH_STATUS_TABLE,
+        KeySchema=[
+            {"AttributeName": "batchId", "KeyType": "HASH"},
+            {"AttributeName": "itemKey", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "batchId", "AttributeType": "S"},
+            {"AttributeName": "itemKey", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    dynamodb.create_table(
+        TableName=KNOWN_IMAGES_TABLE,
+        KeySchema=[{"AttributeName": "s3Prefix", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "s3Prefix", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    return boto3.client("sqs").create_queue(
+        QueueName=BENCH_QUEUE, Attributes={"VisibilityTimeout": "0"}
+    )["QueueUrl"]
+
+
+def get_git_commit() -> str|None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=WORKSPACE_FOLDER,
+            capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
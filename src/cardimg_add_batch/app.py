@@ -1,24 +1,40 @@
-import boto3, csv, json, os, uuid
-from datetime import datetime, timedelta, UTC
-from io import StringIO
-from typing import Any
-from urllib.parse import urlparse
-from validators.url import url as validators_url
+import base64, binascii, csv, gzip, json, os, uuid, zlib
+from cardimg_common.aws_clients import LazyClient
+from cardimg_common.batch_enqueue import (
+    ENQUEUE_CHUNK_ROWS, chunked, register_csvrows, send_csvrows_to_sqs
+)
+from cardimg_common.batch_status import create_batch_summary, schedule_batch
+from cardimg_common.batch_validation import get_header_error, validate_csvrows
+from cardimg_common.instrumentation import instrumented_handler, record_value, span, timed_iter
+from io import BytesIO, StringIO, TextIOWrapper
+from itertools import chain, islice
+from typing import Any, Iterable, Iterator, TextIO
 
-sqs = boto3.client("sqs")
-dynamodb = boto3.resource("dynamodb")
+# Created on first use, so that a request that fails validation never loads boto3
+sqs = LazyClient("sqs")
+dynamodb = LazyClient("dynamodb")
 
+# The scraper reads from two queues. Batches of up to PRIORITY_BATCH_MAX_ROWS rows are queued
+# straight onto the priority queue, which the scraper polls with concurrency of its own, so
+# a small batch never waits behind a big one. Bigger batches are only registered in dynamo
+# here, and the fetch scheduler (cardimg_schedule_fetches) trickles them onto the bulk
+# queue, round-robin between batches.
+PRIORITY_FETCH_QUEUE = os.environ['PRIORITY_FETCH_QUEUE']
+PRIORITY_BATCH_MAX_ROWS = int(os.environ.get('PRIORITY_BATCH_MAX_ROWS', 100))
 
-# We only care about the keys of the APPROVED_DOMAINS_TO_CARDIMG_SELECTORS
-# variable; the values are only relevant to the 'single scrape' lambda.
-APPROVED_DOMAINS = \
-    list(json.loads(os.environ['APPROVED_DOMAINS_TO_CARDIMG_SELECTORS']).keys())
-CARD_IMG_FETCH_QUEUE = os.environ['CARD_IMG_FETCH_QUEUE']
-CARD_PAGE_URI_COLUMN = "Card Page URI"
+GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+# Errors raised while decoding or decompressing a malformed body. Because the body is
+# streamed, these can surface at any row, not only while the header is being read.
+BODY_DECODING_ERRORS = (binascii.Error, UnicodeDecodeError, OSError, EOFError, zlib.error, csv.Error)
 
+def get_body_bytes(event) -> int:
+    return len(event.get('body') or '')
+
+@instrumented_handler("cardimg_add_batch", get_payload_bytes=get_body_bytes)
 def lambda_handler(event, context) -> dict[str, Any]:
     try:
-        data, user_errors = validate_event(event)
+        with span('validation'):
+            user_errors = validate_event(event)
         if user_errors:
             return {
                 "statusCode": 400,
@@ -27,8 +43,20 @@ def lambda_handler(event, context) -> dict[str, Any]:
             }
         else:
             new_batch_id = str(uuid.uuid4())
-            create_dynamo_record(data, new_batch_id)
-            responses = send_csvrows_to_sqs(data, new_batch_id)
+            # ?refresh=true re-checks cards that already have an image, with conditional GETs
+            refresh = (event.get('queryStringParameters') or {}).get('refresh', '').lower() == 'true'
+            csv_rows = iter_timed_csvrows(iter_csvrows(event), count_rows=False)
+            unqueued_rows = enqueue_csvrows(csv_rows, new_batch_id, refresh=refresh)
+            if unqueued_rows:
+                return {
+                    "statusCode": 500,
+                    "headers": {'Content-Type': 'application/json'},
+                    "body": json.dumps({
+                        "batchId": new_batch_id,
+                        "error": "Some rows could not be queued",
+                        "unqueuedRows": unqueued_rows,
+                    }),
+                }
             return {
                 "statusCode": 202,
                 "headers": {'Content-Type': 'application/json'},
@@ -40,83 +68,105 @@ def lambda_handler(event, context) -> dict[str, Any]:
             'headers': {'Content-Type': 'application/json'},
             'body': json.dumps({'error': str(type(e))})
         }
-    
 
-def validate_event(event) -> tuple[list[dict[str, str]], dict[str, Any]]:
-    data = []
+
+def open_csv_body(event) -> TextIO:
+    """
+    Returns a text stream over the request body. Bodies that API Gateway delivers
+    base64-encoded (isBase64Encoded) are decoded, and gzip-compressed bodies are
+    decompressed lazily as the stream is read.
+    """
+    body = event['body']
+    if body is None:
+        raise KeyError('body')
+    if not event.get('isBase64Encoded'):
+        return StringIO(body)
+    raw_body = base64.b64decode(body, validate=True)
+    if raw_body.startswith(GZIP_MAGIC_NUMBER):
+        return TextIOWrapper(gzip.GzipFile(fileobj=BytesIO(raw_body)), encoding='utf-8-sig', newline='')
+    return TextIOWrapper(BytesIO(raw_body), encoding='utf-8-sig', newline='')
+
+
+def iter_csvrows(event) -> Iterator[dict[str, str]]:
+    """Streams the rows of the request body's csv, one dict per row."""
+    return csv.DictReader(open_csv_body(event))
+
+
+def iter_timed_csvrows(csv_reader:Iterator[dict[str, str]], count_rows:bool=True) -> Iterator[dict[str, str]]:
+    """
+    Yields csv_reader's rows, timing their decoding and parsing as the csvParse stage. The
+    body is parsed twice (to validate it, then to queue it), but its rows are only counted
+    (as csvRows) on the pass that has count_rows.
+    """
+    row_count = 0
+    for row in timed_iter(csv_reader, 'csvParse'):
+        row_count += 1
+        yield row
+    if count_rows:
+        record_value('csvRows', row_count)
+
+
+def validate_event(event) -> dict[str, Any]:
+    """
+    Validates the csv in the request body in a single streaming pass. Rows are
+    checked as they are parsed and then discarded, so only errors are retained.
+    """
     user_errors = {}
     try:
-        csv_headercheck = csv.reader(StringIO(event['body']))
-        if CARD_PAGE_URI_COLUMN not in next(csv_headercheck):
-            raise ValueError(f"Missing column {CARD_PAGE_URI_COLUMN}")
-        csv_reader = csv.DictReader(StringIO(event['body']))
-    except (KeyError, StopIteration):
+        csv_reader = iter_csvrows(event)
+        with span('csvParse'):
+            fieldnames = csv_reader.fieldnames # type:ignore[reportAttributeAccessIssue]
+    except KeyError:
         user_errors["bodyErrors"] = "Request body missing or inaccessible"
-    except ValueError:
-        user_errors["bodyErrors"] ="CSV headers missing or malformed"
+    except BODY_DECODING_ERRORS:
+        user_errors["bodyErrors"] = "Request body could not be decoded"
     else:
-        data = list(csv_reader)
-        single_row_errors = _validate_csvdata_singlerows(data)
-        if single_row_errors:
-            user_errors["singleRowErrors"] = single_row_errors
+        # Same header checks (and messages) as a batch uploaded to S3
+        header_error = get_header_error(fieldnames)
+        if header_error:
+            user_errors["bodyErrors"] = header_error
+            return user_errors
+        try:
+            single_row_errors = validate_csvrows(iter_timed_csvrows(csv_reader))
+        except BODY_DECODING_ERRORS:
+            user_errors["bodyErrors"] = "Request body could not be decoded"
+        else:
+            if single_row_errors:
+                user_errors["singleRowErrors"] = single_row_errors
         # Could add cross-field validations here. Perhaps enforce uniqueness?
 
-    return data, user_errors
-
+    return user_errors
 
-def _validate_csvdata_singlerows(csvdata:list[dict[str,str]]) -> dict[int,list[str]]:
-    errors_by_row = {}
-    for (i, row) in  enumerate(csvdata):
-        row_errors = []
-        row_errors.extend(_validate_cardpage_uri(row))
-        #additional validations would go here
-        if row_errors:
-            # i + 2 because a text file is 1-indexed, not 0-indexed, and also the
-            # first row is the column names
-            errors_by_row[i+2] = row_errors
-    return errors_by_row
 
-def _validate_cardpage_uri(csv_row:dict[str, str]) -> list[str]:
-    errors = []
-    try:
-        cardpage_uri_text = csv_row[CARD_PAGE_URI_COLUMN]
-        if not cardpage_uri_text:
-            errors.append("uri missing")
-        # urllib will allow a lot of arbitrary input, so this next check is to avoid js or html injections
-        elif not validators_url(cardpage_uri_text):
-            errors.append("uri not valid (make sure it starts with 'https://' and points to a real webpage)")
-        else:
-            cardpage_uri = urlparse(cardpage_uri_text.lower())
-            if cardpage_uri.scheme != "https":
-                errors.append("uri must begin with 'https://'")
-            elif cardpage_uri.netloc.removeprefix('www.') not in APPROVED_DOMAINS:
-                errors.append("uri not in approved domains")
-                
-    except KeyError as ke:
-        errors.append("malformed row")
-    return errors
-
-
-def send_csvrows_to_sqs(csv_data:list[dict[str, str]], batch_id:str) -> list[dict[str,str]]:
-    responses = []
-    for row in csv_data:
-        sqs_message_body = { "batchId": batch_id, "itemFromBatch": row}
-        sqs_response = sqs.send_message(
-            QueueUrl=CARD_IMG_FETCH_QUEUE,
-            MessageBody=json.dumps(sqs_message_body)
-        )
-        responses.append(sqs_response)
-    return responses
-
-
-def create_dynamo_record(csv_data:list[dict[str, str]], batch_id:str):
-    progress_document = {}
-    for row in csv_data:
-        progress_document[row[CARD_PAGE_URI_COLUMN]] = "PENDING"
-    batchStatusTable = dynamodb.Table("CardImgBatchStatus") # type:ignore[reportAttributeAccessIssue]
-    batchStatusTable.put_item(Item={
-        "batchId": batch_id,
-        "progressDocument": progress_document,
-        "expiresAt": int((datetime.now(UTC) + timedelta(days=30)).timestamp())
-        }
-    )
\ No newline at end of file
+def enqueue_csvrows(csv_rows:Iterable[dict[str, str]], batch_id:str, refresh:bool=False) -> list[int]:
+    """
+    Registers csv_rows in the batch's dynamo record, one chunk at a time as they are read,
+    and queues them: a small batch's rows go straight onto the priority queue, chunk by
+    chunk, and a big batch is handed to the fetch scheduler once all its rows are
+    registered. Each chunk is added to dynamo before it is queued, so the scraper never
+    sees a uri that the batch record doesn't know about.
+    Returns the csv line numbers of any rows that could not be queued.
+    """
+    # Reading one row past the priority lane's limit is enough to tell if the batch fits in it
+    csv_rows = iter(csv_rows)
+    first_rows = list(islice(csv_rows, PRIORITY_BATCH_MAX_ROWS + 1))
+    prioritized = len(first_rows) <= PRIORITY_BATCH_MAX_ROWS
+    with span('dynamoWrite'):
+        create_batch_summary(dynamodb, batch_id)
+    # Only the uris are kept across chunks, so that a uri repeated anywhere in the csv is
+    # counted once in the batch's status counters.
+    registered_uris = set()
+    unqueued_rows = []
+    rows_seen = 0
+    for chunk in chunked(chain(first_rows, csv_rows), ENQUEUE_CHUNK_ROWS):
+        with span('dynamoWrite'):
+            registered_uris.update(register_csvrows(dynamodb, chunk, batch_id, registered_uris))
+        if prioritized:
+            with span('enqueue'):
+                unqueued_rows.extend(send_csvrows_to_sqs(sqs, chunk, batch_id, PRIORITY_FETCH_QUEUE,
+                                                         first_row_index=rows_seen, refresh=refresh))
+        rows_seen += len(chunk)
+    if not prioritized:
+        with span('dynamoWrite'):
+            schedule_batch(dynamodb, batch_id, refresh)
+    return unqueued_rows
@@ -0,0 +1,440 @@
+import csv, json, os, time, uuid
+from botocore.exceptions import ClientError
+from cardimg_common.aws_clients import LazyClient
+from cardimg_common.batch_enqueue import ENQUEUE_CHUNK_ROWS, chunked, register_csvrows, send_csvrows_to_sqs
+from cardimg_common.batch_status import (
+    AWAITING_UPLOAD_INGEST_STATUS, BATCH_STATUS_TABLE, QUEUED_INGEST_STATUS, QUEUEING_INGEST_STATUS,
+    REJECTED_INGEST_STATUS, SUMMARY_ITEM_KEY, UNFINISHED_INGEST_STATUSES, URI_ITEM_KEY_PREFIX,
+    VALIDATING_INGEST_STATUS, create_batch_summary, schedule_batch
+)
+from cardimg_common.batch_validation import get_header_error, validate_csvrows
+from cardimg_common.instrumentation import instrumented_handler, record_value, span, timed_iter
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator
+from urllib.parse import unquote_plus
+
+# Created on first use, so that each handler only ever loads the clients it needs
+sqs = LazyClient("sqs")
+dynamodb = LazyClient("dynamodb")
+s3 = LazyClient("s3")
+lambda_client = LazyClient("lambda")
+
+# Batches too big for a request body are uploaded straight to this bucket instead, with a
+# presigned url (see request_upload_handler), and ingested from there by
+# ingest_upload_handler, which the upload triggers.
+BATCH_UPLOAD_BUCKET = os.environ.get('BATCH_UPLOAD_BUCKET')
+BATCH_UPLOAD_KEY_PREFIX = "uploads/"
+BATCH_UPLOAD_CONTENT_TYPE = "text/csv"
+BATCH_UPLOAD_URL_EXPIRES_SECONDS = 15 * 60
+MAX_BATCH_UPLOAD_BYTES = int(os.environ.get('MAX_BATCH_UPLOAD_BYTES', 256 * 1024 * 1024))
+S3_READ_CHUNK_BYTES = 1024 * 1024
+# Uploaded csvs can have any number of bad rows, so only the first ones are reported.
+MAX_REPORTED_ROW_ERRORS = 100
+# Errors raised while decoding or parsing a malformed csv, at any row.
+CSV_DECODING_ERRORS = (UnicodeDecodeError, csv.Error)
+
+# Like cardimg_add_batch, uploaded batches of up to PRIORITY_BATCH_MAX_ROWS rows are queued
+# straight onto the priority queue, and bigger ones are handed to the fetch scheduler
+# (cardimg_schedule_fetches). Only ingestion queues anything.
+PRIORITY_FETCH_QUEUE = os.environ.get('PRIORITY_FETCH_QUEUE')
+PRIORITY_BATCH_MAX_ROWS = int(os.environ.get('PRIORITY_BATCH_MAX_ROWS', 100))
+
+# An ingestion saves its progress (the byte offset of the next row to read) to the batch's
+# summary item at least this often, and stops this long before the lambda would time out,
+# so that the next invocation can resume where it left off. While an invocation is working
+# on a batch it holds a lease on it, so a redelivered S3 event can't ingest it twice.
+INGEST_CHECKPOINT_INTERVAL_SECONDS = 5
+INGEST_STOP_MARGIN_SECONDS = 60
+INGEST_DEFAULT_LEASE_SECONDS = 15 * 60
+
+@instrumented_handler("cardimg_request_batch_upload")
+def request_upload_handler(event, context) -> dict[str, Any]:
+    """
+    Starts a batch whose csv is uploaded straight to S3 rather than sent in the request
+    body, which limits its size to API Gateway's. Returns the new batch's id, and a
+    presigned url to PUT the csv to; the upload starts its ingestion (ingest_upload_handler).
+    """
+    try:
+        new_batch_id = str(uuid.uuid4())
+        # ?refresh=true applies to the uploaded csv's rows, as it does to a request body's
+        refresh = (event.get('queryStringParameters') or {}).get('refresh', '').lower() == 'true'
+        with span('dynamoWrite'):
+            create_batch_summary(dynamodb, new_batch_id, summary_attributes={
+                "ingestStatus": {'S': AWAITING_UPLOAD_INGEST_STATUS},
+                "refresh": {'BOOL': refresh},
+            })
+        upload_url = s3.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': BATCH_UPLOAD_BUCKET,
+                'Key': get_batch_upload_key(new_batch_id),
+                'ContentType': BATCH_UPLOAD_CONTENT_TYPE,
+            },
+            ExpiresIn=BATCH_UPLOAD_URL_EXPIRES_SECONDS
+        )
+        return {
+            "statusCode": 201,
+            "headers": {'Content-Type': 'application/json'},
+            "body": json.dumps({
+                "batchId": new_batch_id,
+                "uploadUrl": upload_url,
+                "uploadHeaders": {"Content-Type": BATCH_UPLOAD_CONTENT_TYPE},
+                "maxUploadBytes": MAX_BATCH_UPLOAD_BYTES,
+                "expiresInSeconds": BATCH_UPLOAD_URL_EXPIRES_SECONDS,
+            }),
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(type(e))})
+        }
+
+
+@instrumented_handler("cardimg_ingest_batch_upload")
+def ingest_upload_handler(event, context):
+    """
+    Ingests uploaded batch csvs: for S3's ObjectCreated events, and for the continuations
+    this function sends itself when a csv takes longer than one invocation to ingest.
+    """
+    uploads = [
+        (s3_record['s3']['bucket']['name'], unquote_plus(s3_record['s3']['object']['key']))
+        for s3_record in event.get('Records', [])
+    ]
+    continuation = event.get('batchUploadContinuation')
+    if continuation:
+        uploads.append((continuation['bucket'], continuation['key']))
+    for (bucket, key) in uploads:
+        ingest_batch_upload(bucket, key, context)
+
+
+def get_batch_upload_key(batch_id:str) -> str:
+    return f"{BATCH_UPLOAD_KEY_PREFIX}{batch_id}.csv"
+
+
+def get_batch_id_from_upload_key(key:str) -> str|None:
+    if not (key.startswith(BATCH_UPLOAD_KEY_PREFIX) and key.endswith(".csv")):
+        return None
+    try:
+        return str(uuid.UUID(key[len(BATCH_UPLOAD_KEY_PREFIX):-len(".csv")]))
+    except ValueError:
+        return None
+
+
+def ingest_batch_upload(bucket:str, key:str, context):
+    """
+    Validates the uploaded csv at bucket/key in full, then registers and queues its rows,
+    one chunk at a time as they are read, like cardimg_add_batch does for a request body.
+    If the invocation is running out of time, the progress so far is saved and the
+    function invokes itself to carry on from there.
+    """
+    batch_id = get_batch_id_from_upload_key(key)
+    if batch_id is None:
+        print(f"Ignoring {key}, which isn't a batch upload.")
+        return
+    lease_expires_at = get_lease_expiry(context)
+    with span('dynamoWrite'):
+        progress = claim_batch_ingestion(batch_id, lease_expires_at)
+    if progress is None:
+        print(f"Batch {batch_id} is already ingested, or being ingested by another invocation.")
+        return
+    try:
+        finished = ingest_claimed_upload(bucket, key, batch_id, progress, lease_expires_at,
+                                         make_time_left_check(context))
+    except Exception:
+        release_ingest_lease(batch_id, lease_expires_at)
+        raise
+    if not finished:
+        print(f"Stopping batch {batch_id} after {progress['processedRows']} rows; continuing in a new invocation.")
+        lambda_client.invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({"batchUploadContinuation": {"bucket": bucket, "key": key}}).encode()
+        )
+
+
+def ingest_claimed_upload(bucket:str, key:str, batch_id:str, progress:dict, lease_expires_at:float,
+                          has_time_left:Callable[[], bool]) -> bool:
+    """
+    Carries on ingesting the batch from progress (see read_ingest_progress), saving it as
+    it goes. Returns False if it stopped early for lack of time, and True once the batch is
+    QUEUED or REJECTED.
+    """
+    if progress['status'] == AWAITING_UPLOAD_INGEST_STATUS:
+        with span('s3Check'):
+            upload = s3.head_object(Bucket=bucket, Key=key)
+        record_value('uploadBytes', upload['ContentLength'], "Bytes")
+        # Every read is conditional on this ETag, so a csv replaced halfway through ingestion
+        # isn't half one file and half the other
+        progress.update(status=VALIDATING_INGEST_STATUS, etag=upload['ETag'])
+        if upload['ContentLength'] > MAX_BATCH_UPLOAD_BYTES:
+            progress.update(status=REJECTED_INGEST_STATUS,
+                            errors={"bodyErrors": f"CSV larger than {MAX_BATCH_UPLOAD_BYTES} bytes"})
+
+    registered_uris = None
+    last_saved_at = time.monotonic()
+    while progress['status'] in (VALIDATING_INGEST_STATUS, QUEUEING_INGEST_STATUS):
+        validating = progress['status'] == VALIDATING_INGEST_STATUS
+        try:
+            (csv_reader, csv_lines) = open_uploaded_csv(bucket, key, progress)
+            if progress['processedBytes'] == 0:
+                with span('csvParse'):
+                    progress['fieldnames'] = csv_reader.fieldnames
+                header_error = get_header_error(csv_reader.fieldnames)
+                if header_error:
+                    progress.update(status=REJECTED_INGEST_STATUS, errors={"bodyErrors": header_error})
+                    break
+            if not validating and registered_uris is None:
+                with span('dynamoRead'):
+                    registered_uris = get_registered_uris(batch_id) if progress['processedRows'] else set()
+            row_count = 0
+            for chunk in chunked(timed_iter(csv_reader, 'csvParse'), ENQUEUE_CHUNK_ROWS):
+                if validating:
+                    with span('validation'):
+                        add_row_errors(progress['errors'], validate_csvrows(
+                            chunk, first_row_index=progress['processedRows']
+                        ))
+                else:
+                    with span('dynamoWrite'):
+                        registered_uris.update(register_csvrows(dynamodb, chunk, batch_id, registered_uris))
+                    # Big batches are queued by the fetch scheduler once they're all registered
+                    unqueued_rows = []
+                    if progress['rowCount'] <= PRIORITY_BATCH_MAX_ROWS:
+                        with span('enqueue'):
+                            unqueued_rows = send_csvrows_to_sqs(
+                                sqs, chunk, batch_id, PRIORITY_FETCH_QUEUE,
+                                first_row_index=progress['processedRows'], refresh=progress['refresh']
+                            )
+                    if unqueued_rows:
+                        print(f"Could not queue rows {unqueued_rows} of batch {batch_id}")
+                        progress['unqueuedRowCount'] += len(unqueued_rows)
+                row_count += len(chunk)
+                progress['processedRows'] += len(chunk)
+                progress['processedBytes'] = csv_lines.offset
+                if not has_time_left():
+                    record_value('csvRows', row_count)
+                    with span('dynamoWrite'):
+                        save_ingest_progress(batch_id, progress, lease_expires_at, release_lease=True)
+                    return False
+                if time.monotonic() - last_saved_at >= INGEST_CHECKPOINT_INTERVAL_SECONDS:
+                    with span('dynamoWrite'):
+                        save_ingest_progress(batch_id, progress, lease_expires_at)
+                    last_saved_at = time.monotonic()
+            record_value('csvRows', row_count)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'PreconditionFailed':
+                raise
+            progress.update(status=REJECTED_INGEST_STATUS,
+                            errors={"bodyErrors": "CSV was replaced while it was being ingested"})
+        except CSV_DECODING_ERRORS:
+            if not validating:
+                raise
+            progress.update(status=REJECTED_INGEST_STATUS, errors={"bodyErrors": "CSV could not be decoded"})
+        else:
+            if validating and progress['errors']:
+                progress['status'] = REJECTED_INGEST_STATUS
+            elif validating:
+                # Queueing reads the csv again from the start
+                progress.update(status=QUEUEING_INGEST_STATUS, rowCount=progress['processedRows'],
+                                processedBytes=0, processedRows=0)
+            else:
+                if progress['rowCount'] > PRIORITY_BATCH_MAX_ROWS:
+                    with span('dynamoWrite'):
+                        schedule_batch(dynamodb, batch_id, progress['refresh'])
+                progress['status'] = QUEUED_INGEST_STATUS
+
+    with span('dynamoWrite'):
+        save_ingest_progress(batch_id, progress, lease_expires_at, release_lease=True)
+    return True
+
+
+class ByteOffsetLines:
+    """
+    Splits a stream of utf-8 bytes into lines of text for a csv reader, and keeps track of
+    the offset (in bytes) of the end of the last line handed out. A csv reader only reads
+    the lines of the row it's parsing, so between rows, offset is where the next row starts.
+    """
+
+    def __init__(self, chunks:Iterable[bytes], offset:int=0):
+        self.offset = offset
+        self._lines = self._split_lines(chunks)
+        # Only the start of the file can have a byte order mark
+        self._encoding = 'utf-8-sig' if offset == 0 else 'utf-8'
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = next(self._lines)
+        self.offset += len(line)
+        text = line.decode(self._encoding)
+        self._encoding = 'utf-8'
+        return text
+
+    @staticmethod
+    def _split_lines(chunks:Iterable[bytes]) -> Iterator[bytes]:
+        pending = b''
+        for chunk in chunks:
+            (*lines, pending) = (pending + chunk).split(b'\n')
+            for line in lines:
+                yield line + b'\n'
+        if pending:
+            yield pending
+
+
+def open_uploaded_csv(bucket:str, key:str, progress:dict) -> tuple[csv.DictReader, ByteOffsetLines]:
+    """
+    Streams the uploaded csv's rows from progress['processedBytes'] on. Returns the csv
+    reader, and the lines it reads from, whose offset is where the next row starts.
+    """
+    start_byte = progress['processedBytes']
+    get_object_kwargs = {'Bucket': bucket, 'Key': key, 'IfMatch': progress['etag']}
+    if start_byte:
+        get_object_kwargs['Range'] = f"bytes={start_byte}-"
+    try:
+        with span('s3Read'):
+            chunks = s3.get_object(**get_object_kwargs)['Body'].iter_chunks(S3_READ_CHUNK_BYTES)
+    except ClientError as e:
+        # Progress was saved right after the last row, so there's nothing left to read
+        if e.response['Error']['Code'] != 'InvalidRange':
+            raise
+        chunks = iter(())
+    csv_lines = ByteOffsetLines(timed_iter(chunks, 's3Read'), start_byte)
+    # Resuming past the header, the column names come from the saved progress instead
+    return csv.DictReader(csv_lines, fieldnames=progress['fieldnames'] if start_byte else None), csv_lines
+
+
+def add_row_errors(errors:dict, new_errors_by_row:dict[int, list[str]]):
+    """Adds new_errors_by_row to errors' singleRowErrors, up to MAX_REPORTED_ROW_ERRORS rows."""
+    if not new_errors_by_row:
+        return
+    errors['singleRowErrorCount'] = errors.get('singleRowErrorCount', 0) + len(new_errors_by_row)
+    single_row_errors = errors.setdefault('singleRowErrors', {})
+    for (row_number, row_errors) in islice(new_errors_by_row.items(),
+                                           max(MAX_REPORTED_ROW_ERRORS - len(single_row_errors), 0)):
+        # As json keys (the form they're saved in), row numbers are strings
+        single_row_errors[str(row_number)] = row_errors
+
+
+def get_registered_uris(batch_id:str) -> set[str]:
+    """Returns the uris that are already in the batch's dynamo record, e.g. to resume queueing it."""
+    registered_uris = set()
+    query_kwargs = {
+        'TableName': BATCH_STATUS_TABLE,
+        'KeyConditionExpression': 'batchId = :batch_id AND begins_with(itemKey, :uri_prefix)',
+        'ProjectionExpression': 'cardpageUri',
+        'ExpressionAttributeValues': {':batch_id': {'S': batch_id}, ':uri_prefix': {'S': URI_ITEM_KEY_PREFIX}},
+    }
+    while True:
+        query_result = dynamodb.query(**query_kwargs)
+        registered_uris.update(item['cardpageUri']['S'] for item in query_result['Items'])
+        if 'LastEvaluatedKey' not in query_result:
+            return registered_uris
+        query_kwargs['ExclusiveStartKey'] = query_result['LastEvaluatedKey']
+
+
+def get_lease_expiry(context) -> float:
+    get_remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+    lease_seconds = get_remaining_time_in_millis() / 1000 if get_remaining_time_in_millis \
+        else INGEST_DEFAULT_LEASE_SECONDS
+    return round(time.time() + lease_seconds, 3)
+
+
+def make_time_left_check(context) -> Callable[[], bool]:
+    get_remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time_in_millis is None:
+        return lambda: True
+    return lambda: get_remaining_time_in_millis() > INGEST_STOP_MARGIN_SECONDS * 1000
+
+
+def claim_batch_ingestion(batch_id:str, lease_expires_at:float) -> dict|None:
+    """
+    Takes the lease on the batch's ingestion, unless the batch is already ingested or
+    another invocation holds an unexpired lease on it. Returns the batch's ingestion
+    progress, or None if the lease couldn't be taken.
+    """
+    try:
+        response = dynamodb.update_item(
+            TableName=BATCH_STATUS_TABLE,
+            Key={'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+            UpdateExpression="SET ingestLeaseExpiresAt = :lease_expires_at",
+            ConditionExpression="ingestStatus IN (" + ", ".join(
+                f":unfinished{j}" for j in range(len(UNFINISHED_INGEST_STATUSES))
+            ) + ") AND (attribute_not_exists(ingestLeaseExpiresAt) OR ingestLeaseExpiresAt < :now)",
+            ExpressionAttributeValues={
+                ':lease_expires_at': {'N': str(lease_expires_at)},
+                ':now': {'N': str(time.time())},
+                **{f":unfinished{j}": {'S': status} for (j, status) in enumerate(UNFINISHED_INGEST_STATUSES)},
+            },
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return read_ingest_progress(response['Attributes'])
+
+
+def read_ingest_progress(summary_item:dict) -> dict:
+    def get_number(attribute:str) -> int:
+        return int(summary_item.get(attribute, {}).get('N', 0))
+    return {
+        'status': summary_item['ingestStatus']['S'],
+        'refresh': summary_item.get('refresh', {}).get('BOOL', False),
+        'etag': summary_item.get('uploadETag', {}).get('S'),
+        'fieldnames': [value['S'] for value in summary_item.get('csvFieldnames', {}).get('L', [])] or None,
+        'processedBytes': get_number('ingestedBytes'),
+        'processedRows': get_number('ingestedRows'),
+        'rowCount': get_number('csvRowCount'),
+        'unqueuedRowCount': get_number('ingestUnqueuedRowCount'),
+        'errors': json.loads(summary_item.get('ingestErrors', {}).get('S', '{}')),
+    }
+
+
+def save_ingest_progress(batch_id:str, progress:dict, lease_expires_at:float, release_lease:bool=False):
+    """
+    Saves the batch's ingestion progress to its summary item (bumping its statusVersion, so
+    that status views see the change), as long as this invocation still holds the lease.
+    """
+    attribute_values = {
+        'ingestStatus': {'S': progress['status']},
+        'ingestedBytes': {'N': str(progress['processedBytes'])},
+        'ingestedRows': {'N': str(progress['processedRows'])},
+        'csvRowCount': {'N': str(progress['rowCount'])},
+        'ingestUnqueuedRowCount': {'N': str(progress['unqueuedRowCount'])},
+        'ingestErrors': {'S': json.dumps(progress['errors'])},
+        'ingestLeaseExpiresAt': {'N': '0' if release_lease else str(lease_expires_at)},
+    }
+    if progress['etag']:
+        attribute_values['uploadETag'] = {'S': progress['etag']}
+    if progress['fieldnames']:
+        attribute_values['csvFieldnames'] = {'L': [{'S': fieldname} for fieldname in progress['fieldnames']]}
+    dynamodb.update_item(
+        TableName=BATCH_STATUS_TABLE,
+        Key={'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+        UpdateExpression="SET " + ", ".join(f"{attribute} = :{attribute}" for attribute in attribute_values)
+            + " ADD statusVersion :one",
+        ConditionExpression="ingestLeaseExpiresAt = :held_lease_expires_at",
+        ExpressionAttributeValues={
+            **{f":{attribute}": value for (attribute, value) in attribute_values.items()},
+            ':one': {'N': '1'},
+            ':held_lease_expires_at': {'N': str(lease_expires_at)},
+        }
+    )
+
+
+def release_ingest_lease(batch_id:str, lease_expires_at:float):
+    """Gives up the lease (if this invocation still holds it), so a retry needn't wait for it to expire."""
+    try:
+        dynamodb.update_item(
+            TableName=BATCH_STATUS_TABLE,
+            Key={'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+            UpdateExpression="SET ingestLeaseExpiresAt = :released",
+            ConditionExpression="ingestLeaseExpiresAt = :held_lease_expires_at",
+            ExpressionAttributeValues={
+                ':released': {'N': '0'},
+                ':held_lease_expires_at': {'N': str(lease_expires_at)},
+            }
+        )
+    except ClientError as e:
+        print(f"Couldn't release the ingestion lease on batch {batch_id} ({str(e)})")
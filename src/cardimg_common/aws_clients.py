@@ -0,0 +1,37 @@
+import threading
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name:str):
+    """
+    Returns the container's low-level boto3 client for service_name, creating it (and
+    importing boto3) on first use. Clients are safe to share across threads, but creating
+    them isn't, so creation is serialized.
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                import boto3
+                client = _clients[service_name] = boto3.client(service_name)
+    return client
+
+
+class LazyClient:
+    """
+    Stands in for a module's boto3 client until the client is first used, so that creating
+    it (loading its service model, tens of milliseconds per client) isn't part of every cold
+    start: invocations that never call the service never pay for it.
+    """
+
+    def __init__(self, service_name:str):
+        self.service_name = service_name
+
+    def __getattr__(self, name:str):
+        return getattr(get_client(self.service_name), name)
+
+    def __repr__(self):
+        return f"LazyClient({self.service_name!r})"
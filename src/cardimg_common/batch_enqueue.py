@@ -0,0 +1,102 @@
+import json, os, random, time
+from cardimg_common.batch_status import register_uris
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+
+# Batch csvs must have this column; the rest of a row is passed on to the scraper as is.
+CARD_PAGE_URI_COLUMN = "Card Page URI"
+
+# SQS accepts at most 10 entries per SendMessageBatch call. Groups are sent from a
+# bounded thread pool, and entries that SQS reports as Failed are retried with
+# exponential backoff (plus jitter) until SQS_SEND_MAX_ATTEMPTS is used up.
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_SEND_MAX_WORKERS = int(os.environ.get('SQS_SEND_MAX_WORKERS', 8))
+SQS_SEND_MAX_ATTEMPTS = int(os.environ.get('SQS_SEND_MAX_ATTEMPTS', 4))
+SQS_SEND_BACKOFF_BASE_SECONDS = .05
+
+# Validated rows are registered in dynamo and queued this many at a time, so a function
+# adding a batch never holds more than one chunk of parsed rows in memory.
+ENQUEUE_CHUNK_ROWS = SQS_BATCH_MAX_ENTRIES * SQS_SEND_MAX_WORKERS * 4
+
+
+def chunked(rows:Iterable[dict[str, str]], chunk_size:int) -> Iterator[list[dict[str, str]]]:
+    rows_iter = iter(rows)
+    while chunk := list(islice(rows_iter, chunk_size)):
+        yield chunk
+
+
+def register_csvrows(dynamodb_client, csv_data:list[dict[str, str]], batch_id:str,
+                     registered_uris:set[str]|frozenset[str]=frozenset()) -> list[str]:
+    """
+    Registers each uri in csv_data that isn't in registered_uris (see register_uris), along
+    with the first row it appears in, and returns them.
+    """
+    csv_rows_by_uri = {}
+    for row in csv_data:
+        uri = row[CARD_PAGE_URI_COLUMN]
+        if uri not in registered_uris:
+            csv_rows_by_uri.setdefault(uri, row)
+    return register_uris(dynamodb_client, batch_id, list(csv_rows_by_uri), csv_rows_by_uri)
+
+
+def send_csvrows_to_sqs(sqs_client, csv_data:list[dict[str, str]], batch_id:str, queue_url:str,
+                        first_row_index:int=0, refresh:bool=False) -> list[int]:
+    """
+    Queues every row of csv_data onto queue_url, using SendMessageBatch groups sent
+    concurrently.
+    Returns the (1-indexed, header-inclusive) CSV line numbers of any rows that
+    could not be queued; an empty list means every row was confirmed enqueued.
+    first_row_index is the position of csv_data[0] within the whole csv. With refresh,
+    the scraper re-checks cards that already have an image rather than skipping them.
+    """
+    extra_body = {"refresh": True} if refresh else {}
+    entries = [
+        {
+            # + 2 because a text file is 1-indexed, and the first row is the column names
+            "Id": str(first_row_index + i + 2),
+            "MessageBody": json.dumps({"batchId": batch_id, "itemFromBatch": row, **extra_body}),
+        }
+        for (i, row) in enumerate(csv_data)
+    ]
+    groups = [
+        entries[i:i + SQS_BATCH_MAX_ENTRIES]
+        for i in range(0, len(entries), SQS_BATCH_MAX_ENTRIES)
+    ]
+    unqueued_rows = []
+    with ThreadPoolExecutor(max_workers=SQS_SEND_MAX_WORKERS) as executor:
+        for failed_ids in executor.map(lambda group: _send_sqs_batch_with_retries(sqs_client, group, queue_url), groups):
+            unqueued_rows.extend(int(entry_id) for entry_id in failed_ids)
+    return sorted(unqueued_rows)
+
+
+def _send_sqs_batch_with_retries(sqs_client, entries:list[dict[str, str]], queue_url:str) -> list[str]:
+    """
+    Sends a single SendMessageBatch group, retrying entries that failed for
+    reasons other than a sender fault. Returns the Ids that never succeeded.
+    """
+    pending = entries
+    permanently_failed_ids = []
+    for attempt in range(SQS_SEND_MAX_ATTEMPTS):
+        if attempt > 0:
+            backoff = SQS_SEND_BACKOFF_BASE_SECONDS * (2 ** (attempt - 1))
+            time.sleep(backoff + random.uniform(0, backoff))
+        try:
+            sqs_response = sqs_client.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=pending
+            )
+        except Exception as e:
+            print(f"SendMessageBatch attempt {attempt + 1} raised {type(e).__name__}: {str(e)}")
+            continue
+        retryable_ids = set()
+        for failure in sqs_response.get('Failed', []):
+            if failure.get('SenderFault'):
+                # The message itself was rejected, so resending it won't help.
+                permanently_failed_ids.append(failure['Id'])
+            else:
+                retryable_ids.add(failure['Id'])
+        pending = [entry for entry in pending if entry['Id'] in retryable_ids]
+        if not pending:
+            break
+    return permanently_failed_ids + [entry['Id'] for entry in pending]
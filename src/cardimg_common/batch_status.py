@@ -0,0 +1,276 @@
+import json, os, random, time
+from collections import Counter
+from datetime import datetime, timedelta, UTC
+from typing import TYPE_CHECKING
+
+# botocore is imported where its errors are caught, by which point the client has loaded it,
+# so that importing this module doesn't put botocore on the cold start of every lambda
+if TYPE_CHECKING:
+    from botocore.exceptions import ClientError
+
+BATCH_STATUS_TABLE = os.environ.get('BATCH_STATUS_TABLE', "CardImgBatchStatus")
+
+# Every item of a batch shares the batch's partition key (batchId), and the sort key
+# (itemKey) tells them apart:
+#   SUMMARY_ITEM_KEY      one item per batch, with a counter per status (pendingCount, ...)
+#                         and a statusVersion that goes up on every change to the batch
+#   "URI#<cardpage uri>"  one item per distinct uri in the batch, with that uri's status
+#                         and the csv row it came from (csvRow, as json)
+# So no item grows with the size of the batch, and scrapers updating different uris of
+# the same batch write to different items. The summary also records when the batch was
+# created and when a status last changed (createdAt, statusUpdatedAt), to estimate when
+# it will be done.
+SUMMARY_ITEM_KEY = "#SUMMARY"
+URI_ITEM_KEY_PREFIX = "URI#"
+# Batches too big for the priority fetch queue are queued a little at a time by the fetch
+# scheduler (cardimg_schedule_fetches), which keeps an item per such batch (see
+# schedule_batch) under this partition key, holding the item key of the batch's last queued uri.
+FETCH_SCHEDULE_BATCH_ID = "#FETCH_SCHEDULE"
+SCHEDULED_BATCH_ITEM_KEY_PREFIX = "BATCH#"
+# The progress events function (cardimg_progress_events) reads the table's stream, and adds
+# an item per batch per stream read with what changed, keyed by the stream's sequence number
+# (zero padded, so that the items sort in stream order). Clients long-poll for these instead
+# of rereading the whole batch. Once every uri is done, the summary records completedAt.
+EVENT_ITEM_KEY_PREFIX = "EVENT#"
+# Sort keys are limited to 1024 bytes, which limits how long a uri can be.
+MAX_CARDPAGE_URI_BYTES = 1024 - len(URI_ITEM_KEY_PREFIX)
+
+PENDING_STATUS = "PENDING"
+RETRYING_STATUS = "RETRYING"
+SUCCESS_STATUS = "SUCCESS"
+FAILURE_STATUS = "FAILURE"
+ALL_STATUSES = (PENDING_STATUS, RETRYING_STATUS, SUCCESS_STATUS, FAILURE_STATUS)
+
+# Batches uploaded straight to S3 (rather than in the add request's body) also track their
+# ingestion in the summary item (ingestStatus): the csv is validated in full, then its uris
+# are registered and queued. REJECTED batches failed validation, and nothing was queued.
+AWAITING_UPLOAD_INGEST_STATUS = "AWAITING_UPLOAD"
+VALIDATING_INGEST_STATUS = "VALIDATING"
+QUEUEING_INGEST_STATUS = "QUEUEING"
+QUEUED_INGEST_STATUS = "QUEUED"
+REJECTED_INGEST_STATUS = "REJECTED"
+UNFINISHED_INGEST_STATUSES = (AWAITING_UPLOAD_INGEST_STATUS, VALIDATING_INGEST_STATUS, QUEUEING_INGEST_STATUS)
+
+BATCH_TIME_TO_LIVE = timedelta(days=30)
+
+# Errors that mean "try again later" rather than "this write is wrong". These are retried
+# with full jitter, so that scrapers contending for the same batch summary spread out.
+RETRYABLE_ERROR_CODES = frozenset([
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TransactionConflictException',
+])
+UPDATE_MAX_ATTEMPTS = 5
+UPDATE_BACKOFF_BASE_SECONDS = .05
+
+# Uri items change together with the summary's counters, in one transaction, so that the
+# counters can't miss a change when a write fails halfway. A transaction holds at most 100
+# actions: the summary's, and one per uri. A cancelled transaction wrote nothing; these
+# reasons (per action) mean it may go through if tried again with fresh reads.
+TRANSACTION_MAX_URIS = 99
+RETRYABLE_CANCELLATION_CODES = frozenset([
+    'None', 'ConditionalCheckFailed', 'TransactionConflict', 'ProvisionedThroughputExceeded',
+    'ThrottlingError',
+])
+BATCH_GET_BACKOFF_BASE_SECONDS = .05
+
+
+def uri_item_key(cardpage_uri:str) -> str:
+    return URI_ITEM_KEY_PREFIX + cardpage_uri
+
+
+def event_item_key(sequence_number:int) -> str:
+    return f"{EVENT_ITEM_KEY_PREFIX}{sequence_number:040d}"
+
+
+def status_count_attribute(status:str) -> str:
+    return status.lower() + "Count"
+
+
+def get_expires_at() -> int:
+    return int((datetime.now(UTC) + BATCH_TIME_TO_LIVE).timestamp())
+
+
+def create_batch_summary(dynamodb_client, batch_id:str, summary_attributes:dict|None=None):
+    """Creates the batch's summary item, with no uris yet, and any extra summary_attributes."""
+    dynamodb_client.put_item(TableName=BATCH_STATUS_TABLE, Item={
+        "batchId": {'S': batch_id},
+        "itemKey": {'S': SUMMARY_ITEM_KEY},
+        "totalCount": {'N': '0'},
+        "statusVersion": {'N': '0'},
+        **{status_count_attribute(status): {'N': '0'} for status in ALL_STATUSES},
+        "createdAt": {'N': str(round(time.time(), 3))},
+        "expiresAt": {'N': str(get_expires_at())},
+        **(summary_attributes or {}),
+    })
+
+
+def schedule_batch(dynamodb_client, batch_id:str, refresh:bool=False):
+    """Hands a batch whose uris are all registered to the fetch scheduler, to be queued from the start."""
+    dynamodb_client.put_item(TableName=BATCH_STATUS_TABLE, Item={
+        "batchId": {'S': FETCH_SCHEDULE_BATCH_ID},
+        "itemKey": {'S': SCHEDULED_BATCH_ITEM_KEY_PREFIX + batch_id},
+        "scheduledBatchId": {'S': batch_id},
+        "refresh": {'BOOL': refresh},
+        "lastQueuedAt": {'N': '0'},
+        "expiresAt": {'N': str(get_expires_at())},
+    })
+
+
+def record_status_changes(dynamodb_client, batch_id:str, statuses_by_uri:dict[str, str]) -> int:
+    """
+    Sets the status of each uri's item and applies the net change to the batch's status
+    counters, in one transaction (per TRANSACTION_MAX_URIS uris), so the counters always
+    agree with the uri items. The current statuses are read first, and a uri is only
+    written if its status changes, so a redelivered message isn't counted twice. Each
+    write is conditioned on the status that was read; if another scraper changed it in
+    between, the statuses are read again. Uris that aren't part of the batch are skipped.
+    Returns the number of write calls.
+    """
+    from botocore.exceptions import ClientError
+    write_count = 0
+    cardpage_uris = list(statuses_by_uri)
+    for i in range(0, len(cardpage_uris), TRANSACTION_MAX_URIS):
+        chunk = {uri: statuses_by_uri[uri] for uri in cardpage_uris[i:i + TRANSACTION_MAX_URIS]}
+        for attempt in range(UPDATE_MAX_ATTEMPTS):
+            current_statuses = get_current_statuses(dynamodb_client, batch_id, list(chunk))
+            changes = {
+                uri: (current_statuses[uri], status) for (uri, status) in chunk.items()
+                if uri in current_statuses and current_statuses[uri] != status
+            }
+            if not changes:
+                break
+            write_count += 1
+            try:
+                dynamodb_client.transact_write_items(TransactItems=make_status_change_actions(batch_id, changes))
+                break
+            except ClientError as e:
+                if not is_retryable_transaction_error(e) or attempt == UPDATE_MAX_ATTEMPTS - 1:
+                    raise
+            time.sleep(random.uniform(0, UPDATE_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    return write_count
+
+
+def get_current_statuses(dynamodb_client, batch_id:str, cardpage_uris:list[str]) -> dict[str, str]:
+    """Reads the status of each of cardpage_uris (at most 100) that is part of the batch."""
+    request_items = {BATCH_STATUS_TABLE: {
+        'Keys': [{'batchId': {'S': batch_id}, 'itemKey': {'S': uri_item_key(uri)}} for uri in cardpage_uris],
+        'ProjectionExpression': 'itemKey, #status',
+        'ExpressionAttributeNames': {'#status': 'status'},
+        # The statuses are about to be written back; a stale one would only cancel the write
+        'ConsistentRead': True,
+    }}
+    current_statuses = {}
+    attempt = 0
+    while request_items:
+        response = dynamodb_client.batch_get_item(RequestItems=request_items)
+        for item in response['Responses'].get(BATCH_STATUS_TABLE, []):
+            current_statuses[item['itemKey']['S'].removeprefix(URI_ITEM_KEY_PREFIX)] = item['status']['S']
+        request_items = response.get('UnprocessedKeys')
+        if request_items:
+            time.sleep(BATCH_GET_BACKOFF_BASE_SECONDS * (2 ** min(attempt, 5)))
+            attempt += 1
+    return current_statuses
+
+
+def make_status_change_actions(batch_id:str, changes:dict[str, tuple[str, str]]) -> list[dict]:
+    """The transaction's actions to change each uri from its old status to its new one."""
+    counter_deltas = Counter()
+    actions = []
+    for (cardpage_uri, (old_status, new_status)) in changes.items():
+        counter_deltas[old_status] -= 1
+        counter_deltas[new_status] += 1
+        actions.append({'Update': {
+            'TableName': BATCH_STATUS_TABLE,
+            'Key': {'batchId': {'S': batch_id}, 'itemKey': {'S': uri_item_key(cardpage_uri)}},
+            'UpdateExpression': 'SET #status = :new_status',
+            'ConditionExpression': '#status = :old_status',
+            'ExpressionAttributeNames': {'#status': 'status'},
+            'ExpressionAttributeValues': {':new_status': {'S': new_status}, ':old_status': {'S': old_status}},
+        }})
+    changed_counters = [(status, delta) for (status, delta) in counter_deltas.items() if delta]
+    actions.append({'Update': {
+        'TableName': BATCH_STATUS_TABLE,
+        'Key': {'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+        'UpdateExpression': "SET statusUpdatedAt = :now ADD statusVersion :one" + "".join(
+            f", #count{j} :delta{j}" for j in range(len(changed_counters))
+        ),
+        **({'ExpressionAttributeNames': {
+            f"#count{j}": status_count_attribute(status)
+            for (j, (status, _)) in enumerate(changed_counters)
+        }} if changed_counters else {}),
+        'ExpressionAttributeValues': {
+            ':now': {'N': str(round(time.time(), 3))},
+            ':one': {'N': '1'},
+            **{
+                f":delta{j}": {'N': str(delta)}
+                for (j, (_, delta)) in enumerate(changed_counters)
+            }
+        },
+    }})
+    return actions
+
+
+def register_uris(dynamodb_client, batch_id:str, cardpage_uris:list[str],
+                  csv_rows_by_uri:dict[str, dict[str, str]]|None=None) -> list[str]:
+    """
+    Adds a PENDING item for each of cardpage_uris (with its row from csv_rows_by_uri, if
+    given, for the fetch scheduler to queue) and counts them in the batch's summary,
+    in one transaction per TRANSACTION_MAX_URIS uris, so that an interrupted registration
+    never leaves a uri item that isn't counted. Uris the batch already has (e.g. from
+    before an ingestion was resumed) were counted then, so they're left out. Returns the
+    uris that are now registered.
+    """
+    from botocore.exceptions import ClientError
+    expires_at = str(get_expires_at())
+    for i in range(0, len(cardpage_uris), TRANSACTION_MAX_URIS):
+        new_uris = cardpage_uris[i:i + TRANSACTION_MAX_URIS]
+        for attempt in range(UPDATE_MAX_ATTEMPTS):
+            if not new_uris:
+                break
+            actions = [
+                {'Put': {
+                    'TableName': BATCH_STATUS_TABLE,
+                    'Item': {
+                        "batchId": {'S': batch_id},
+                        "itemKey": {'S': uri_item_key(uri)},
+                        "cardpageUri": {'S': uri},
+                        "status": {'S': PENDING_STATUS},
+                        "expiresAt": {'N': expires_at},
+                        **({"csvRow": {'S': json.dumps(csv_rows_by_uri[uri])}} if csv_rows_by_uri else {}),
+                    },
+                    'ConditionExpression': 'attribute_not_exists(itemKey)',
+                }}
+                for uri in new_uris
+            ] + [{'Update': {
+                'TableName': BATCH_STATUS_TABLE,
+                'Key': {'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+                'UpdateExpression': "ADD statusVersion :one, totalCount :new_uri_count, #pending_count :new_uri_count",
+                'ExpressionAttributeNames': {'#pending_count': status_count_attribute(PENDING_STATUS)},
+                'ExpressionAttributeValues': {':one': {'N': '1'}, ':new_uri_count': {'N': str(len(new_uris))}},
+            }}]
+            try:
+                dynamodb_client.transact_write_items(TransactItems=actions)
+                break
+            except ClientError as e:
+                if not is_retryable_transaction_error(e) or attempt == UPDATE_MAX_ATTEMPTS - 1:
+                    raise
+                # The uris whose items already exist; the rest are tried again on their own
+                reasons = e.response.get('CancellationReasons') or []
+                new_uris = [
+                    uri for (uri, reason) in zip(new_uris, reasons + [{}] * len(new_uris))
+                    if reason.get('Code') != 'ConditionalCheckFailed'
+                ]
+            time.sleep(random.uniform(0, UPDATE_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    return cardpage_uris
+
+
+def is_retryable_transaction_error(e:'ClientError') -> bool:
+    code = e.response['Error']['Code']
+    if code != 'TransactionCanceledException':
+        return code in RETRYABLE_ERROR_CODES
+    return all(
+        reason.get('Code', 'None') in RETRYABLE_CANCELLATION_CODES
+        for reason in e.response.get('CancellationReasons') or []
+    )
@@ -0,0 +1,63 @@
+import json, os
+from cardimg_common.batch_enqueue import CARD_PAGE_URI_COLUMN
+from cardimg_common.batch_status import MAX_CARDPAGE_URI_BYTES
+from cardimg_common.cardpage_uri import ApprovedDomainIndex, canonicalize_cardpage_uri
+from functools import lru_cache
+from typing import Iterable
+
+# We only care about the keys of the APPROVED_DOMAINS_TO_CARDIMG_SELECTORS
+# variable; the values are only relevant to the 'single scrape' lambda.
+APPROVED_DOMAINS = ApprovedDomainIndex(
+    json.loads(os.environ['APPROVED_DOMAINS_TO_CARDIMG_SELECTORS']).keys()
+)
+
+# Batches tend to repeat the same uris, so validation results are memoized per
+# container. Entries are small (a uri and a tuple of error strings).
+URI_VALIDATION_CACHE_SIZE = 8192
+
+
+def get_header_error(fieldnames:list[str]|None) -> str|None:
+    if fieldnames is None:
+        return "CSV is empty"
+    if CARD_PAGE_URI_COLUMN not in fieldnames:
+        return "CSV headers missing or malformed"
+    return None
+
+
+def validate_csvrows(csvdata:Iterable[dict[str,str]], first_row_index:int=0) -> dict[int,list[str]]:
+    errors_by_row = {}
+    for (i, row) in  enumerate(csvdata, start=first_row_index):
+        row_errors = []
+        row_errors.extend(_validate_cardpage_uri(row))
+        #additional validations would go here
+        if row_errors:
+            # i + 2 because a text file is 1-indexed, not 0-indexed, and also the
+            # first row is the column names
+            errors_by_row[i+2] = row_errors
+    return errors_by_row
+
+def _validate_cardpage_uri(csv_row:dict[str, str]) -> list[str]:
+    try:
+        cardpage_uri_text = csv_row[CARD_PAGE_URI_COLUMN]
+    except KeyError as ke:
+        return ["malformed row"]
+    return list(_validate_cardpage_uri_text(cardpage_uri_text))
+
+@lru_cache(maxsize=URI_VALIDATION_CACHE_SIZE)
+def _validate_cardpage_uri_text(cardpage_uri_text:str|None) -> tuple[str, ...]:
+    if not cardpage_uri_text:
+        return ("uri missing",)
+    elif len(cardpage_uri_text.encode()) > MAX_CARDPAGE_URI_BYTES:
+        return (f"uri longer than {MAX_CARDPAGE_URI_BYTES} bytes",)
+    # urllib will allow a lot of arbitrary input, so this next check is to avoid js or html injections.
+    # validators is imported on first use, so requests rejected before any row is read never load it.
+    # It isn't in the layer: each function that validates batches has it in its requirements.txt.
+    from validators.url import url as validators_url
+    if not validators_url(cardpage_uri_text):
+        return ("uri not valid (make sure it starts with 'https://' and points to a real webpage)",)
+    cardpage_uri = canonicalize_cardpage_uri(cardpage_uri_text)
+    if cardpage_uri.scheme != "https":
+        return ("uri must begin with 'https://'",)
+    elif cardpage_uri.netloc not in APPROVED_DOMAINS:
+        return ("uri not in approved domains",)
+    return ()
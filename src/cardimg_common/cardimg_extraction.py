@@ -0,0 +1,108 @@
+from abc import ABC, abstractmethod
+from html.parser import HTMLParser
+from typing import Callable, Iterable
+
+# Ways of finding the card image on a card page, chosen per approved domain by the
+# "extractor" key of its entry in APPROVED_DOMAINS_TO_CARDIMG_SELECTORS:
+#   "img"      (default) the src of the first <img> with the domain's "selector" class
+#   "srcset"   like "img", but the largest candidate in the <img>'s srcset, if it has one
+#   "og:image" the content of the page's <meta property="og:image">
+IMG_EXTRACTOR = "img"
+SRCSET_EXTRACTOR = "srcset"
+OG_IMAGE_EXTRACTOR = "og:image"
+
+
+class CardImgExtractor(HTMLParser, ABC):
+    """
+    Finds the card image's uri in a card page, fed to it a chunk at a time. Parsing stops
+    at the first chunk that contains a match, so the rest of the page is never parsed, and
+    no tree of the page is ever built.
+
+    Each extractor is good for one page; make a new one for the next.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.cardimg_uri = None
+
+    def extract(self, html_chunks:Iterable[str]) -> str|None:
+        for html_chunk in html_chunks:
+            self.feed(html_chunk)
+            if self.cardimg_uri is not None:
+                break
+        return self.cardimg_uri
+
+    def handle_starttag(self, tag:str, attrs:list[tuple[str, str|None]]):
+        if self.cardimg_uri is None:
+            self.cardimg_uri = self.match_tag(tag, dict(attrs))
+
+    def handle_startendtag(self, tag:str, attrs:list[tuple[str, str|None]]):
+        self.handle_starttag(tag, attrs)
+
+    @abstractmethod
+    def match_tag(self, tag:str, attrs:dict[str, str|None]) -> str|None:
+        """Returns the card image's uri if this tag gives it, or None to keep looking."""
+
+
+class ImgClassExtractor(CardImgExtractor):
+    """Matches the first <img> with css_class among its classes."""
+
+    def __init__(self, css_class:str, use_srcset:bool=False):
+        super().__init__()
+        self.css_class = css_class
+        self.use_srcset = use_srcset
+
+    def match_tag(self, tag, attrs):
+        if tag != 'img' or self.css_class not in (attrs.get('class') or '').split():
+            return None
+        if self.use_srcset and attrs.get('srcset'):
+            return largest_srcset_candidate(attrs['srcset']) or attrs.get('src')
+        return attrs.get('src')
+
+
+class MetaPropertyExtractor(CardImgExtractor):
+    """Matches the first <meta> whose property (or name) is meta_property."""
+
+    def __init__(self, meta_property:str):
+        super().__init__()
+        self.meta_property = meta_property
+
+    def match_tag(self, tag, attrs):
+        if tag != 'meta' or self.meta_property not in (attrs.get('property'), attrs.get('name')):
+            return None
+        return attrs.get('content') or None
+
+
+def largest_srcset_candidate(srcset:str) -> str|None:
+    """Returns the uri of the widest (or highest density) candidate in a srcset attribute."""
+    best_uri, best_size = None, -1.
+    for candidate in srcset.split(','):
+        candidate_parts = candidate.split()
+        if not candidate_parts:
+            continue
+        descriptor = candidate_parts[1] if len(candidate_parts) > 1 else '1x'
+        try:
+            size = float(descriptor[:-1])
+        except ValueError:
+            continue
+        if size > best_size:
+            best_uri, best_size = candidate_parts[0], size
+    return best_uri
+
+
+def get_extractor_factory(domain_config:str|dict) -> Callable[[], CardImgExtractor]:
+    """
+    Reads an approved domain's entry in APPROVED_DOMAINS_TO_CARDIMG_SELECTORS (either just its
+    css class, or an object with "selector" and/or "extractor") and returns a function that
+    makes a fresh extractor for each of that domain's pages.
+    """
+    if isinstance(domain_config, str):
+        return lambda: ImgClassExtractor(domain_config)
+    extractor = domain_config.get('extractor', IMG_EXTRACTOR)
+    if extractor == OG_IMAGE_EXTRACTOR:
+        return lambda: MetaPropertyExtractor(OG_IMAGE_EXTRACTOR)
+    if extractor not in (IMG_EXTRACTOR, SRCSET_EXTRACTOR):
+        raise ValueError(f"Unknown card image extractor: {extractor}")
+    css_class = domain_config['selector']
+    use_srcset = extractor == SRCSET_EXTRACTOR
+    return lambda: ImgClassExtractor(css_class, use_srcset)
@@ -0,0 +1,47 @@
+from urllib.parse import urlparse, ParseResult
+from typing import Iterable
+
+
+def canonicalize_cardpage_uri(cardpage_uri_text:str) -> ParseResult:
+    """
+    The one canonical form of a card page uri, shared by every lambda so that the
+    batch validator and the scraper agree on what a uri points to. The scheme and
+    host are lowercased, a leading 'www.' is dropped, and the query string, fragment
+    and trailing '/' are stripped. The path's case is kept, since some sites care.
+    """
+    parsed_uri = urlparse(cardpage_uri_text.strip())
+    return ParseResult(
+        scheme=parsed_uri.scheme.lower(),
+        netloc=normalize_host(parsed_uri.netloc),
+        path=parsed_uri.path.rstrip('/'),
+        params='',
+        query='',
+        fragment=''
+    )
+
+
+def normalize_host(host:str) -> str:
+    return host.lower().removeprefix('www.')
+
+
+class ApprovedDomainIndex:
+    """
+    Set-based index of approved domains. A host matches an approved domain if it is
+    that domain or one of its subdomains, so each lookup costs one set membership
+    test per label in the host instead of a scan over every approved domain.
+    """
+
+    def __init__(self, approved_domains:Iterable[str]):
+        self._approved_domains = frozenset(normalize_host(domain) for domain in approved_domains)
+
+    def match(self, host:str) -> str | None:
+        """Returns the approved domain that host falls under, or None."""
+        candidate = normalize_host(host)
+        while candidate:
+            if candidate in self._approved_domains:
+                return candidate
+            candidate = candidate.partition('.')[2]
+        return None
+
+    def __contains__(self, host:str) -> bool:
+        return self.match(host) is not None
@@ -0,0 +1,130 @@
+import functools, io, os, threading
+
+# Formats a derivative can be saved as, with the options each is saved with
+DERIVATIVE_SAVE_OPTIONS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "avif": {"format": "AVIF", "quality": 60, "speed": 8},
+    "jpeg": {"format": "JPEG", "quality": 85, "optimize": True, "progressive": True},
+    "png": {"format": "PNG", "optimize": True},
+}
+DERIVATIVE_EXTENSIONS = {"jpeg": "jpg"}
+# Decoded pixels are by far the most memory the scraper ever holds (PNGs and TIFFs have no
+# reduced-scale draft to decode instead), so each container decodes one image at a time,
+# however many records it scrapes at once, and only images whose pixels fit the budget:
+# up to 4 bytes per pixel, held twice while exif_transpose or convert makes its copy. A
+# JPEG's pixels are counted after its draft.
+DERIVATIVE_MEMORY_BUDGET_BYTES = int(os.environ.get('DERIVATIVE_MEMORY_BUDGET_BYTES', 64 * 1024 * 1024))
+MAX_SOURCE_PIXELS = DERIVATIVE_MEMORY_BUDGET_BYTES // (2 * 4)
+_decode_lock = threading.Lock()
+# EXIF orientations that turn the image a quarter turn, swapping its width and height
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class DerivativeSpec:
+    """
+    One smaller copy of each card image: scaled down (never up) to width, keeping its aspect
+    ratio, and saved as image_format. A derivative is stored next to its original, e.g.
+    sha256/<hash>.jpg gets sha256/<hash>-146w.webp.
+    """
+
+    def __init__(self, width:int, image_format:str):
+        if not isinstance(width, int) or width <= 0:
+            raise ValueError(f"Derivative width must be a positive integer, not {width!r}")
+        if image_format not in DERIVATIVE_SAVE_OPTIONS:
+            raise ValueError(f"Unknown derivative format: {image_format}")
+        self.width = width
+        self.image_format = image_format
+
+    @property
+    def name(self) -> str:
+        return f"{self.width}w.{DERIVATIVE_EXTENSIONS.get(self.image_format, self.image_format)}"
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.image_format}"
+
+    def get_key(self, content_key:str) -> str:
+        """The derivative's s3 key, given its original's."""
+        return f"{content_key.rsplit('.', 1)[0]}-{self.name}"
+
+
+def parse_derivative_specs(derivatives_config:list[dict]) -> list[DerivativeSpec]:
+    """Reads CARDIMG_DERIVATIVES (a list of {"width": ..., "format": ...} objects)."""
+    return [
+        DerivativeSpec(derivative_config['width'], derivative_config.get('format', 'webp').lower())
+        for derivative_config in derivatives_config
+    ]
+
+
+def can_make_derivative(spec:DerivativeSpec) -> bool:
+    """
+    Whether Pillow is installed and can write the spec's format. Pillow is optional: without
+    it, the scraper stores originals only.
+    """
+    return _can_write_format(DERIVATIVE_SAVE_OPTIONS[spec.image_format]['format'])
+
+
+@functools.cache
+def _can_write_format(pillow_format:str) -> bool:
+    pillow = _import_pillow()
+    if pillow is None:
+        return False
+    if pillow_format not in pillow.Image.SAVE:
+        print(f"This build of Pillow can't write {pillow_format}; skipping those derivatives.")
+        return False
+    return True
+
+
+@functools.cache
+def _import_pillow():
+    """
+    Imports Pillow, and loads every one of its format plugins, on first use rather than on
+    import: it's only needed once an image is stored, which a warm container's invocations
+    (whose cards mostly have images already) often never do.
+    """
+    try:
+        import PIL.ExifTags, PIL.Image, PIL.ImageOps
+    except ImportError:
+        print("Pillow isn't installed; card image derivatives won't be made.")
+        return None
+    # Loads every plugin, so that Image.SAVE lists all the formats this build can write
+    PIL.Image.init()
+    return PIL
+
+
+def make_derivative(img_file, spec:DerivativeSpec) -> tuple[bytes, int, int]:
+    """
+    Returns the derivative of the image in img_file (a seekable binary file) as its
+    (encoded bytes, width, height). JPEGs are decoded at a reduced scale where that's
+    still at least as large as the derivative, which is much faster than a full decode.
+    Waits for any other thread's derivative to be done first (see MAX_SOURCE_PIXELS).
+    """
+    pillow = _import_pillow()
+    img_file.seek(0)
+    with _decode_lock, pillow.Image.open(img_file) as image:
+        # The derivative's height comes from the full-size dimensions (as EXIF turns them),
+        # which are more exact than the draft's
+        (original_width, original_height) = image.size
+        if image.getexif().get(pillow.ExifTags.Base.Orientation) in ROTATED_ORIENTATIONS:
+            (original_width, original_height) = (original_height, original_width)
+        # A square box, so that the draft is large enough whichever way EXIF turns the image
+        image.draft('RGB', (spec.width, spec.width))
+        if image.width * image.height > MAX_SOURCE_PIXELS:
+            raise ValueError(f"Image is too large to make derivatives of ({image.width}x{image.height})")
+        image = pillow.ImageOps.exif_transpose(image)
+        if original_width > spec.width:
+            image = image.resize(
+                (spec.width, max(round(original_height * spec.width / original_width), 1)),
+                pillow.Image.Resampling.LANCZOS
+            )
+        image = _convert_for_format(image, spec.image_format)
+        derivative_file = io.BytesIO()
+        image.save(derivative_file, **DERIVATIVE_SAVE_OPTIONS[spec.image_format])
+        return derivative_file.getvalue(), image.width, image.height
+
+
+def _convert_for_format(image, image_format:str):
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if image_format == 'jpeg' or not has_alpha:
+        return image.convert('RGB') if image.mode != 'RGB' else image
+    return image.convert('RGBA') if image.mode != 'RGBA' else image
@@ -0,0 +1,101 @@
+import json, requests, threading, time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connect timeout just over a multiple of 3s (the TCP retransmission window), and a read
+# timeout short enough that a hung site fails a card rather than the whole invocation.
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 3.05
+DEFAULT_READ_TIMEOUT_SECONDS = 5
+# Connection errors and 5xx responses are retried with backoff. 429s and 503s are left to
+# the caller, which pauses the whole domain's rate limiter rather than just this request.
+DEFAULT_MAX_RETRIES = 2
+RETRY_BACKOFF_FACTOR = .25
+RETRY_STATUS_CODES = (500, 502, 504)
+# Card pages and their images are often served from different hosts (e.g. a CDN)
+POOLED_HOSTS_PER_SESSION = 4
+
+
+class ScraperSession(requests.Session):
+    """
+    A requests.Session for one domain, meant to live for the life of the container so that
+    warm invocations reuse its open (keep-alive) connections instead of reconnecting and
+    redoing the TLS handshake for every page and image.
+
+    Every request gets the session's timeouts unless it passes its own, and the session
+    counts requests, new connections and time spent so that get_stats() can report how
+    often connections were reused.
+    """
+
+    def __init__(self, pool_maxsize:int,
+                 connect_timeout:float=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout:float=DEFAULT_READ_TIMEOUT_SECONDS,
+                 max_retries:int=DEFAULT_MAX_RETRIES):
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+            respect_retry_after_header=False,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=POOLED_HOSTS_PER_SESSION, pool_maxsize=pool_maxsize, max_retries=retry
+        )
+        self.mount('https://', self._adapter)
+        self.mount('http://', self._adapter)
+        self._stats_lock = threading.Lock()
+        self._request_count = 0
+        self._request_seconds = 0.
+        self._connection_count_at_reset = 0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        try:
+            return super().request(method, url, **kwargs)
+        finally:
+            with self._stats_lock:
+                self._request_count += 1
+                self._request_seconds += time.perf_counter() - start
+
+    def get_stats(self, reset:bool=False) -> dict:
+        """
+        Returns the requests made, connections opened and seconds spent since the last reset.
+        Retries count as one request but may open more than one connection.
+        """
+        connection_count = self._count_connections()
+        with self._stats_lock:
+            request_count = self._request_count
+            new_connection_count = max(connection_count - self._connection_count_at_reset, 0)
+            stats = {
+                'requests': request_count,
+                'newConnections': new_connection_count,
+                'connectionReuseRate':
+                    round(max(1 - new_connection_count / request_count, 0), 3) if request_count else None,
+                'meanRequestMs':
+                    round(1000 * self._request_seconds / request_count, 1) if request_count else None,
+            }
+            if reset:
+                self._request_count = 0
+                self._request_seconds = 0.
+                self._connection_count_at_reset = connection_count
+        return stats
+
+    def _count_connections(self) -> int:
+        # Each host's urllib3 pool counts the connections it has opened. Pools that were
+        # evicted to make room for other hosts take their counts with them, so this may
+        # undercount when a session talks to more than POOLED_HOSTS_PER_SESSION hosts.
+        pools = self._adapter.poolmanager.pools
+        return sum(
+            getattr(pools.get(key), 'num_connections', 0) for key in list(pools.keys())
+        )
+
+
+def log_session_stats(sessions_by_domain:dict[str, ScraperSession]):
+    """Prints (then resets) each session's stats, as one json line per domain that was used."""
+    for (domain, session) in sessions_by_domain.items():
+        stats = session.get_stats(reset=True)
+        if stats['requests']:
+            print(json.dumps({'httpSessionStats': domain, **stats}))
@@ -0,0 +1,163 @@
+import functools, json, os, random, threading, time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+# Each invocation prints one CloudWatch Embedded Metric Format (EMF) line: structured json
+# that CloudWatch Logs turns into metrics, and that is just as readable in a local run.
+METRICS_NAMESPACE = "CardImg"
+# The fraction of invocations whose whole event is logged. Events can be large (a batch of
+# SQS messages, or a whole csv), so the rest log only their size.
+EVENT_LOG_SAMPLE_RATE = float(os.environ.get('EVENT_LOG_SAMPLE_RATE', 0))
+
+_cold_start = True
+_current_metrics = None
+_active_spans = threading.local()
+
+
+class InvocationMetrics:
+    """
+    Timings and values for one invocation of one lambda. Time is kept per stage (e.g.
+    "pageFetch" or "s3Put"), summed over every span of that stage on every thread, so a
+    stage's time can add up to more than the invocation's duration when records are
+    handled concurrently.
+
+    A span's time doesn't include the spans (or timed iterators) nested in it, so that
+    e.g. parsing a streamed page and fetching it are counted separately.
+    """
+
+    def __init__(self, service:str, cold_start:bool, request_id:str|None=None,
+                 clock:Callable[[], float]=time.perf_counter):
+        self.service = service
+        self.cold_start = cold_start
+        self.request_id = request_id
+        self._clock = clock
+        self._started_at = clock()
+        self._lock = threading.Lock()
+        self._stage_seconds = {}
+        self._stage_counts = {}
+        self._values = {}
+
+    def add_time(self, stage:str, seconds:float, count:int=1):
+        with self._lock:
+            self._stage_seconds[stage] = self._stage_seconds.get(stage, 0.) + seconds
+            self._stage_counts[stage] = self._stage_counts.get(stage, 0) + count
+
+    def add_value(self, name:str, value:float, unit:str="Count"):
+        """Adds to a metric other than a timing, e.g. a payload's size in "Bytes"."""
+        with self._lock:
+            (previous_value, _) = self._values.get(name, (0, unit))
+            self._values[name] = (previous_value + value, unit)
+
+    def to_emf(self) -> dict:
+        with self._lock:
+            metrics = {
+                'durationMs': (round(1000 * (self._clock() - self._started_at), 1), "Milliseconds"),
+                'coldStart': (int(self.cold_start), "Count"),
+                **{f"{stage}Ms": (round(1000 * seconds, 1), "Milliseconds")
+                   for (stage, seconds) in self._stage_seconds.items()},
+                **{f"{stage}Count": (count, "Count") for (stage, count) in self._stage_counts.items()},
+                **self._values,
+            }
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for (name, (_, unit)) in metrics.items()],
+                }],
+            },
+            'Service': self.service,
+            'requestId': self.request_id,
+            **{name: value for (name, (value, _)) in metrics.items()},
+        }
+
+
+def start_invocation(service:str, context=None) -> InvocationMetrics:
+    """Starts collecting metrics for a new invocation. Only a container's first is a cold start."""
+    global _cold_start, _current_metrics
+    _current_metrics = InvocationMetrics(
+        service, _cold_start, getattr(context, 'aws_request_id', None), clock=time.perf_counter
+    )
+    _cold_start = False
+    return _current_metrics
+
+
+def emit_metrics():
+    """Prints the current invocation's metrics as an EMF line, and stops collecting them."""
+    global _current_metrics
+    if _current_metrics is not None:
+        print(json.dumps(_current_metrics.to_emf()))
+        _current_metrics = None
+
+
+@contextmanager
+def span(stage:str, count:bool=True):
+    """Times the block as (one more occurrence of) stage, in the current invocation's metrics."""
+    parent_spans = getattr(_active_spans, 'stack', None)
+    if parent_spans is None:
+        parent_spans = _active_spans.stack = []
+    # Each entry is [time spent in nested spans], so that the parent can leave it out
+    nested_seconds = [0.]
+    parent_spans.append(nested_seconds)
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        parent_spans.pop()
+        if parent_spans:
+            parent_spans[-1][0] += elapsed
+        metrics = _current_metrics
+        if metrics is not None:
+            metrics.add_time(stage, elapsed - nested_seconds[0], 1 if count else 0)
+
+
+def timed_iter(iterable:Iterable, stage:str) -> Iterator:
+    """
+    Yields from iterable, timing only the waits for each item as stage (e.g. the reads of a
+    streamed response), and not whatever the caller does with the items.
+    """
+    iterator = iter(iterable)
+    while True:
+        with span(stage, count=False):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def record_value(name:str, value:float, unit:str="Count"):
+    """Adds value to the current invocation's metric called name (see InvocationMetrics.add_value)."""
+    metrics = _current_metrics
+    if metrics is not None:
+        metrics.add_value(name, value, unit)
+
+
+def log_event_sample(event, sample_rate:float|None=None, sample:Callable[[], float]=random.random) -> bool:
+    """Logs the whole event for a sample of invocations (see EVENT_LOG_SAMPLE_RATE)."""
+    if sample() >= (EVENT_LOG_SAMPLE_RATE if sample_rate is None else sample_rate):
+        return False
+    print(json.dumps({'sampledEvent': event}))
+    return True
+
+
+def instrumented_handler(service:str, get_payload_bytes:Callable[[dict], int]|None=None):
+    """
+    Wraps a lambda_handler so that each invocation collects metrics (see span and
+    record_value), logs a sample of events, and prints its metrics as it returns.
+    """
+    def decorate(lambda_handler):
+        @functools.wraps(lambda_handler)
+        def instrumented_lambda_handler(event, context):
+            start_invocation(service, context)
+            if get_payload_bytes is not None:
+                record_value('payloadBytes', get_payload_bytes(event), "Bytes")
+            log_event_sample(event)
+            try:
+                return lambda_handler(event, context)
+            finally:
+                emit_metrics()
+        return instrumented_lambda_handler
+    return decorate
@@ -0,0 +1,156 @@
+import threading, time
+from collections import OrderedDict
+from typing import Callable
+
+# BatchGetItem takes at most 100 keys per call
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_ATTEMPTS = 5
+CACHE_MAX_ENTRIES = 10000
+CACHE_TIME_TO_LIVE_SECONDS = 15 * 60
+
+
+class KnownImagesIndex:
+    """
+    Answers "do we already have an image for this card?" without listing the bucket.
+
+    Each card page has its own prefix in the bucket (see the scraper's
+    get_s3_prefix_for_cardimg), which holds its image or a pointer to it. The index is a
+    dynamo table keyed by that prefix, with an item for every prefix that has an image.
+    Prefixes found in the index are cached in memory (LRU, with a time to live), so a warm
+    container doesn't ask about the same card twice. Prefixes that aren't known aren't
+    cached, since another container may upload their image at any time.
+
+    Without a table, or if the table can't be read, lookups fall back to listing the
+    bucket, one prefix at a time.
+    """
+
+    def __init__(self, dynamodb_client, table_name:str|None, s3_client, bucket:str,
+                 max_entries:int=CACHE_MAX_ENTRIES,
+                 time_to_live_seconds:float=CACHE_TIME_TO_LIVE_SECONDS,
+                 clock:Callable[[], float]=time.monotonic):
+        self._dynamodb = dynamodb_client
+        self._table_name = table_name
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._max_entries = max_entries
+        self._time_to_live_seconds = time_to_live_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cached_until = OrderedDict()
+
+    def find_known(self, s3_prefixes) -> set[str]:
+        """Returns the subset of s3_prefixes that already hold an image."""
+        s3_prefixes = set(s3_prefixes)
+        known = {s3_prefix for s3_prefix in s3_prefixes if self._is_cached(s3_prefix)}
+        uncached = sorted(s3_prefixes - known)
+        if not uncached:
+            return known
+        if self._table_name:
+            # Imported here rather than at module level, which would load botocore on every cold start
+            from botocore.exceptions import ClientError
+            try:
+                found = self._batch_get(uncached)
+            except ClientError as e:
+                print(f"Couldn't read known images index ({str(e)}); listing the bucket instead.")
+                found = self._list_in_s3(uncached)
+        else:
+            found = self._list_in_s3(uncached)
+        for s3_prefix in found:
+            self._cache(s3_prefix)
+        return known | found
+
+    def remember(self, s3_prefix:str, s3_key:str, **attributes:str):
+        """Records that s3_key (under s3_prefix) now holds the card's image."""
+        if self._table_name:
+            self._dynamodb.put_item(
+                TableName=self._table_name,
+                Item=_make_index_item(s3_prefix, s3_key, attributes),
+            )
+        self._cache(s3_prefix)
+
+    def rebuild_from_s3(self) -> int:
+        """
+        Adds an index item for every card image (or pointer to one) in the bucket, e.g. for
+        images uploaded before the index existed. Returns the number of images indexed.
+        """
+        if not self._table_name:
+            raise ValueError("Rebuilding the known images index needs an index table")
+        indexed_count = 0
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket):
+            index_items = [
+                _make_index_item(s3_key.rsplit('/', 1)[0] + '/', s3_key, {})
+                for s3_key in (s3_object['Key'] for s3_object in page.get('Contents', []))
+                if '/' in s3_key and s3_key.rsplit('/', 1)[1].startswith('img.')
+            ]
+            # BatchWriteItem takes at most 25 items per call
+            for i in range(0, len(index_items), 25):
+                self._batch_write(index_items[i:i + 25])
+            indexed_count += len(index_items)
+        return indexed_count
+
+    def _is_cached(self, s3_prefix:str) -> bool:
+        with self._lock:
+            cached_until = self._cached_until.get(s3_prefix)
+            if cached_until is None:
+                return False
+            if cached_until <= self._clock():
+                del self._cached_until[s3_prefix]
+                return False
+            self._cached_until.move_to_end(s3_prefix)
+            return True
+
+    def _cache(self, s3_prefix:str):
+        with self._lock:
+            self._cached_until[s3_prefix] = self._clock() + self._time_to_live_seconds
+            self._cached_until.move_to_end(s3_prefix)
+            while len(self._cached_until) > self._max_entries:
+                self._cached_until.popitem(last=False)
+
+    def _batch_get(self, s3_prefixes:list[str]) -> set[str]:
+        found = set()
+        for i in range(0, len(s3_prefixes), BATCH_GET_MAX_KEYS):
+            request_items = {self._table_name: {
+                'Keys': [{'s3Prefix': {'S': s3_prefix}} for s3_prefix in s3_prefixes[i:i + BATCH_GET_MAX_KEYS]],
+                'ProjectionExpression': 's3Prefix',
+            }}
+            for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+                response = self._dynamodb.batch_get_item(RequestItems=request_items)
+                found.update(
+                    item['s3Prefix']['S'] for item in response['Responses'].get(self._table_name, [])
+                )
+                request_items = response.get('UnprocessedKeys')
+                if not request_items:
+                    break
+                time.sleep(.05 * (2 ** attempt))
+            else:
+                from botocore.exceptions import ClientError
+                raise ClientError(
+                    {'Error': {'Code': 'UnprocessedKeys', 'Message': 'Known images lookup was throttled'}},
+                    'BatchGetItem'
+                )
+        return found
+
+    def _batch_write(self, index_items:list[dict]):
+        request_items = {self._table_name: [{'PutRequest': {'Item': item}} for item in index_items]}
+        attempt = 0
+        while request_items:
+            response = self._dynamodb.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems')
+            if request_items:
+                time.sleep(.05 * (2 ** min(attempt, 5)))
+                attempt += 1
+
+    def _list_in_s3(self, s3_prefixes:list[str]) -> set[str]:
+        return {
+            s3_prefix for s3_prefix in s3_prefixes
+            if self._s3.list_objects_v2(Bucket=self._bucket, Prefix=s3_prefix, MaxKeys=1).get('Contents')
+        }
+
+
+def _make_index_item(s3_prefix:str, s3_key:str, attributes:dict[str, str]) -> dict:
+    return {
+        's3Prefix': {'S': s3_prefix},
+        's3Key': {'S': s3_key},
+        **{name: {'S': value} for (name, value) in attributes.items()},
+    }
@@ -0,0 +1,150 @@
+import random, threading, time
+from datetime import datetime, UTC
+from email.utils import parsedate_to_datetime
+from typing import Callable
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket for one domain within one container. Tokens refill at
+    rate_per_second up to burst, and acquire() blocks until a token is available.
+    Callers reserve a token before sleeping for it, so concurrent waiters are spaced
+    out evenly rather than all waking at once.
+    """
+
+    def __init__(self, rate_per_second:float, burst:int=1,
+                 clock:Callable[[], float]=time.monotonic,
+                 sleep:Callable[[float], None]=time.sleep):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last_refill = clock()
+
+    def acquire(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate_per_second
+        if wait > 0:
+            self._sleep(wait)
+
+    def pause_for(self, seconds:float):
+        """Stops handing out tokens for the given number of seconds (e.g. after a 429)."""
+        with self._lock:
+            self._refill()
+            # A debt of seconds * rate tokens means the next token is ready once the pause
+            # is over. Concurrent pauses don't stack; the longest one wins.
+            self._tokens = min(self._tokens, -seconds * self.rate_per_second)
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate_per_second)
+        self._last_refill = now
+
+
+class DynamoTokenBucket:
+    """
+    Token bucket whose state lives in a dynamo item, so that every concurrent lambda
+    scraping a domain draws from the same budget. Tokens are taken with an optimistic
+    conditional write: if another container changed the item since it was read, the
+    write fails and acquire() reads again.
+    """
+
+    def __init__(self, dynamodb_client, table_name:str, domain:str, rate_per_second:float,
+                 burst:int=1, clock:Callable[[], float]=time.time,
+                 sleep:Callable[[float], None]=time.sleep):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self._dynamodb = dynamodb_client
+        self._table_name = table_name
+        self._key = {'domain': {'S': domain}}
+        self._clock = clock
+        self._sleep = sleep
+
+    def acquire(self):
+        while True:
+            now = self._clock()
+            item = self._dynamodb.get_item(
+                TableName=self._table_name, Key=self._key, ConsistentRead=True
+            ).get('Item')
+            if item is None:
+                tokens, last_refill, paused_until = float(self.burst), now, 0.
+            else:
+                tokens = float(item['tokens']['N'])
+                last_refill = float(item['lastRefill']['N'])
+                paused_until = float(item.get('pausedUntil', {'N': '0'})['N'])
+            if now < paused_until:
+                self._sleep(paused_until - now)
+                continue
+            tokens = min(self.burst, tokens + max(now - last_refill, 0) * self.rate_per_second)
+            if tokens < 1:
+                self._sleep((1 - tokens) / self.rate_per_second)
+                continue
+            if self._try_take_token(item, tokens - 1, now):
+                return
+            # Lost the race to another container; back off briefly before re-reading.
+            self._sleep(random.uniform(0, 1 / self.rate_per_second))
+
+    def _try_take_token(self, item:dict|None, remaining_tokens:float, now:float) -> bool:
+        update_kwargs = {
+            'TableName': self._table_name,
+            'Key': self._key,
+            'UpdateExpression': 'SET tokens = :tokens, lastRefill = :now',
+            'ExpressionAttributeValues': {
+                ':tokens': {'N': repr(remaining_tokens)},
+                ':now': {'N': repr(now)},
+            },
+        }
+        if item is None:
+            update_kwargs['ConditionExpression'] = 'attribute_not_exists(#domain)'
+            update_kwargs['ExpressionAttributeNames'] = {'#domain': 'domain'}
+        else:
+            update_kwargs['ConditionExpression'] = 'lastRefill = :previous_refill'
+            update_kwargs['ExpressionAttributeValues'][':previous_refill'] = item['lastRefill']
+        # Imported here rather than at module level, which would load botocore on every cold start
+        from botocore.exceptions import ClientError
+        try:
+            self._dynamodb.update_item(**update_kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def pause_for(self, seconds:float):
+        """Stops every container from taking tokens for the given number of seconds."""
+        from botocore.exceptions import ClientError
+        paused_until = self._clock() + seconds
+        try:
+            self._dynamodb.update_item(
+                TableName=self._table_name,
+                Key=self._key,
+                UpdateExpression='SET pausedUntil = :paused_until',
+                ConditionExpression='attribute_not_exists(pausedUntil) OR pausedUntil < :paused_until',
+                ExpressionAttributeValues={':paused_until': {'N': repr(paused_until)}},
+            )
+        except ClientError as e:
+            # A longer pause is already in place, which is fine.
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+
+def parse_retry_after(retry_after:str|None, now:datetime|None=None) -> float|None:
+    """
+    Returns the number of seconds a Retry-After header asks us to wait, or None if the
+    header is missing or unreadable. Handles both the delay-seconds and HTTP-date forms.
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - (now or datetime.now(UTC))).total_seconds(), 0.)
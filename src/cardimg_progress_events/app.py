@@ -0,0 +1,297 @@
+import json, os, time
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta, UTC
+from cardimg_common.aws_clients import LazyClient
+from cardimg_common.batch_status import (
+    ALL_STATUSES, BATCH_STATUS_TABLE, EVENT_ITEM_KEY_PREFIX, FETCH_SCHEDULE_BATCH_ID, PENDING_STATUS,
+    RETRYING_STATUS, SUMMARY_ITEM_KEY, UNFINISHED_INGEST_STATUSES, URI_ITEM_KEY_PREFIX, event_item_key,
+    status_count_attribute
+)
+from cardimg_common.instrumentation import instrumented_handler, record_value, span
+
+dynamodb = LazyClient("dynamodb")
+sns = LazyClient("sns")
+
+# Optional: without a topic, a batch's completion only shows up in its events
+BATCH_COMPLETED_TOPIC = os.environ.get('BATCH_COMPLETED_TOPIC')
+
+# Events only need to outlive the clients following them. A client that starts following a
+# batch (or has been away longer than this) should read its full status from
+# cardimg_view_batch_status first, then follow the events from the cursor it gets back.
+EVENT_TIME_TO_LIVE = timedelta(days=1)
+
+# A poll answers as soon as there are events after its cursor, or else once it has waited
+# ?wait= seconds for some (checking every POLL_INTERVAL_SECONDS). API Gateway gives up on
+# a request after 29 seconds, so waits are capped below that.
+DEFAULT_WAIT_SECONDS = 20
+MAX_WAIT_SECONDS = 25
+POLL_INTERVAL_SECONDS = 1
+# Each event holds at most one stream read's changes (100 records), so this bounds a response
+MAX_EVENTS_PER_RESPONSE = 50
+
+
+@instrumented_handler("cardimg_progress_events")
+def lambda_handler(event, context) -> dict[str, list]:
+    """
+    Reads a batch of records from the batch status table's stream, and adds one event item
+    per batch they changed (see EVENT_ITEM_KEY_PREFIX), holding each changed uri's new
+    status and the batch's latest counts. Registering uris isn't an event of its own; it
+    shows up in the counts. A batch whose events can't be written is reported as failed
+    from its first record, so that Lambda retries the stream from there. Events are
+    written at least once, but they hold new states rather than increments, so a client
+    that sees one twice ends up in the same place.
+    """
+    progress_by_batch = {}
+    for record in event['Records']:
+        keys = record['dynamodb']['Keys']
+        batch_id = keys['batchId']['S']
+        item_key = keys['itemKey']['S']
+        if record['eventName'] == 'REMOVE' or batch_id == FETCH_SCHEDULE_BATCH_ID:
+            continue
+        if not (item_key == SUMMARY_ITEM_KEY or item_key.startswith(URI_ITEM_KEY_PREFIX)):
+            # Including the event items themselves
+            continue
+        progress = progress_by_batch.setdefault(batch_id, {
+            'firstSequenceNumber': record['dynamodb']['SequenceNumber'],
+            'statusChanges': {},
+            'summaryChange': None,
+            'summaryImage': None,
+        })
+        progress['lastSequenceNumber'] = record['dynamodb']['SequenceNumber']
+        old_image = record['dynamodb'].get('OldImage', {})
+        new_image = record['dynamodb'].get('NewImage', {})
+        if item_key == SUMMARY_ITEM_KEY:
+            progress['summaryImage'] = new_image
+            if get_summary_view(new_image) != get_summary_view(old_image):
+                progress['summaryChange'] = get_summary_view(new_image)
+        elif record['eventName'] == 'MODIFY' and new_image['status'] != old_image.get('status'):
+            cardpage_uri = new_image.get('cardpageUri', {}).get('S', item_key.removeprefix(URI_ITEM_KEY_PREFIX))
+            progress['statusChanges'][cardpage_uri] = new_image['status']['S']
+
+    batch_item_failures = []
+    for (batch_id, progress) in progress_by_batch.items():
+        try:
+            record_progress_event(batch_id, progress)
+        except Exception as e:
+            print(f"Couldn't record the progress of batch {batch_id}: {e!r}")
+            batch_item_failures.append({"itemIdentifier": progress['firstSequenceNumber']})
+    return {"batchItemFailures": batch_item_failures}
+
+
+def get_summary_view(summary_image:dict) -> dict:
+    """The part of a summary item (in the stream's typed format) that clients are told about."""
+    def get_number(attribute:str) -> int:
+        return int(summary_image.get(attribute, {}).get('N', 0))
+    summary_view = {
+        "totalCount": get_number('totalCount'),
+        "statusCounts": {status: get_number(status_count_attribute(status)) for status in ALL_STATUSES},
+    }
+    if 'ingestStatus' in summary_image:
+        summary_view["ingest"] = {
+            "status": summary_image['ingestStatus']['S'],
+            "processedRows": get_number('ingestedRows'),
+        }
+    return summary_view
+
+
+def record_progress_event(batch_id:str, progress:dict):
+    delta = {}
+    if progress['statusChanges']:
+        delta["statusChanges"] = progress['statusChanges']
+    if progress['summaryChange'] is not None:
+        delta["summary"] = progress['summaryChange']
+    summary_image = progress['summaryImage']
+    if summary_image is not None and is_batch_complete(summary_image):
+        completed_at = complete_batch(batch_id, get_summary_view(summary_image))
+        if completed_at is not None:
+            delta["completedAt"] = completed_at
+    if not delta:
+        return
+    with span('dynamoWrite'):
+        dynamodb.put_item(TableName=BATCH_STATUS_TABLE, Item={
+            "batchId": {'S': batch_id},
+            "itemKey": {'S': event_item_key(int(progress['lastSequenceNumber']))},
+            "delta": {'S': json.dumps(delta)},
+            "expiresAt": {'N': str(int((datetime.now(UTC) + EVENT_TIME_TO_LIVE).timestamp()))},
+        })
+    record_value('statusChanges', len(progress['statusChanges']))
+
+
+def is_batch_complete(summary_image:dict) -> bool:
+    """
+    Whether every uri of the batch is SUCCESS or FAILURE (RETRYING ones still have attempts
+    left), and no more will be added, in a summary that doesn't yet record its completion.
+    """
+    summary_view = get_summary_view(summary_image)
+    status_counts = summary_view['statusCounts']
+    return summary_view['totalCount'] > 0 \
+        and not status_counts[PENDING_STATUS] and not status_counts[RETRYING_STATUS] \
+        and summary_view.get('ingest', {}).get('status') not in UNFINISHED_INGEST_STATUSES \
+        and 'completedAt' not in summary_image
+
+
+def complete_batch(batch_id:str, summary_view:dict) -> str|None:
+    """
+    Records the batch's completion in its summary and publishes it to BATCH_COMPLETED_TOPIC,
+    and returns when it completed. If an earlier read of the same records already recorded
+    it, that's only returned, not published again. If publishing fails, the record is
+    undone, so that a retry publishes.
+    """
+    completed_at = round(time.time(), 3)
+    try:
+        with span('dynamoWrite'):
+            dynamodb.update_item(
+                TableName=BATCH_STATUS_TABLE,
+                Key={'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+                UpdateExpression="SET completedAt = :now",
+                ConditionExpression="attribute_exists(itemKey) AND attribute_not_exists(completedAt)",
+                ExpressionAttributeValues={':now': {'N': str(completed_at)}},
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        recorded_completed_at = e.response.get('Item', {}).get('completedAt')
+        return format_timestamp(float(recorded_completed_at['N'])) if recorded_completed_at else None
+    completed_at_text = format_timestamp(completed_at)
+    if BATCH_COMPLETED_TOPIC:
+        try:
+            with span('snsPublish'):
+                sns.publish(TopicArn=BATCH_COMPLETED_TOPIC, Message=json.dumps({
+                    "batchId": batch_id,
+                    "completedAt": completed_at_text,
+                    **summary_view,
+                }))
+        except Exception:
+            dynamodb.update_item(
+                TableName=BATCH_STATUS_TABLE,
+                Key={'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+                UpdateExpression="REMOVE completedAt"
+            )
+            raise
+    return completed_at_text
+
+
+@instrumented_handler("cardimg_poll_progress_events")
+def poll_handler(event, context):
+    """
+    Answers GET /cardimg/batch/{batchId}/events?cursor=...&wait=... with what changed in the
+    batch after the cursor: each changed uri's latest status, the latest counts (if they
+    changed) and completedAt (once the batch is complete), and the cursor to poll with next.
+    Without a cursor, it starts from the oldest event still kept (see EVENT_TIME_TO_LIVE).
+    """
+    batch_id = event['pathParameters']['batchId']
+    query_params = event.get('queryStringParameters') or {}
+    try:
+        (cursor, wait_seconds) = parse_poll_request(query_params)
+        wait_until = time.monotonic() + wait_seconds
+        with span('dynamoRead'):
+            (deltas, next_cursor) = get_deltas_after(batch_id, cursor)
+        completed_at = None
+        if not deltas:
+            # Nothing new ever comes after a batch's completion, so there's no point waiting
+            with span('dynamoRead'):
+                completed_at = get_completed_at(batch_id)
+        while not deltas and completed_at is None and time.monotonic() < wait_until:
+            time.sleep(max(0, min(POLL_INTERVAL_SECONDS, wait_until - time.monotonic())))
+            with span('dynamoRead'):
+                (deltas, next_cursor) = get_deltas_after(batch_id, cursor)
+    except InvalidQueryParameterException as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)})
+        }
+    except ItemNotFoundInTableException as e:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)})
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': 'Internal server error'})
+        }
+
+    response_body = {"batchId": batch_id, "cursor": next_cursor, **merge_deltas(deltas)}
+    if completed_at is not None:
+        response_body["completedAt"] = completed_at
+    response_json = json.dumps(response_body)
+    record_value('responseBytes', len(response_json), "Bytes")
+    return {
+        "statusCode": 200,
+        'headers': {'Content-Type': 'application/json', 'Cache-Control': 'no-store'},
+        "body": response_json,
+    }
+
+
+def parse_poll_request(query_params:dict[str, str]) -> tuple[str, float]:
+    cursor = query_params.get('cursor', '0')
+    # Cursors are stream sequence numbers, which are up to 40 digits long
+    if not (cursor.isdigit() and len(cursor) <= 40):
+        raise InvalidQueryParameterException("cursor is not valid")
+    try:
+        wait_seconds = float(query_params.get('wait', DEFAULT_WAIT_SECONDS))
+    except ValueError:
+        raise InvalidQueryParameterException("wait must be a number")
+    if not 0 <= wait_seconds <= MAX_WAIT_SECONDS:
+        raise InvalidQueryParameterException(f"wait must be between 0 and {MAX_WAIT_SECONDS}")
+    return cursor, wait_seconds
+
+
+def get_deltas_after(batch_id:str, cursor:str) -> tuple[list[dict], str]:
+    """Reads the batch's events after cursor, oldest first. Returns them and the new cursor."""
+    query_result = dynamodb.query(
+        TableName=BATCH_STATUS_TABLE,
+        KeyConditionExpression='batchId = :batch_id AND itemKey BETWEEN :first_key AND :last_key',
+        ProjectionExpression='itemKey, delta',
+        ExpressionAttributeValues={
+            ':batch_id': {'S': batch_id},
+            ':first_key': {'S': event_item_key(int(cursor) + 1)},
+            ':last_key': {'S': event_item_key(10 ** 40 - 1)},
+        },
+        Limit=MAX_EVENTS_PER_RESPONSE,
+    )
+    items = query_result['Items']
+    if not items:
+        return [], cursor
+    last_sequence_number = int(items[-1]['itemKey']['S'].removeprefix(EVENT_ITEM_KEY_PREFIX))
+    return [json.loads(item['delta']['S']) for item in items], str(last_sequence_number)
+
+
+def merge_deltas(deltas:list[dict]) -> dict:
+    """Folds events into one, keeping each uri's latest status and the latest counts."""
+    merged = {"statusChanges": {}}
+    for delta in deltas:
+        merged["statusChanges"].update(delta.get("statusChanges", {}))
+        if "summary" in delta:
+            merged["summary"] = delta["summary"]
+        if "completedAt" in delta:
+            merged["completedAt"] = delta["completedAt"]
+    return merged
+
+
+def get_completed_at(batch_id:str) -> str|None:
+    query_result = dynamodb.get_item(
+        TableName=BATCH_STATUS_TABLE,
+        Key={'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+        ProjectionExpression='completedAt'
+    )
+    if 'Item' not in query_result:
+        raise ItemNotFoundInTableException(f"No batch found with the given id")
+    if 'completedAt' not in query_result['Item']:
+        return None
+    return format_timestamp(float(query_result['Item']['completedAt']['N']))
+
+
+def format_timestamp(timestamp:float) -> str:
+    return datetime.fromtimestamp(timestamp, UTC).isoformat(timespec='seconds')
+
+
+class InvalidQueryParameterException(Exception):
+    pass
+
+class ItemNotFoundInTableException(Exception):
+    pass
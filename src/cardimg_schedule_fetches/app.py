@@ -0,0 +1,132 @@
+import json, os, time
+from cardimg_common.aws_clients import LazyClient
+from cardimg_common.batch_enqueue import CARD_PAGE_URI_COLUMN, SQS_BATCH_MAX_ENTRIES, send_csvrows_to_sqs
+from cardimg_common.batch_status import BATCH_STATUS_TABLE, FETCH_SCHEDULE_BATCH_ID, URI_ITEM_KEY_PREFIX
+from cardimg_common.instrumentation import instrumented_handler, record_value, span
+
+sqs = LazyClient("sqs")
+dynamodb = LazyClient("dynamodb")
+
+# Batches too big for the priority fetch queue (see cardimg_add_batch and
+# cardimg_batch_upload) are trickled onto CARD_IMG_FETCH_QUEUE from here, round-robin
+# between batches, keeping no more than BULK_QUEUE_TARGET_DEPTH messages waiting there. So
+# a big batch that arrives after another starts getting scraped within one scheduler run,
+# rather than after the other is done. Each uri is queued once, with the csv row it was
+# registered with (its first row in the batch), so a uri repeated in a big batch is
+# scraped once, whereas a priority batch queues every row.
+CARD_IMG_FETCH_QUEUE = os.environ['CARD_IMG_FETCH_QUEUE']
+BULK_QUEUE_TARGET_DEPTH = int(os.environ.get('BULK_QUEUE_TARGET_DEPTH', 2000))
+
+@instrumented_handler("cardimg_schedule_fetches")
+def lambda_handler(event, context) -> dict[str, int]:
+    """
+    Tops the bulk fetch queue up to BULK_QUEUE_TARGET_DEPTH waiting messages, from the
+    scheduled batches (see schedule_batch in cardimg_common.batch_status), round-robin:
+    each round splits what's left evenly between the batches with uris left to queue,
+    least recently served first. Runs every minute, one run at a time.
+    """
+    with span('sqsCheck'):
+        queue_attributes = sqs.get_queue_attributes(
+            QueueUrl=CARD_IMG_FETCH_QUEUE, AttributeNames=['ApproximateNumberOfMessages']
+        )['Attributes']
+    budget = BULK_QUEUE_TARGET_DEPTH - int(queue_attributes['ApproximateNumberOfMessages'])
+    with span('dynamoRead'):
+        scheduled_batches = get_scheduled_batches()
+    queued_row_count = 0
+    while budget > 0 and scheduled_batches:
+        # Shares smaller than an SQS batch would only make more calls
+        share = max(budget // len(scheduled_batches), SQS_BATCH_MAX_ENTRIES)
+        round_queued_row_count = 0
+        for scheduled_batch in list(scheduled_batches):
+            if budget <= 0:
+                break
+            queued = queue_scheduled_rows(scheduled_batch, min(share, budget))
+            budget -= queued
+            round_queued_row_count += queued
+            if scheduled_batch['finished']:
+                scheduled_batches.remove(scheduled_batch)
+        queued_row_count += round_queued_row_count
+        if not round_queued_row_count:
+            # Nothing could be queued (e.g. SQS is failing), so try again on the next run
+            break
+    record_value('queuedRows', queued_row_count)
+    return {"queuedRows": queued_row_count, "scheduledBatches": len(scheduled_batches)}
+
+
+def get_scheduled_batches() -> list[dict]:
+    """Returns the batches waiting for the fetch scheduler, least recently served first."""
+    scheduled_batches = []
+    query_kwargs = {
+        'TableName': BATCH_STATUS_TABLE,
+        'KeyConditionExpression': 'batchId = :schedule_batch_id',
+        'ExpressionAttributeValues': {':schedule_batch_id': {'S': FETCH_SCHEDULE_BATCH_ID}},
+    }
+    while True:
+        query_result = dynamodb.query(**query_kwargs)
+        scheduled_batches.extend(
+            {
+                'itemKey': item['itemKey']['S'],
+                'batchId': item['scheduledBatchId']['S'],
+                'refresh': item.get('refresh', {}).get('BOOL', False),
+                'cursor': item.get('cursor', {}).get('S'),
+                'lastQueuedAt': float(item.get('lastQueuedAt', {}).get('N', 0)),
+                'finished': False,
+            }
+            for item in query_result['Items']
+        )
+        if 'LastEvaluatedKey' not in query_result:
+            return sorted(scheduled_batches, key=lambda scheduled_batch: scheduled_batch['lastQueuedAt'])
+        query_kwargs['ExclusiveStartKey'] = query_result['LastEvaluatedKey']
+
+
+def queue_scheduled_rows(scheduled_batch:dict, limit:int) -> int:
+    """
+    Queues up to limit of the scheduled batch's uris, following on from its cursor, and moves
+    the cursor past them (or drops the batch from the schedule once it's all queued). Returns
+    the number of uris queued.
+    """
+    batch_id = scheduled_batch['batchId']
+    query_kwargs = {
+        'TableName': BATCH_STATUS_TABLE,
+        'KeyConditionExpression': 'batchId = :batch_id AND begins_with(itemKey, :uri_prefix)',
+        'ProjectionExpression': 'itemKey, cardpageUri, csvRow',
+        'ExpressionAttributeValues': {':batch_id': {'S': batch_id}, ':uri_prefix': {'S': URI_ITEM_KEY_PREFIX}},
+        'Limit': limit,
+    }
+    if scheduled_batch['cursor']:
+        query_kwargs['ExclusiveStartKey'] = {'batchId': {'S': batch_id}, 'itemKey': {'S': scheduled_batch['cursor']}}
+    with span('dynamoRead'):
+        query_result = dynamodb.query(**query_kwargs)
+    uri_items = query_result['Items']
+    # Uris registered without their row get a row of just the uri
+    csv_rows = [
+        json.loads(item['csvRow']['S']) if 'csvRow' in item else {CARD_PAGE_URI_COLUMN: item['cardpageUri']['S']}
+        for item in uri_items
+    ]
+    with span('enqueue'):
+        unqueued_rows = send_csvrows_to_sqs(
+            sqs, csv_rows, batch_id, CARD_IMG_FETCH_QUEUE, refresh=scheduled_batch['refresh']
+        )
+    # The cursor stops before the first uri that couldn't be queued, so it's tried again next time
+    # (min - 2 turns its csv line number back into its position in uri_items)
+    queued_count = min(unqueued_rows) - 2 if unqueued_rows else len(uri_items)
+    if queued_count:
+        scheduled_batch['cursor'] = uri_items[queued_count - 1]['itemKey']['S']
+    scheduled_batch['finished'] = not unqueued_rows and 'LastEvaluatedKey' not in query_result
+    schedule_key = {'batchId': {'S': FETCH_SCHEDULE_BATCH_ID}, 'itemKey': {'S': scheduled_batch['itemKey']}}
+    with span('dynamoWrite'):
+        if scheduled_batch['finished']:
+            dynamodb.delete_item(TableName=BATCH_STATUS_TABLE, Key=schedule_key)
+        elif queued_count:
+            scheduled_batch['lastQueuedAt'] = time.time()
+            dynamodb.update_item(
+                TableName=BATCH_STATUS_TABLE,
+                Key=schedule_key,
+                UpdateExpression="SET #cursor = :cursor, lastQueuedAt = :last_queued_at",
+                ExpressionAttributeNames={'#cursor': 'cursor'},
+                ExpressionAttributeValues={
+                    ':cursor': {'S': scheduled_batch['cursor']},
+                    ':last_queued_at': {'N': str(round(scheduled_batch['lastQueuedAt'], 3))},
+                }
+            )
+    return queued_count
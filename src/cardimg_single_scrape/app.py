@@ -1,123 +1,527 @@
-from bs4 import BeautifulSoup
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from cardimg_common.aws_clients import LazyClient
+from cardimg_common.cardimg_extraction import CardImgExtractor, get_extractor_factory
+from cardimg_common.cardpage_uri import ApprovedDomainIndex, canonicalize_cardpage_uri
+from cardimg_common.batch_status import (
+    FAILURE_STATUS, RETRYING_STATUS, SUCCESS_STATUS, record_status_changes
+)
+from cardimg_common.http_session import ScraperSession, log_session_stats
+from cardimg_common.instrumentation import instrumented_handler, record_value, span, timed_iter
+from cardimg_common.known_images import KnownImagesIndex
+from cardimg_common.derivatives import (
+    DerivativeSpec, can_make_derivative, make_derivative, parse_derivative_specs
+)
+from cardimg_common.rate_limit import DynamoTokenBucket, TokenBucket, parse_retry_after
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from urllib.parse import urlparse, ParseResult
-import boto3, json, mimetypes, os, re, requests, time
+from itertools import chain, zip_longest
+from typing import Callable, Iterable
+from urllib.parse import urljoin, urlparse, ParseResult
+import hashlib, json, mimetypes, os, re, requests, tempfile, threading
 
 CARDIMG_BUCKET = os.environ['CARDIMG_BUCKET']
 SCRAPER_APP_VERSION = os.environ['SCRAPER_APP_VERSION']
 APPROVED_DOMAINS_TO_CARDIMG_SELECTORS = \
     json.loads(os.environ['APPROVED_DOMAINS_TO_CARDIMG_SELECTORS'])
+APPROVED_DOMAINS = ApprovedDomainIndex(APPROVED_DOMAINS_TO_CARDIMG_SELECTORS.keys())
 CARD_PAGE_URI_COLUMN = "Card Page URI"
 
 # Matches the img src as capture grp 1 and the query params as grp 3
 # Only matches raster image types (excludes icons and vector images).
 IMG_SRC_REGEX_PATTERN = r'^(.*\.(jpg|jpeg|png|gif|webp|avif|bmp|tiff|tif))(\?.*)?$'
 
-SLEEP_TIME = .1
+# Each approved domain's entry in APPROVED_DOMAINS_TO_CARDIMG_SELECTORS is either just its
+# css selector, or an object with a "selector", optionally an "extractor" (see
+# cardimg_common.cardimg_extraction) and optionally its rate limit, given as
+# "requestsPerSecond" and "burst". Domains without a rate limit get these defaults.
+DEFAULT_REQUESTS_PER_SECOND = 10
+DEFAULT_BURST = 1
+# When set, each domain's rate limit is shared by all concurrent scrapers via this table.
+# Otherwise each container enforces the rate limit on its own.
+RATE_LIMIT_TABLE = os.environ.get('RATE_LIMIT_TABLE')
+# Responses that mean "slow down". We wait as long as Retry-After says (or
+# THROTTLED_DEFAULT_WAIT_SECONDS without one) and try again, up to MAX_THROTTLED_ATTEMPTS times.
+# Waits are capped so that one Retry-After can't use up the whole lambda timeout.
+THROTTLED_STATUS_CODES = (429, 503)
+THROTTLED_DEFAULT_WAIT_SECONDS = 1
+THROTTLED_MAX_WAIT_SECONDS = 10
+MAX_THROTTLED_ATTEMPTS = 3
 
-SCRAPE_SUCCESS_STATUS = "SUCCESS"
-SCRAPE_FAILURE_STATUS = "FAILURE"
+# Records in one invocation are scraped concurrently by up to SCRAPE_MAX_WORKERS threads,
+# but no more than SCRAPE_MAX_WORKERS_PER_DOMAIN of them fetch from the same domain at once.
+SCRAPE_MAX_WORKERS = int(os.environ.get('SCRAPE_MAX_WORKERS', 4))
+SCRAPE_MAX_WORKERS_PER_DOMAIN = int(os.environ.get('SCRAPE_MAX_WORKERS_PER_DOMAIN', 2))
+DOMAIN_SEMAPHORES = {
+    domain: threading.BoundedSemaphore(SCRAPE_MAX_WORKERS_PER_DOMAIN)
+    for domain in APPROVED_DOMAINS_TO_CARDIMG_SELECTORS
+}
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource("dynamodb")
-batchStatusTable = dynamodb.Table("CardImgBatchStatus") # type:ignore[reportAttributeAccessIssue]
+SCRAPE_SUCCESS_STATUS = SUCCESS_STATUS
+SCRAPE_RETRYING_STATUS = RETRYING_STATUS
+SCRAPE_FAILURE_STATUS = FAILURE_STATUS
+# Must match the maxReceiveCount of CardImgFetchQueue's RedrivePolicy
+SQS_MAX_RECEIVE_COUNT = int(os.environ.get('SQS_MAX_RECEIVE_COUNT', 3))
 
+# Low-level clients rather than resources, because clients are safe to share across threads.
+# Each is only created when first used (e.g. an invocation whose cards all have an image
+# never creates the s3 client).
+s3 = LazyClient('s3')
+dynamodb = LazyClient('dynamodb')
+
+# Cards whose image is already in the bucket are skipped. When KNOWN_IMAGES_TABLE isn't set,
+# the index falls back to listing the bucket for each card.
+KNOWN_IMAGES_TABLE = os.environ.get('KNOWN_IMAGES_TABLE')
+KNOWN_IMAGES = KnownImagesIndex(dynamodb, KNOWN_IMAGES_TABLE, s3, CARDIMG_BUCKET)
+
+def make_rate_limiter(domain:str, domain_config:str|dict) -> TokenBucket|DynamoTokenBucket:
+    rate_limit = {} if isinstance(domain_config, str) else domain_config
+    requests_per_second = rate_limit.get('requestsPerSecond', DEFAULT_REQUESTS_PER_SECOND)
+    burst = rate_limit.get('burst', DEFAULT_BURST)
+    if RATE_LIMIT_TABLE:
+        return DynamoTokenBucket(dynamodb, RATE_LIMIT_TABLE, domain, requests_per_second, burst)
+    return TokenBucket(requests_per_second, burst)
+
+CARDIMG_EXTRACTORS = {
+    domain: get_extractor_factory(domain_config)
+    for (domain, domain_config) in APPROVED_DOMAINS_TO_CARDIMG_SELECTORS.items()
+}
+# Card pages are read and parsed this many bytes at a time, until the card image is found
+CARDPAGE_CHUNK_BYTES = 16 * 1024
+
+# Card images are stored by content, at CARDIMG_CONTENT_PREFIX + <sha256>.<extension>, so
+# the same image reached from several card pages is only stored once. Each card page's
+# prefix (see get_s3_prefix_for_cardimg) holds a small json pointer to its image, with the
+# validators (ETag/Last-Modified) needed to re-check the image with a conditional GET.
+CARDIMG_CONTENT_PREFIX = "sha256/"
+CARDIMG_POINTER_NAME = "img.json"
+# Card images are read a chunk at a time, and kept in memory only while they're small.
+# Images over the threshold are sent as a multipart upload. Larger images than
+# MAX_CARDIMG_BYTES are rejected (and nothing is written to S3).
+MAX_CARDIMG_BYTES = int(os.environ.get('MAX_CARDIMG_BYTES', 25 * 1024 * 1024))
+CARDIMG_READ_CHUNK_BYTES = 64 * 1024
+CARDIMG_SPOOL_MEMORY_BYTES = 1024 * 1024
+# Workers storing the same image at once take turns (by hash), so that only one uploads it
+CONTENT_UPLOAD_LOCKS = [threading.Lock() for _ in range(64)]
+CARDIMG_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=2,
+)
+
+# Smaller copies of each card image (e.g. for grids of cards), as a list of
+# {"width": ..., "format": "webp"|"avif"|"jpeg"|"png"} objects. Each is stored next to its
+# original (see DerivativeSpec) and listed, with its size and dimensions, in the pointer.
+# Derivatives are only made when Pillow is installed, and Pillow is only imported once the
+# first one is made.
+CARDIMG_DERIVATIVE_SPECS = parse_derivative_specs(json.loads(os.environ.get('CARDIMG_DERIVATIVES', '[]')))
+
+RATE_LIMITERS = {
+    domain: make_rate_limiter(domain, domain_config)
+    for (domain, domain_config) in APPROVED_DOMAINS_TO_CARDIMG_SELECTORS.items()
+}
+
+# One keep-alive session per approved domain, kept for the life of the container, so warm
+# invocations don't reconnect (and redo the TLS handshake) for every page and image.
+SCRAPE_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('SCRAPE_CONNECT_TIMEOUT_SECONDS', 3.05))
+SCRAPE_READ_TIMEOUT_SECONDS = float(os.environ.get('SCRAPE_READ_TIMEOUT_SECONDS', 5))
+HTTP_SESSIONS = {
+    domain: ScraperSession(
+        pool_maxsize=SCRAPE_MAX_WORKERS_PER_DOMAIN,
+        connect_timeout=SCRAPE_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=SCRAPE_READ_TIMEOUT_SECONDS,
+    )
+    for domain in APPROVED_DOMAINS_TO_CARDIMG_SELECTORS
+}
+
+def get_sqs_payload_bytes(event) -> int:
+    return sum(len(sqs_record.get('body') or '') for sqs_record in event.get('Records', []))
+
+@instrumented_handler("cardimg_single_scrape", get_payload_bytes=get_sqs_payload_bytes)
 def lambda_handler(event, context):
-    sqs_record_bodies = [ json.loads(record['body']) for record in event['Records'] ]
-    print(f"Handling event with {len(sqs_record_bodies)} csv entries.")
-    print(json.dumps(event))
-
-    # Our way of handling failed scrape requests is unsophisticated. An exception that occurs
-    # partway through the batch of queued events will cause this whole lambda invocation to fail.
-    # Any unprocessed queue events will be dropped, so we have to save them as failures during
-    # exception processing. Therefore, we assign the statuses to all failures until we confirm
-    # their success, one at a time.
-    # Here we construct a two-level dictionary, wherein batch ID's (referring to user-defined
-    # batches, NOT SQS batches) map to dicts of URLs to statuses. Statuses are initialized to
-    # a failure status.
-    statuses = {}
-    for sqs_record in sqs_record_bodies:
-        if not sqs_record['batchId'] in statuses:
-            statuses[sqs_record['batchId']] = {}
-        statuses_for_batch_id = statuses[sqs_record['batchId']]
-        cardpage_uri = sqs_record['itemFromBatch']['Card Page URI']
-        statuses_for_batch_id[cardpage_uri] = SCRAPE_FAILURE_STATUS
-
-    for record_body in sqs_record_bodies:
-        batch_id, item_from_batch = record_body['batchId'], record_body['itemFromBatch']
-        try:
-            parsed_cardpage_uri = urlparse(item_from_batch['Card Page URI'].removesuffix('/'))
-            cardpage_domain = parsed_cardpage_uri.netloc.lower().removeprefix("www.")
-            cardimg_selector = APPROVED_DOMAINS_TO_CARDIMG_SELECTORS[cardpage_domain]
-            if already_has_s3_key_at(parsed_cardpage_uri):
+    sqs_records = event['Records']
+    print(f"Handling event with {len(sqs_records)} csv entries.")
+    record_value('records', len(sqs_records))
+
+    # Each record is scraped on a worker thread and succeeds or fails on its own. Records are
+    # interleaved by domain before they are handed to the pool, so that workers waiting on one
+    # busy domain's semaphore don't hold up records for other domains.
+    sqs_records = _interleave_by_domain(sqs_records)
+    # Which cards already have an image is looked up for the whole batch at once
+    with span('knownImagesLookup'):
+        known_s3_prefixes = find_known_cardimgs(sqs_records)
+    with ThreadPoolExecutor(max_workers=SCRAPE_MAX_WORKERS) as executor:
+        scrape_results = list(executor.map(
+            lambda sqs_record: handle_sqs_record(sqs_record, known_s3_prefixes), sqs_records
+        ))
+
+    # Statuses are buffered until every record is done, so that each batch's status
+    # counters are updated once per invocation rather than once per card.
+    statuses_by_batch_id = {}
+    for scrape_result in scrape_results:
+        if scrape_result is not None:
+            batch_id, cardpage_uri, status = scrape_result
+            statuses_for_batch_id = statuses_by_batch_id.setdefault(batch_id, {})
+            # If a uri appears twice in one sqs batch, a success wins over a failure
+            if statuses_for_batch_id.get(cardpage_uri) != SCRAPE_SUCCESS_STATUS:
+                statuses_for_batch_id[cardpage_uri] = status
+    with span('dynamoWrite'):
+        unsaved_batch_ids = save_job_statuses_to_dynamo(statuses_by_batch_id)
+    log_session_stats(HTTP_SESSIONS)
+
+    # Only the messages that failed (or whose status couldn't be saved) are reported back to
+    # SQS (via ReportBatchItemFailures), so only those are redelivered, and cards that were
+    # already scraped aren't scraped again.
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": sqs_record['messageId']}
+            for (sqs_record, scrape_result) in zip(sqs_records, scrape_results)
+            if scrape_result is None
+                or scrape_result[2] != SCRAPE_SUCCESS_STATUS
+                or scrape_result[0] in unsaved_batch_ids
+        ]
+    }
+
+def handle_sqs_record(sqs_record:dict, known_s3_prefixes:set[str]|frozenset[str]=frozenset()
+                      ) -> tuple[str, str, str]|None:
+    """
+    Returns the (batchId, cardpage uri, status) of the record, or None if it couldn't be
+    handled at all. Unhandled records are redelivered by SQS.
+    """
+    try:
+        return scrape_record(sqs_record, known_s3_prefixes)
+    except Exception as e:
+        print(f"Couldn't handle message {sqs_record.get('messageId')}: {str(e)}")
+        return None
+
+def scrape_record(sqs_record:dict, known_s3_prefixes:set[str]|frozenset[str]=frozenset()
+                  ) -> tuple[str, str, str]:
+    """
+    Scrapes the card for one sqs record, unless its s3 prefix is in known_s3_prefixes (in which
+    case a refresh record re-checks the image instead), and returns its (batchId, cardpage uri,
+    status).
+    """
+    record_body = json.loads(sqs_record['body'])
+    batch_id, item_from_batch = record_body['batchId'], record_body['itemFromBatch']
+    try:
+        parsed_cardpage_uri = canonicalize_cardpage_uri(item_from_batch['Card Page URI'])
+        cardpage_domain = APPROVED_DOMAINS.match(parsed_cardpage_uri.netloc)
+        if cardpage_domain is None:
+            raise ValueError(f"{parsed_cardpage_uri.netloc} is not an approved domain")
+        if get_s3_prefix_for_cardimg(parsed_cardpage_uri) in known_s3_prefixes:
+            if record_body.get('refresh'):
+                print(f"Refreshing the image for {get_s3_prefix_for_cardimg(parsed_cardpage_uri)}...")
+                with DOMAIN_SEMAPHORES[cardpage_domain]:
+                    refresh_img(
+                        parsed_cardpage_uri, CARDIMG_EXTRACTORS[cardpage_domain],
+                        RATE_LIMITERS[cardpage_domain], HTTP_SESSIONS[cardpage_domain]
+                    )
+            else:
                 print(f"Object already exists at {get_s3_prefix_for_cardimg(parsed_cardpage_uri)}.")
+        else:
+            print(f"Object not found at {get_s3_prefix_for_cardimg(parsed_cardpage_uri)}. Retrieving it from {parsed_cardpage_uri.netloc}...")
+            with DOMAIN_SEMAPHORES[cardpage_domain]:
+                locate_and_upload_img(
+                    parsed_cardpage_uri, CARDIMG_EXTRACTORS[cardpage_domain],
+                    RATE_LIMITERS[cardpage_domain], HTTP_SESSIONS[cardpage_domain]
+                )
+    except Exception as e:
+        print(f"Exception occured: {str(e)}")
+        return batch_id, item_from_batch['Card Page URI'], get_failure_status(sqs_record)
+    return batch_id, item_from_batch['Card Page URI'], SCRAPE_SUCCESS_STATUS
+
+def get_failure_status(sqs_record:dict) -> str:
+    """A failed record is only a FAILURE once SQS won't redeliver it; until then it's RETRYING."""
+    receive_count = int(sqs_record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+    if receive_count >= SQS_MAX_RECEIVE_COUNT:
+        return SCRAPE_FAILURE_STATUS
+    return SCRAPE_RETRYING_STATUS
+
+def _interleave_by_domain(sqs_records:list[dict]) -> list[dict]:
+    """Reorders records round-robin across their cardpage domains."""
+    records_by_domain = {}
+    for sqs_record in sqs_records:
+        try:
+            record_body = json.loads(sqs_record['body'])
+            cardpage_domain = canonicalize_cardpage_uri(record_body['itemFromBatch']['Card Page URI']).netloc
+        except Exception:
+            # Malformed records fail later, in handle_sqs_record
+            cardpage_domain = None
+        records_by_domain.setdefault(cardpage_domain, []).append(sqs_record)
+    return [
+        sqs_record
+        for sqs_record in chain.from_iterable(zip_longest(*records_by_domain.values()))
+        if sqs_record is not None
+    ]
+
+def find_known_cardimgs(sqs_records:list[dict]) -> set[str]:
+    """Returns the s3 prefixes of the records' cards that already have an image."""
+    s3_prefixes = set()
+    for sqs_record in sqs_records:
+        try:
+            record_body = json.loads(sqs_record['body'])
+            s3_prefixes.add(get_s3_prefix_for_cardimg(
+                canonicalize_cardpage_uri(record_body['itemFromBatch']['Card Page URI'])
+            ))
+        except Exception:
+            # Malformed records fail later, in handle_sqs_record
+            continue
+    return KNOWN_IMAGES.find_known(s3_prefixes)
+
+def locate_and_upload_img(parsed_cardpage_uri:ParseResult, make_extractor:Callable[[], CardImgExtractor],
+                          rate_limiter, http_session:requests.Session):
+    cardimg_uri = get_cardimg_uri(parsed_cardpage_uri, make_extractor, rate_limiter, http_session)
+    with rate_limited_get(cardimg_uri, rate_limiter, http_session, 'imageFetch', stream=True) as resp:
+        if not resp.ok:
+            raise RuntimeError("status code was " + str(resp.status_code))
+        store_cardimg(parsed_cardpage_uri, cardimg_uri, resp)
+
+def refresh_img(parsed_cardpage_uri:ParseResult, make_extractor:Callable[[], CardImgExtractor],
+                rate_limiter, http_session:requests.Session):
+    """
+    Re-fetches a card's image with a conditional GET, using the validators saved in its
+    pointer, so an unchanged image costs a 304 and no body. Cards without a pointer (or whose
+    image has moved) are scraped from their card page as usual.
+    """
+    pointer = get_cardimg_pointer(parsed_cardpage_uri)
+    if pointer is None:
+        return locate_and_upload_img(parsed_cardpage_uri, make_extractor, rate_limiter, http_session)
+    conditional_headers = {}
+    if pointer.get('etag'):
+        conditional_headers['If-None-Match'] = pointer['etag']
+    if pointer.get('lastModified'):
+        conditional_headers['If-Modified-Since'] = pointer['lastModified']
+    cardimg_uri = pointer['originalImgUri']
+    with rate_limited_get(cardimg_uri, rate_limiter, http_session, 'imageFetch',
+                          stream=True, headers=conditional_headers) as resp:
+        if resp.status_code == 304:
+            print(f"Image at {cardimg_uri} is unchanged.")
+            return
+        if resp.ok:
+            store_cardimg(parsed_cardpage_uri, cardimg_uri, resp)
+            return
+    print(f"Image at {cardimg_uri} returned {resp.status_code}; finding it on the card page again...")
+    locate_and_upload_img(parsed_cardpage_uri, make_extractor, rate_limiter, http_session)
+
+def store_cardimg(parsed_cardpage_uri:ParseResult, cardimg_uri:str, resp:requests.Response) -> dict:
+    """
+    Stores the image in resp (and its derivatives) by its content (under its SHA-256), unless
+    an identical image is already stored, and points the card page's prefix at it. Returns the
+    pointer.
+    """
+    content_length = resp.headers.get('Content-Length')
+    if content_length is not None and content_length.isdigit() and int(content_length) > MAX_CARDIMG_BYTES:
+        raise CardImgTooLargeException(f"{cardimg_uri} is {content_length} bytes")
+    extension = urlparse(cardimg_uri).path.split('.')[-1].lower()
+    content_type = get_cardimg_content_type(resp, "img." + extension)
+    upstream_validators = {
+        'etag': resp.headers.get('ETag'),
+        'lastModified': resp.headers.get('Last-Modified'),
+    }
+    # The hash is only known once the whole image is read, so the image is spooled (in memory
+    # while small, then in /tmp) rather than streamed straight into S3.
+    with tempfile.SpooledTemporaryFile(max_size=CARDIMG_SPOOL_MEMORY_BYTES) as spooled_img:
+        with span('imageSpool'):
+            sha256 = spool_cardimg(timed_iter(resp.iter_content(CARDIMG_READ_CHUNK_BYTES), 'imageFetch'), spooled_img)
+        content_key = f"{CARDIMG_CONTENT_PREFIX}{sha256}.{extension}"
+        with CONTENT_UPLOAD_LOCKS[int(sha256[:8], 16) % len(CONTENT_UPLOAD_LOCKS)]:
+            # Before the upload, which closes spooled_img
+            derivatives = store_derivatives(content_key, spooled_img)
+            if s3_key_exists(content_key):
+                print(f"Image from {cardimg_uri} is already stored at {content_key}.")
             else:
-                print(f"Object not found at {get_s3_prefix_for_cardimg(parsed_cardpage_uri)}. Retrieving it from {parsed_cardpage_uri.netloc}...")
-                locate_and_upload_img(parsed_cardpage_uri, cardimg_selector)
-            
-            # save success to dynamo
-            save_job_status_to_dynamo(batch_id, item_from_batch['Card Page URI'], SCRAPE_SUCCESS_STATUS)
-            statuses[batch_id][item_from_batch['Card Page URI']] = SCRAPE_SUCCESS_STATUS
-            
-        except Exception as e:
-            print(f"Exception occured: {str(e)}")
-            # save all failures (and pending jobs we didn't get to) as failures in dynamo
-            for pending_batch_id, statuses_for_id in statuses.items():
-                for uri, status in statuses_for_id.items():
-                    if not status == SCRAPE_SUCCESS_STATUS:
-                        save_job_status_to_dynamo(pending_batch_id, uri, SCRAPE_FAILURE_STATUS)
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Internal server error'})
-            }
-    return {
-        "statusCode": 200,
-        'headers': {'Content-Type': 'application/json'},
-        "body": json.dumps({
-            "message": f"located + uploaded {len(sqs_record_bodies)} objects"
-        }),
+                spooled_img.seek(0)
+                with span('s3Put'):
+                    s3.upload_fileobj(
+                        spooled_img,
+                        CARDIMG_BUCKET,
+                        content_key,
+                        ExtraArgs={
+                            'ContentType': content_type,
+                            'Metadata': {
+                                "scraper_app_version": SCRAPER_APP_VERSION,
+                                "datetime": datetime.now().isoformat(),
+                                "original_img_uri": cardimg_uri,
+                                **{
+                                    name: value for (name, value) in (
+                                        ("etag", upstream_validators['etag']),
+                                        ("last_modified", upstream_validators['lastModified']),
+                                    ) if value
+                                }
+                            }
+                        },
+                        Config=CARDIMG_TRANSFER_CONFIG
+                    )
+
+    prefix = get_s3_prefix_for_cardimg(parsed_cardpage_uri)
+    pointer = {
+        'sha256': sha256,
+        'contentKey': content_key,
+        'contentType': content_type,
+        'originalImgUri': cardimg_uri,
+        **{name: value for (name, value) in upstream_validators.items() if value},
+        'derivatives': derivatives,
+        'scraperAppVersion': SCRAPER_APP_VERSION,
+        'datetime': datetime.now().isoformat(),
     }
+    with span('s3Put'):
+        s3.put_object(
+            Bucket=CARDIMG_BUCKET,
+            Key=prefix + CARDIMG_POINTER_NAME,
+            Body=json.dumps(pointer).encode('utf-8'),
+            ContentType='application/json'
+        )
+    try:
+        with span('dynamoWrite'):
+            KNOWN_IMAGES.remember(prefix, content_key, sha256=sha256, originalImgUri=cardimg_uri)
+    except Exception as e:
+        # The image is stored either way; at worst the card is scraped again later
+        print(f"Couldn't add {prefix} to the known images index: {str(e)}")
+    return pointer
+
+def store_derivatives(content_key:str, img_file) -> list[dict]:
+    """
+    Makes and stores the image's derivatives (see CARDIMG_DERIVATIVE_SPECS), except those
+    already stored, and returns each one's key, format, dimensions and size. Derivatives
+    that can't be made are left out; the original is stored either way.
+    """
+    derivatives = []
+    for spec in CARDIMG_DERIVATIVE_SPECS:
+        if not can_make_derivative(spec):
+            continue
+        derivative_key = spec.get_key(content_key)
+        try:
+            derivative = get_stored_derivative(derivative_key, spec)
+            if derivative is None:
+                with span('derivativeEncode'):
+                    derivative_bytes, width, height = make_derivative(img_file, spec)
+                with span('s3Put'):
+                    s3.put_object(
+                        Bucket=CARDIMG_BUCKET,
+                        Key=derivative_key,
+                        Body=derivative_bytes,
+                        ContentType=spec.content_type,
+                        Metadata={
+                            "scraper_app_version": SCRAPER_APP_VERSION,
+                            "source_key": content_key,
+                            "width": str(width),
+                            "height": str(height),
+                        }
+                    )
+                derivative = make_derivative_entry(derivative_key, spec, width, height, len(derivative_bytes))
+        except Exception as e:
+            print(f"Couldn't make the {spec.name} derivative of {content_key}: {str(e)}")
+            continue
+        derivatives.append(derivative)
+    return derivatives
 
-def already_has_s3_key_at(parsed_cardpage_uri:ParseResult) -> bool:
-    s3_response = s3.list_objects_v2(
-        Bucket=CARDIMG_BUCKET,
-        Prefix=get_s3_prefix_for_cardimg(parsed_cardpage_uri)
+def get_stored_derivative(derivative_key:str, spec:DerivativeSpec) -> dict|None:
+    try:
+        with span('s3Check'):
+            s3_response = s3.head_object(Bucket=CARDIMG_BUCKET, Key=derivative_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return make_derivative_entry(
+        derivative_key, spec,
+        int(s3_response['Metadata']['width']), int(s3_response['Metadata']['height']),
+        s3_response['ContentLength']
     )
-    return s3_response.get('Contents') is not None
 
-def locate_and_upload_img(parsed_cardpage_uri:ParseResult, cardimg_selector:str):
-    cardimg_uri = get_cardimg_uri(parsed_cardpage_uri, cardimg_selector)
+def make_derivative_entry(derivative_key:str, spec:DerivativeSpec, width:int, height:int, size:int) -> dict:
+    return {'key': derivative_key, 'format': spec.image_format, 'width': width, 'height': height, 'bytes': size}
 
-    time.sleep(SLEEP_TIME)
-    resp = requests.get(cardimg_uri)
-    if not resp.ok:
-        raise RuntimeError("status code was " + str(resp.status_code))
-    imgdata = resp.content
+def spool_cardimg(chunks:Iterable[bytes], spooled_img) -> str:
+    """
+    Writes chunks to spooled_img and returns their SHA-256 (in hex). Raises
+    CardImgTooLargeException once more than MAX_CARDIMG_BYTES have been read.
+    """
+    digest = hashlib.sha256()
+    bytes_read = 0
+    for chunk in chunks:
+        bytes_read += len(chunk)
+        if bytes_read > MAX_CARDIMG_BYTES:
+            raise CardImgTooLargeException(f"Image is over {MAX_CARDIMG_BYTES} bytes")
+        digest.update(chunk)
+        spooled_img.write(chunk)
+    return digest.hexdigest()
 
-    prefix = get_s3_prefix_for_cardimg(parsed_cardpage_uri)
-    terminal_name = "img." + urlparse(cardimg_uri).path.split('.')[-1] # "img." + file extension
-    cardimg_s3key = prefix + terminal_name
-    s3.put_object(
+def get_cardimg_pointer(parsed_cardpage_uri:ParseResult) -> dict|None:
+    try:
+        with span('s3Check'):
+            s3_response = s3.get_object(
                 Bucket=CARDIMG_BUCKET,
-                Key=cardimg_s3key,
-                Body=imgdata,
-                ContentType=mimetypes.guess_file_type(terminal_name)[0],
-                Metadata={
-                    "scraper_app_version": SCRAPER_APP_VERSION,
-                    "datetime": datetime.now().isoformat(),
-                    "original_img_uri": cardimg_uri
-                }
-    )
+                Key=get_s3_prefix_for_cardimg(parsed_cardpage_uri) + CARDIMG_POINTER_NAME
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(s3_response['Body'].read())
+
+def s3_key_exists(s3_key:str) -> bool:
+    try:
+        with span('s3Check'):
+            s3.head_object(Bucket=CARDIMG_BUCKET, Key=s3_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+def get_cardimg_uri(cardpage_uri:ParseResult, make_extractor:Callable[[], CardImgExtractor],
+                    rate_limiter, http_session:requests.Session) -> str:
+    """
+    Streams the card page through the domain's extractor, which stops parsing as soon as it
+    finds the card image. The rest of the page is still read (but not parsed), so that the
+    connection can go back to the session's pool.
+    """
+    with rate_limited_get(cardpage_uri.geturl(), rate_limiter, http_session, 'pageFetch', stream=True) as resp:
+        if not resp.ok:
+            raise RuntimeError("status code was " + str(resp.status_code))
+        resp.encoding = resp.encoding or 'utf-8'
+        html_chunks = timed_iter(resp.iter_content(CARDPAGE_CHUNK_BYTES, decode_unicode=True), 'pageFetch')
+        with span('htmlParse'):
+            cardimg_src = make_extractor().extract(html_chunks)
+        for _ in html_chunks:
+            pass
+    if cardimg_src is None:
+        raise ValueError(f"No card image found at {cardpage_uri.geturl()}")
+    # Relative srcs are relative to the card page
+    return clean_cardimg_uri(urljoin(cardpage_uri.geturl(), cardimg_src))
 
-def get_cardimg_uri(cardpage_uri:ParseResult, css_class:str) -> str:
-    time.sleep(SLEEP_TIME)
-    resp = requests.get(cardpage_uri.geturl())
-    if not resp.ok:
-        raise RuntimeError("status code was " + str(resp.status_code))
-    resp_soup = BeautifulSoup(resp.text, 'html.parser')
-    cardimg_tag = resp_soup.find_all("img", class_=css_class)[0]
-    return clean_cardimg_uri(str(cardimg_tag['src']))
+def rate_limited_get(uri:str, rate_limiter, http_session:requests.Session, stage:str='pageFetch',
+                     **get_kwargs) -> requests.Response:
+    """
+    GETs uri with the domain's session once the domain's rate limiter allows it. If the site
+    says we are going too fast, the whole domain is paused for as long as it asks before we
+    try again. Waits for the rate limiter and the GET itself are timed separately, the GET as
+    stage (see cardimg_common.instrumentation).
+    """
+    for attempt in range(MAX_THROTTLED_ATTEMPTS):
+        with span('rateLimitWait'):
+            rate_limiter.acquire()
+        with span(stage):
+            resp = http_session.get(uri, **get_kwargs)
+        if resp.status_code not in THROTTLED_STATUS_CODES:
+            break
+        resp.close()
+        retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        wait_seconds = min(
+            THROTTLED_DEFAULT_WAIT_SECONDS if retry_after is None else retry_after,
+            THROTTLED_MAX_WAIT_SECONDS
+        )
+        print(f"Throttled by {urlparse(uri).netloc} (status {resp.status_code}); pausing for {wait_seconds}s.")
+        rate_limiter.pause_for(wait_seconds)
+    return resp
+
+def get_cardimg_content_type(resp:requests.Response, terminal_name:str) -> str:
+    """The image's Content-Type as the card site sent it, or else as guessed from its extension."""
+    content_type = resp.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type.startswith('image/'):
+        return content_type
+    return mimetypes.guess_file_type(terminal_name)[0] or 'application/octet-stream'
 
 def clean_cardimg_uri(cardimg_uri:str) -> str:
     match = re.match(IMG_SRC_REGEX_PATTERN, cardimg_uri, re.IGNORECASE)
@@ -131,14 +535,17 @@ def clean_cardimg_uri(cardimg_uri:str) -> str:
 def get_s3_prefix_for_cardimg(parsed_cardpage_uri:ParseResult) -> str:
     return f"{(parsed_cardpage_uri.netloc + parsed_cardpage_uri.path).lower()}/"
 
-def save_job_status_to_dynamo(batch_id:str, scraped_uri:str, status:str):
-    return batchStatusTable.update_item(
-                Key={'batchId': batch_id},
-                UpdateExpression=f'SET progressDocument.#scraped_uri = :status',
-                ExpressionAttributeNames={
-                    '#scraped_uri': scraped_uri
-                },
-                ExpressionAttributeValues={
-                    ':status': status
-                }
-            )
\ No newline at end of file
+def save_job_statuses_to_dynamo(statuses_by_batch_id:dict[str, dict[str, str]]) -> set[str]:
+    """Saves buffered statuses, and returns the batchIds whose statuses couldn't be saved."""
+    unsaved_batch_ids = set()
+    for batch_id, statuses_by_uri in statuses_by_batch_id.items():
+        try:
+            record_status_changes(dynamodb, batch_id, statuses_by_uri)
+        except Exception as e:
+            print(f"Couldn't save statuses for batch {batch_id}: {str(e)}")
+            unsaved_batch_ids.add(batch_id)
+    return unsaved_batch_ids
+
+
+class CardImgTooLargeException(Exception):
+    pass
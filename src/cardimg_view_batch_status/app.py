@@ -1,18 +1,59 @@
-import boto3, json
+import base64, binascii, json
+from datetime import datetime, UTC
+from cardimg_common.aws_clients import LazyClient
+from cardimg_common.batch_status import (
+    ALL_STATUSES, BATCH_STATUS_TABLE, FAILURE_STATUS, SUCCESS_STATUS, SUMMARY_ITEM_KEY,
+    URI_ITEM_KEY_PREFIX, status_count_attribute
+)
+from cardimg_common.instrumentation import instrumented_handler, record_value, span
 
-dynamodb = boto3.resource("dynamodb")
-batchStatusTable = dynamodb.Table("CardImgBatchStatus") #type:ignore[reportAttributeAccessIssue]
+# A low-level client, which is much cheaper to create on a cold start than a resource
+dynamodb = LazyClient("dynamodb")
 
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+SUMMARY_PROJECTION = ", ".join(
+    ["totalCount", "statusVersion", "createdAt", "statusUpdatedAt"]
+    + [status_count_attribute(status) for status in ALL_STATUSES]
+    # Only batches uploaded straight to S3 have these (see cardimg_batch_upload's ingest_upload_handler)
+    + ["ingestStatus", "ingestedRows", "ingestUnqueuedRowCount", "ingestErrors"]
+)
+
+@instrumented_handler("cardimg_view_batch_status")
 def lambda_handler(event, context):
     batch_id = event['pathParameters']['batchId']
+    query_params = event.get('queryStringParameters') or {}
     try:
-        query_result = batchStatusTable.get_item(
-            Key={'batchId': batch_id}
-            )
-        if 'Item' not in query_result:
-            raise ItemNotFoundInTableException(f"No batch found with the given id")
-        batch_status_item = query_result['Item']
-        progress_document = batch_status_item['progressDocument']
+        page_request = parse_page_request(query_params)
+        with span('dynamoRead'):
+            summary = get_summary(batch_id)
+        etag = f'"{summary["statusVersion"]}"'
+        if etag_matches(etag, get_header(event, 'If-None-Match')):
+            return {
+                'statusCode': 304,
+                'headers': {'ETag': etag, 'Cache-Control': 'no-cache'},
+                'body': ''
+            }
+        response_body = {
+            "batchId": batch_id,
+            "totalCount": summary['totalCount'],
+            "statusCounts": summary['statusCounts'],
+        }
+        if summary['estimatedCompletionAt'] is not None:
+            response_body["estimatedCompletionAt"] = summary['estimatedCompletionAt']
+        if summary['ingest'] is not None:
+            response_body["ingest"] = summary['ingest']
+        if page_request is not None:
+            with span('dynamoRead'):
+                progress_page, next_cursor = get_progress_page(batch_id, **page_request)
+            response_body["progress"] = progress_page
+            response_body["nextCursor"] = next_cursor
+    except InvalidQueryParameterException as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)})
+        }
     except ItemNotFoundInTableException as e:
         return {
             'statusCode': 404,
@@ -26,14 +67,150 @@ def lambda_handler(event, context):
             'body': json.dumps({'error': 'Internal server error'})
         }
 
+    response_json = json.dumps(response_body)
+    record_value('responseBytes', len(response_json), "Bytes")
     return {
         "statusCode": 200,
-        'headers': {'Content-Type': 'application/json'},
-        "body": json.dumps({
-            "batchId": batch_id,
-            "progress": progress_document
-        }),
+        'headers': {'Content-Type': 'application/json', 'ETag': etag, 'Cache-Control': 'no-cache'},
+        "body": response_json,
+    }
+
+def parse_page_request(query_params:dict[str, str]) -> dict|None:
+    """
+    Reads the query string. Returns None for ?summary=true (counts only), otherwise the
+    status filter, page size and cursor to pass to get_progress_page.
+    """
+    if query_params.get('summary', '').lower() == 'true':
+        return None
+    status = query_params.get('status')
+    if status is not None:
+        status = status.upper()
+        if status not in ALL_STATUSES:
+            raise InvalidQueryParameterException(f"status must be one of {', '.join(ALL_STATUSES)}")
+    try:
+        limit = int(query_params.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise InvalidQueryParameterException("limit must be a whole number")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidQueryParameterException(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    cursor = query_params.get('cursor')
+    return {
+        'status': status,
+        'limit': limit,
+        'start_item_key': decode_cursor(cursor) if cursor else None,
+    }
+
+def get_summary(batch_id:str) -> dict:
+    query_result = dynamodb.get_item(
+        TableName=BATCH_STATUS_TABLE,
+        Key={'batchId': {'S': batch_id}, 'itemKey': {'S': SUMMARY_ITEM_KEY}},
+        ProjectionExpression=SUMMARY_PROJECTION
+        )
+    if 'Item' not in query_result:
+        raise ItemNotFoundInTableException(f"No batch found with the given id")
+    item = query_result['Item']
+    def get_number(attribute:str) -> int:
+        return int(item.get(attribute, {}).get('N', 0))
+    status_counts = {status: get_number(status_count_attribute(status)) for status in ALL_STATUSES}
+    return {
+        'totalCount': get_number('totalCount'),
+        'statusVersion': get_number('statusVersion'),
+        'statusCounts': status_counts,
+        'estimatedCompletionAt': estimate_completion(
+            item, get_number('totalCount'), status_counts[SUCCESS_STATUS] + status_counts[FAILURE_STATUS]
+        ),
+        'ingest': get_ingest_summary(item),
+    }
+
+def estimate_completion(item:dict, total_count:int, done_count:int) -> str|None:
+    """
+    Estimates when every uri of the batch will be SUCCESS or FAILURE, assuming they keep
+    finishing at the rate they have so far: done_count of them between the batch's creation
+    and its latest status change. It only depends on the summary item, so it doesn't change
+    while the ETag doesn't. Returns None until a uri is done (or for batches too old to
+    have the timestamps).
+    """
+    if not done_count or 'createdAt' not in item or 'statusUpdatedAt' not in item:
+        return None
+    created_at = float(item['createdAt']['N'])
+    status_updated_at = float(item['statusUpdatedAt']['N'])
+    estimated_at = created_at + (status_updated_at - created_at) * total_count / done_count
+    return datetime.fromtimestamp(estimated_at, UTC).isoformat(timespec='seconds')
+
+def get_ingest_summary(item:dict) -> dict|None:
+    """
+    Describes the ingestion of a batch uploaded straight to S3: its status, and how many csv
+    rows it has got through in that status (rows validated while VALIDATING, rows queued
+    while QUEUEING or once QUEUED). Returns None for batches sent in a request body.
+    """
+    if 'ingestStatus' not in item:
+        return None
+    ingest_summary = {
+        "status": item['ingestStatus']['S'],
+        "processedRows": int(item.get('ingestedRows', {}).get('N', 0)),
+    }
+    unqueued_row_count = int(item.get('ingestUnqueuedRowCount', {}).get('N', 0))
+    if unqueued_row_count:
+        ingest_summary["unqueuedRowCount"] = unqueued_row_count
+    errors = json.loads(item.get('ingestErrors', {}).get('S', '{}'))
+    if errors:
+        ingest_summary["errors"] = errors
+    return ingest_summary
+
+def get_progress_page(batch_id:str, status:str|None, limit:int,
+                      start_item_key:str|None) -> tuple[dict[str, str], str|None]:
+    """
+    Reads up to limit uri items of the batch, starting after start_item_key, into a
+    uri -> status map. Returns the map and the cursor for the next page (None on the
+    last page). With a status filter, dynamo applies limit before filtering, so a page
+    can hold fewer than limit uris even when more pages follow.
+    """
+    query_kwargs = {
+        'TableName': BATCH_STATUS_TABLE,
+        'KeyConditionExpression': 'batchId = :batch_id AND begins_with(itemKey, :uri_prefix)',
+        'ProjectionExpression': 'cardpageUri, #status',
+        'ExpressionAttributeNames': {'#status': 'status'},
+        'ExpressionAttributeValues': {':batch_id': {'S': batch_id}, ':uri_prefix': {'S': URI_ITEM_KEY_PREFIX}},
+        'Limit': limit,
     }
+    if status is not None:
+        query_kwargs['FilterExpression'] = '#status = :status'
+        query_kwargs['ExpressionAttributeValues'][':status'] = {'S': status}
+    if start_item_key is not None:
+        query_kwargs['ExclusiveStartKey'] = {'batchId': {'S': batch_id}, 'itemKey': {'S': start_item_key}}
+    query_result = dynamodb.query(**query_kwargs)
+    progress_page = {item['cardpageUri']['S']: item['status']['S'] for item in query_result['Items']}
+    last_evaluated_key = query_result.get('LastEvaluatedKey')
+    next_cursor = encode_cursor(last_evaluated_key['itemKey']['S']) if last_evaluated_key else None
+    return progress_page, next_cursor
+
+def encode_cursor(item_key:str) -> str:
+    return base64.urlsafe_b64encode(item_key.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor:str) -> str:
+    try:
+        item_key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError):
+        raise InvalidQueryParameterException("cursor is not valid")
+    if not item_key.startswith(URI_ITEM_KEY_PREFIX):
+        raise InvalidQueryParameterException("cursor is not valid")
+    return item_key
+
+def get_header(event, header_name:str) -> str|None:
+    # Header names are case-insensitive, but API Gateway passes them on as the client sent them
+    for (name, value) in (event.get('headers') or {}).items():
+        if name.lower() == header_name.lower():
+            return value
+    return None
+
+def etag_matches(etag:str, if_none_match:str|None) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')}
+    return '*' in candidates or etag in candidates
+
+class InvalidQueryParameterException(Exception):
+    pass
 
 class ItemNotFoundInTableException(Exception):
-    pass
\ No newline at end of file
+    pass
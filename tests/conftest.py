@@ -19,10 +19,13 @@ def pytest_configure():
         pytest.param("csvupload/payloaderror/missingcolumns.json", 400, id="missing_columns"),
         pytest.param("csvupload/payloaderror/missingheader.json", 400, id="missing_header"),
         pytest.param("csvupload/payloaderror/wrongheaders.json", 400, id="wrong_headers"),
+        pytest.param("csvupload/payloaderror/undecodablebody.json", 400, id="undecodable_body"),
+        pytest.param("csvupload/payloaderror/corruptgzip.json", 400, id="corrupt_gzip"),
     ]
     
     pytest.CSVUPLOAD_HAPPY_CASES = [ # type:ignore[reportAttributeAccessIssue]
         pytest.param("csvupload/happypath/csvupload-valid.json", 202, id="valid_csv"),
+        pytest.param("csvupload/happypath/csvupload-valid-gzip.json", 202, id="valid_gzip_csv"),
     ]
 
 @pytest.fixture
@@ -1,4 +1,6 @@
-import os, pytest
+import boto3, os, pytest
+
+from moto import mock_aws
 
 @pytest.fixture(scope='session', autouse=True)
 def aws_credentials():
@@ -8,4 +10,41 @@ def aws_credentials():
     os.environ['AWS_SECURITY_TOKEN'] = 'testing'
     os.environ['AWS_SESSION_TOKEN'] = 'testing'
     os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
-    os.environ['AWS_REGION'] = 'us-east-1'
\ No newline at end of file
+    os.environ['AWS_REGION'] = 'us-east-1'
+
+
+class FakeClock:
+    """Stands in for both the clock and sleep, so that sleeping just moves time forward."""
+    def __init__(self, now:float=1000.):
+        self.now = now
+    def __call__(self) -> float:
+        return self.now
+    def sleep(self, seconds:float):
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    """A FakeClock, starting at 1000."""
+    return FakeClock()
+
+@pytest.fixture
+def batch_status_table():
+    """
+    An empty CardImgBatchStatus table. It's created in a moto mock of its own, which the
+    test's @mock_aws joins rather than replaces, so the table lasts the whole test.
+    """
+    with mock_aws():
+        batch_status_table = boto3.resource('dynamodb', region_name='us-east-1').create_table( # type:ignore[reportAttributeAccessIssue]
+            TableName='CardImgBatchStatus',
+            KeySchema=[
+                { 'AttributeName': 'batchId', 'KeyType': 'HASH' },
+                { 'AttributeName': 'itemKey', 'KeyType': 'RANGE' }
+            ],
+            AttributeDefinitions=[
+                { 'AttributeName': 'batchId', 'AttributeType': 'S' },
+                { 'AttributeName': 'itemKey', 'AttributeType': 'S' }
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        batch_status_table.wait_until_exists()
+        yield batch_status_table
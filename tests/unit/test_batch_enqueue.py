@@ -0,0 +1,43 @@
+import boto3
+
+from moto import mock_aws
+
+from cardimg_common import batch_enqueue
+from cardimg_common.batch_enqueue import send_csvrows_to_sqs
+
+@mock_aws
+def test_all_rows_enqueued_in_batches():
+    """Test that every csv row ends up on the queue when sent via SendMessageBatch."""
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    queue_url = sqs.create_queue(QueueName='testq')['QueueUrl']
+    csv_rows = [
+        {"Card Page URI": f"https://scryfall.com/card/mmq/{i}/embargo"} for i in range(25)
+    ]
+    unqueued_rows = send_csvrows_to_sqs(sqs, csv_rows, "some-batch-id", queue_url)
+    assert unqueued_rows == []
+    queue_attributes = sqs.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages']
+    )
+    assert queue_attributes['Attributes']['ApproximateNumberOfMessages'] == "25"
+
+def test_failed_entries_are_retried_and_reported(monkeypatch):
+    """Test that Failed batch entries are retried, and rows that never succeed are reported."""
+    monkeypatch.setattr(batch_enqueue, 'SQS_SEND_BACKOFF_BASE_SECONDS', 0)
+    attempts_by_id = {}
+    class FlakySqsClient:
+        def send_message_batch(self, QueueUrl, Entries):
+            failed = []
+            for entry in Entries:
+                attempts_by_id[entry['Id']] = attempts_by_id.get(entry['Id'], 0) + 1
+                # row 3 fails once then succeeds; row 5 never succeeds
+                if (entry['Id'] == "3" and attempts_by_id["3"] == 1) or entry['Id'] == "5":
+                    failed.append({"Id": entry['Id'], "SenderFault": False, "Code": "InternalError"})
+            return {"Successful": [], "Failed": failed}
+    csv_rows = [
+        {"Card Page URI": f"https://scryfall.com/card/mmq/{i}/embargo"} for i in range(12)
+    ]
+    unqueued_rows = send_csvrows_to_sqs(FlakySqsClient(), csv_rows, "some-batch-id", "testq")
+    assert unqueued_rows == [5]
+    assert attempts_by_id["3"] == 2
+    assert attempts_by_id["5"] == batch_enqueue.SQS_SEND_MAX_ATTEMPTS
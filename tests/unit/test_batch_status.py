@@ -0,0 +1,119 @@
+import boto3, pytest
+
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+from cardimg_common import batch_status
+from cardimg_common.batch_status import record_status_changes, register_uris
+
+TEST_BATCH_ID = "some-batch-id"
+
+@mock_aws
+def test_status_changes_update_uri_items_and_counters(batch_status_table):
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    put_pending_batch(dynamodb, ["https://scryfall.com/card/mmq/77/embargo", "https://scryfall.com/card/mh3/45/thraben-charm"])
+
+    write_count = record_status_changes(dynamodb, TEST_BATCH_ID, {
+        "https://scryfall.com/card/mmq/77/embargo": "SUCCESS",
+        "https://scryfall.com/card/mh3/45/thraben-charm": "RETRYING",
+        "https://scryfall.com/card/not/in/batch": "SUCCESS",
+    })
+    # A redelivered message reporting the same status again changes nothing
+    redelivered_write_count = record_status_changes(dynamodb, TEST_BATCH_ID, {
+        "https://scryfall.com/card/mmq/77/embargo": "SUCCESS",
+    })
+
+    assert write_count == 1
+    assert redelivered_write_count == 0
+    summary_item = get_summary_item()
+    assert summary_item['pendingCount'] == 0
+    assert summary_item['successCount'] == 1
+    assert summary_item['retryingCount'] == 1
+
+@mock_aws
+def test_failed_status_write_changes_nothing_until_redelivered(batch_status_table, monkeypatch):
+    """Test that a write that fails leaves the uri and its counter alone, so a redelivery still counts it."""
+    monkeypatch.setattr(batch_status, 'UPDATE_BACKOFF_BASE_SECONDS', 0)
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    put_pending_batch(dynamodb, ["https://scryfall.com/card/mmq/77/embargo"])
+    class ThrottledClient:
+        def __getattr__(self, name):
+            return getattr(dynamodb, name)
+        def transact_write_items(self, **kwargs):
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': ''}}, 'TransactWriteItems')
+
+    with pytest.raises(ClientError):
+        record_status_changes(ThrottledClient(), TEST_BATCH_ID, {"https://scryfall.com/card/mmq/77/embargo": "SUCCESS"})
+    assert get_summary_item()['pendingCount'] == 1
+    record_status_changes(dynamodb, TEST_BATCH_ID, {"https://scryfall.com/card/mmq/77/embargo": "SUCCESS"})
+
+    summary_item = get_summary_item()
+    assert summary_item['pendingCount'] == 0
+    assert summary_item['successCount'] == 1
+
+@mock_aws
+def test_status_changed_meanwhile_is_read_again(batch_status_table, monkeypatch):
+    """Test that a uri another scraper changed between the read and the write is counted from its new status."""
+    monkeypatch.setattr(batch_status, 'UPDATE_BACKOFF_BASE_SECONDS', 0)
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    put_pending_batch(dynamodb, ["https://scryfall.com/card/mmq/77/embargo"])
+    class RacedOnceClient:
+        raced = False
+        def __getattr__(self, name):
+            return getattr(dynamodb, name)
+        def transact_write_items(self, **kwargs):
+            if not self.raced:
+                self.raced = True
+                record_status_changes(dynamodb, TEST_BATCH_ID, {"https://scryfall.com/card/mmq/77/embargo": "RETRYING"})
+            return dynamodb.transact_write_items(**kwargs)
+
+    write_count = record_status_changes(RacedOnceClient(), TEST_BATCH_ID, {"https://scryfall.com/card/mmq/77/embargo": "SUCCESS"})
+
+    assert write_count == 2
+    summary_item = get_summary_item()
+    assert (summary_item['pendingCount'], summary_item['retryingCount'], summary_item['successCount']) == (0, 0, 1)
+
+def test_other_errors_are_not_retried():
+    class ValidationErrorClient:
+        call_count = 0
+        def batch_get_item(self, RequestItems):
+            return {'Responses': {'CardImgBatchStatus': [
+                {'itemKey': {'S': "URI#https://scryfall.com/card/mmq/77/embargo"}, 'status': {'S': 'PENDING'}}
+            ]}}
+        def transact_write_items(self, **kwargs):
+            self.call_count += 1
+            raise ClientError({'Error': {'Code': 'ValidationException', 'Message': ''}}, 'TransactWriteItems')
+    client = ValidationErrorClient()
+    with pytest.raises(ClientError):
+        record_status_changes(client, TEST_BATCH_ID, {"https://scryfall.com/card/mmq/77/embargo": "SUCCESS"})
+    assert client.call_count == 1
+
+@mock_aws
+def test_registered_uris_counted_once(batch_status_table):
+    """Test that registering uris a resumed ingestion already registered doesn't count them again."""
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    put_pending_batch(dynamodb, ["https://scryfall.com/card/mmq/77/embargo"])
+
+    register_uris(dynamodb, TEST_BATCH_ID, ["https://scryfall.com/card/mmq/77/embargo", "https://scryfall.com/card/mh3/45/thraben-charm"])
+
+    summary_item = get_summary_item()
+    assert summary_item['pendingCount'] == 2
+    assert summary_item['totalCount'] == 1
+
+def get_summary_item() -> dict:
+    return boto3.resource('dynamodb', region_name='us-east-1').Table('CardImgBatchStatus') \
+        .get_item(Key={'batchId': TEST_BATCH_ID, 'itemKey': '#SUMMARY'})['Item']
+
+def put_pending_batch(dynamodb, cardpage_uris:list[str]):
+    dynamodb.put_item(TableName='CardImgBatchStatus', Item={
+        'batchId': {'S': TEST_BATCH_ID},
+        'itemKey': {'S': '#SUMMARY'},
+        'pendingCount': {'N': str(len(cardpage_uris))},
+    })
+    for uri in cardpage_uris:
+        dynamodb.put_item(TableName='CardImgBatchStatus', Item={
+            'batchId': {'S': TEST_BATCH_ID},
+            'itemKey': {'S': 'URI#' + uri},
+            'cardpageUri': {'S': uri},
+            'status': {'S': 'PENDING'},
+        })
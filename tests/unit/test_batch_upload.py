@@ -0,0 +1,155 @@
+import boto3, json, os, pytest, time
+
+from moto import mock_aws
+
+# Every test here adds a batch
+pytestmark = pytest.mark.usefixtures("batch_status_table")
+
+class FakeLambdaContext:
+    """Runs out of time once remaining_millis (one value per call, the last one repeating) says so."""
+    function_name = "CardImgIngestBatchUpload"
+    def __init__(self, remaining_millis:list[int]):
+        self.remaining_millis = remaining_millis
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_millis.pop(0) if len(self.remaining_millis) > 1 else self.remaining_millis[0]
+
+@mock_aws
+def test_uploaded_batch_ingested_in_resumable_chunks(monkeypatch):
+    """Test that an uploaded csv stopped partway through is resumed by a continuation, queueing every row once."""
+    set_env_vars_and_aws_resources()
+    from cardimg_batch_upload import app as cardimg_batch_upload_app
+    monkeypatch.setattr(cardimg_batch_upload_app, 'ENQUEUE_CHUNK_ROWS', 7)
+    upload_key = start_batch_upload(cardimg_batch_upload_app, monkeypatch)
+    cardpage_uris = [f"https://scryfall.com/card/mmq/{i}/embargo" for i in range(30)]
+    # A byte order mark, and a repeated uri in a different invocation than its first appearance
+    put_upload(upload_key, "﻿Card Page URI\r\n" + "\r\n".join(cardpage_uris + cardpage_uris[:1]) + "\r\n")
+    continuations = []
+    monkeypatch.setattr(cardimg_batch_upload_app.lambda_client, 'invoke',
+                        lambda **invoke_kwargs: continuations.append(json.loads(invoke_kwargs['Payload'])))
+
+    # Validation takes 5 chunks and queueing another 5. Time (checked once for the lease, then
+    # after each chunk) runs out after the second chunk is queued.
+    cardimg_batch_upload_app.ingest_upload_handler(
+        make_s3_event(upload_key), FakeLambdaContext([900000] * 7 + [30000])
+    )
+    batch_id = upload_key.removeprefix("uploads/").removesuffix(".csv")
+    assert get_summary_item(batch_id)['ingestStatus']['S'] == "QUEUEING"
+    assert get_summary_item(batch_id)['ingestedRows']['N'] == "14"
+    assert continuations == [{"batchUploadContinuation": {"bucket": "test-batch-uploads", "key": upload_key}}]
+    cardimg_batch_upload_app.ingest_upload_handler(continuations[0], FakeLambdaContext([900000]))
+
+    summary_item = get_summary_item(batch_id)
+    assert summary_item['ingestStatus']['S'] == "QUEUED"
+    assert summary_item['totalCount']['N'] == summary_item['pendingCount']['N'] == "30"
+    queued_bodies = receive_all_messages()
+    assert sorted(body['itemFromBatch']['Card Page URI'] for body in queued_bodies) \
+        == sorted(cardpage_uris + cardpage_uris[:1])
+    assert len(continuations) == 1
+    # A redelivered S3 event doesn't ingest the batch again
+    cardimg_batch_upload_app.ingest_upload_handler(make_s3_event(upload_key), FakeLambdaContext([900000]))
+    assert receive_all_messages() == []
+
+@mock_aws
+def test_uploaded_batch_with_bad_rows_rejected(monkeypatch):
+    """Test that an uploaded csv with invalid rows queues nothing, and its errors show in the batch's status."""
+    set_env_vars_and_aws_resources()
+    from cardimg_batch_upload import app as cardimg_batch_upload_app
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+    upload_key = start_batch_upload(cardimg_batch_upload_app, monkeypatch)
+    put_upload(upload_key, "Card Page URI\nhttps://scryfall.com/card/mmq/1/embargo\nhttps://example.com/card/1\n")
+
+    cardimg_batch_upload_app.ingest_upload_handler(make_s3_event(upload_key), FakeLambdaContext([900000]))
+
+    batch_id = upload_key.removeprefix("uploads/").removesuffix(".csv")
+    response = cardimg_view_batch_status_app.lambda_handler(
+        {'pathParameters': {'batchId': batch_id}, 'queryStringParameters': {'summary': 'true'}}, {}
+    )
+    assert json.loads(response['body'])['ingest'] == {
+        "status": "REJECTED",
+        "processedRows": 2,
+        "errors": {"singleRowErrors": {"3": ["uri not in approved domains"]}, "singleRowErrorCount": 1},
+    }
+    assert receive_all_messages() == []
+
+@mock_aws
+def test_ingestion_turned_away_while_lease_held(monkeypatch):
+    """Test that an ingestion that finds another invocation's unexpired lease on the batch leaves it alone."""
+    set_env_vars_and_aws_resources()
+    from cardimg_batch_upload import app as cardimg_batch_upload_app
+    upload_key = start_batch_upload(cardimg_batch_upload_app, monkeypatch)
+    put_upload(upload_key, "Card Page URI\nhttps://scryfall.com/card/mmq/1/embargo\n")
+    batch_id = upload_key.removeprefix("uploads/").removesuffix(".csv")
+    set_ingest_lease_expiry(batch_id, time.time() + 600)
+
+    cardimg_batch_upload_app.ingest_upload_handler(make_s3_event(upload_key), FakeLambdaContext([900000]))
+
+    assert get_summary_item(batch_id)['ingestStatus']['S'] == "AWAITING_UPLOAD"
+    assert receive_all_messages() == []
+
+@mock_aws
+def test_expired_lease_taken_over(monkeypatch):
+    """Test that an ingestion takes over a lease that expired (e.g. its holder timed out), and ingests the batch."""
+    set_env_vars_and_aws_resources()
+    from cardimg_batch_upload import app as cardimg_batch_upload_app
+    upload_key = start_batch_upload(cardimg_batch_upload_app, monkeypatch)
+    put_upload(upload_key, "Card Page URI\nhttps://scryfall.com/card/mmq/1/embargo\n")
+    batch_id = upload_key.removeprefix("uploads/").removesuffix(".csv")
+    set_ingest_lease_expiry(batch_id, time.time() - 1)
+
+    cardimg_batch_upload_app.ingest_upload_handler(make_s3_event(upload_key), FakeLambdaContext([900000]))
+
+    assert get_summary_item(batch_id)['ingestStatus']['S'] == "QUEUED"
+    assert [body['itemFromBatch']['Card Page URI'] for body in receive_all_messages()] \
+        == ["https://scryfall.com/card/mmq/1/embargo"]
+
+def set_ingest_lease_expiry(batch_id:str, lease_expires_at:float):
+    """Stands in for another invocation holding (or having held) the lease on the batch's ingestion."""
+    boto3.client('dynamodb', region_name='us-east-1').update_item(
+        TableName='CardImgBatchStatus', Key={'batchId': {'S': batch_id}, 'itemKey': {'S': "#SUMMARY"}},
+        UpdateExpression="SET ingestLeaseExpiresAt = :lease_expires_at",
+        ExpressionAttributeValues={':lease_expires_at': {'N': str(lease_expires_at)}}
+    )
+
+def start_batch_upload(cardimg_batch_upload_app, monkeypatch) -> str:
+    """Requests a presigned upload url, and returns the key it uploads to. Rows are queued onto testpriorityq."""
+    boto3.client('s3', region_name='us-east-1').create_bucket(Bucket="test-batch-uploads")
+    monkeypatch.setattr(cardimg_batch_upload_app, 'BATCH_UPLOAD_BUCKET', "test-batch-uploads")
+    monkeypatch.setattr(cardimg_batch_upload_app, 'PRIORITY_FETCH_QUEUE',
+                        boto3.client('sqs', region_name='us-east-1').get_queue_url(QueueName='testpriorityq')['QueueUrl'])
+    response = cardimg_batch_upload_app.request_upload_handler({"queryStringParameters": None}, {})
+    assert response['statusCode'] == 201
+    response_body = json.loads(response['body'])
+    upload_key = f"uploads/{response_body['batchId']}.csv"
+    assert f"/{upload_key}?" in response_body['uploadUrl']
+    assert get_summary_item(response_body['batchId'])['ingestStatus']['S'] == "AWAITING_UPLOAD"
+    return upload_key
+
+def put_upload(upload_key:str, csv_text:str):
+    boto3.client('s3', region_name='us-east-1').put_object(
+        Bucket="test-batch-uploads", Key=upload_key, Body=csv_text.encode(), ContentType="text/csv"
+    )
+
+def make_s3_event(upload_key:str) -> dict:
+    return {"Records": [{"s3": {"bucket": {"name": "test-batch-uploads"}, "object": {"key": upload_key}}}]}
+
+def get_summary_item(batch_id:str) -> dict:
+    return boto3.client('dynamodb', region_name='us-east-1').get_item(
+        TableName='CardImgBatchStatus', Key={'batchId': {'S': batch_id}, 'itemKey': {'S': "#SUMMARY"}}
+    )['Item']
+
+def receive_all_messages() -> list[dict]:
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    queue_url = sqs.get_queue_url(QueueName='testpriorityq')['QueueUrl']
+    bodies = []
+    while messages := sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages'):
+        bodies.extend(json.loads(message['Body']) for message in messages)
+        sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': message['MessageId'], 'ReceiptHandle': message['ReceiptHandle']} for message in messages
+        ])
+    return bodies
+
+def set_env_vars_and_aws_resources():
+    os.environ['APPROVED_DOMAINS_TO_CARDIMG_SELECTORS'] = '{"scryfall.com": "card", "pkmncards.com": "card-image"}'
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    # Only ingestion queues anything, and only onto the priority queue
+    sqs.create_queue(QueueName='testpriorityq')
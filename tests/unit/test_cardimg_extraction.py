@@ -0,0 +1,63 @@
+import pytest
+
+from cardimg_common.cardimg_extraction import get_extractor_factory, largest_srcset_candidate
+
+CARDPAGE_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta property="og:title" content="Machoke">
+    <meta property="og:image" content="https://pkmncards.com/wp-content/uploads/machoke-og.jpg">
+</head>
+<body>
+    <img class="site-logo" src="/logo.png">
+    <img class="card-image wp-post-image" src="https://pkmncards.com/wp-content/uploads/machoke-300.jpg"
+         srcset="https://pkmncards.com/wp-content/uploads/machoke-300.jpg 300w,
+                 https://pkmncards.com/wp-content/uploads/machoke-734.jpg 734w,
+                 https://pkmncards.com/wp-content/uploads/machoke-600.jpg 600w"/>
+    <img class="card-image" src="https://pkmncards.com/wp-content/uploads/other-card.jpg">
+</body>
+</html>
+"""
+
+@pytest.mark.parametrize(
+        "domain_config, expected_uri",
+        [
+            pytest.param("card-image", "https://pkmncards.com/wp-content/uploads/machoke-300.jpg", id="plain_selector"),
+            pytest.param({"selector": "card-image", "extractor": "img"},
+                         "https://pkmncards.com/wp-content/uploads/machoke-300.jpg", id="img"),
+            pytest.param({"selector": "card-image", "extractor": "srcset"},
+                         "https://pkmncards.com/wp-content/uploads/machoke-734.jpg", id="srcset"),
+            pytest.param({"extractor": "og:image"},
+                         "https://pkmncards.com/wp-content/uploads/machoke-og.jpg", id="og_image"),
+            pytest.param("card", None, id="no_match"),
+        ]
+    )
+def test_extractors(domain_config, expected_uri):
+    make_extractor = get_extractor_factory(domain_config)
+    assert make_extractor().extract([CARDPAGE_HTML]) == expected_uri
+
+def test_extraction_stops_at_first_matching_chunk():
+    chunks_read = []
+    def html_chunks():
+        for i in range(0, len(CARDPAGE_HTML), 64):
+            chunks_read.append(i)
+            yield CARDPAGE_HTML[i:i + 64]
+    make_extractor = get_extractor_factory({"extractor": "og:image"})
+    assert make_extractor().extract(html_chunks()) is not None
+    assert len(chunks_read) < len(CARDPAGE_HTML) / 64 / 2
+
+def test_unknown_extractor():
+    with pytest.raises(ValueError):
+        get_extractor_factory({"selector": "card", "extractor": "xpath"})
+
+@pytest.mark.parametrize(
+        "srcset, expected_uri",
+        [
+            pytest.param("a.jpg 1x, b.jpg 2x", "b.jpg", id="density"),
+            pytest.param("a.jpg, b.jpg 0.5x", "a.jpg", id="implicit_1x"),
+            pytest.param("a.jpg 640w, b.jpg 320w", "a.jpg", id="width"),
+            pytest.param(" , ", None, id="empty"),
+        ]
+    )
+def test_largest_srcset_candidate(srcset, expected_uri):
+    assert largest_srcset_candidate(srcset) == expected_uri
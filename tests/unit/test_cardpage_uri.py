@@ -0,0 +1,30 @@
+import pytest
+
+from cardimg_common.cardpage_uri import ApprovedDomainIndex, canonicalize_cardpage_uri
+
+@pytest.mark.parametrize(
+        "cardpage_uri_text, expected_uri",
+        [
+            pytest.param("https://scryfall.com/card/mmq/77/embargo", "https://scryfall.com/card/mmq/77/embargo", id="already_canonical"),
+            pytest.param("HTTPS://WWW.Scryfall.com/card/mmq/77/embargo", "https://scryfall.com/card/mmq/77/embargo", id="case_and_www"),
+            pytest.param("https://pkmncards.com/card/ampharos-neo-genesis-n1-1/", "https://pkmncards.com/card/ampharos-neo-genesis-n1-1", id="trailing_slash"),
+            pytest.param("https://scryfall.com/card/mmq/77/embargo?utm_source=x#top", "https://scryfall.com/card/mmq/77/embargo", id="query_and_fragment"),
+        ]
+    )
+def test_canonicalize_cardpage_uri(cardpage_uri_text, expected_uri):
+    assert canonicalize_cardpage_uri(cardpage_uri_text).geturl() == expected_uri
+
+@pytest.mark.parametrize(
+        "host, expected_domain",
+        [
+            pytest.param("scryfall.com", "scryfall.com", id="exact"),
+            pytest.param("WWW.Scryfall.com", "scryfall.com", id="www_and_case"),
+            pytest.param("cards.scryfall.com", "scryfall.com", id="subdomain"),
+            pytest.param("notscryfall.com", None, id="suffix_but_not_subdomain"),
+            pytest.param("scryfall.com.evil.net", None, id="approved_domain_as_prefix"),
+            pytest.param("com", None, id="tld_only"),
+        ]
+    )
+def test_approved_domain_index(host, expected_domain):
+    approved_domains = ApprovedDomainIndex(["scryfall.com", "pkmncards.com"])
+    assert approved_domains.match(host) == expected_domain
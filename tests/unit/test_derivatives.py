@@ -0,0 +1,82 @@
+import io, pytest, threading
+
+Image = pytest.importorskip("PIL.Image")
+
+from cardimg_common import derivatives
+from cardimg_common.derivatives import DerivativeSpec, make_derivative, parse_derivative_specs
+
+@pytest.mark.parametrize("image_format", ["webp", "avif", "jpeg", "png"])
+def test_derivative_scaled_to_width(image_format):
+    """Test that a derivative is scaled down to its width, keeping the aspect ratio, in its format."""
+    spec = parse_derivative_specs([{"width": 146, "format": image_format}])[0]
+
+    derivative_bytes, width, height = make_derivative(make_image_file(745, 1040), spec)
+
+    assert (width, height) == (146, 204)
+    with Image.open(io.BytesIO(derivative_bytes)) as derivative:
+        assert derivative.size == (146, 204)
+        assert derivative.format == image_format.upper()
+
+def test_small_images_not_scaled_up():
+    """Test that an image narrower than the derivative keeps its own size."""
+    derivative_bytes, width, height = make_derivative(make_image_file(100, 140), DerivativeSpec(488, "webp"))
+    assert (width, height) == (100, 140)
+
+def test_transparency_kept_unless_jpeg():
+    """Test that a transparent png keeps its alpha channel, except as a jpeg."""
+    img_file = make_image_file(300, 420, mode="RGBA", image_format="PNG")
+    webp_bytes, _, _ = make_derivative(img_file, DerivativeSpec(146, "webp"))
+    jpeg_bytes, _, _ = make_derivative(img_file, DerivativeSpec(146, "jpeg"))
+    assert Image.open(io.BytesIO(webp_bytes)).mode == "RGBA"
+    assert Image.open(io.BytesIO(jpeg_bytes)).mode == "RGB"
+
+def test_images_over_memory_budget_not_decoded(monkeypatch):
+    """Test that a png (which can't be drafted smaller) whose pixels don't fit the budget is refused."""
+    monkeypatch.setattr(derivatives, 'MAX_SOURCE_PIXELS', 300 * 420 - 1)
+    with pytest.raises(ValueError):
+        make_derivative(make_image_file(300, 420, image_format="PNG"), DerivativeSpec(146, "webp"))
+
+def test_one_image_decoded_at_a_time(monkeypatch):
+    """Test that concurrent derivatives are made one after another."""
+    decoding_count = 0
+    max_decoding_count = 0
+    original_exif_transpose = derivatives._import_pillow().ImageOps.exif_transpose
+    def counting_exif_transpose(image):
+        nonlocal decoding_count, max_decoding_count
+        decoding_count += 1
+        max_decoding_count = max(max_decoding_count, decoding_count)
+        threading.Event().wait(.05)
+        decoding_count -= 1
+        return original_exif_transpose(image)
+    monkeypatch.setattr(derivatives._import_pillow().ImageOps, 'exif_transpose', counting_exif_transpose)
+
+    threads = [
+        threading.Thread(target=make_derivative, args=(make_image_file(300, 420), DerivativeSpec(146, "webp")))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_decoding_count == 1
+
+def test_derivative_keys_next_to_original():
+    """Test that derivatives are named by width and format, next to their original."""
+    assert DerivativeSpec(146, "webp").get_key("sha256/abc123.jpg") == "sha256/abc123-146w.webp"
+    assert DerivativeSpec(488, "jpeg").get_key("sha256/abc123.png") == "sha256/abc123-488w.jpg"
+
+@pytest.mark.parametrize("derivative_config", [
+    {"width": 0},
+    {"width": "146"},
+    {"width": 146, "format": "heic"},
+])
+def test_invalid_derivative_specs(derivative_config):
+    """Test that a bad width or an unknown format is refused."""
+    with pytest.raises(ValueError):
+        parse_derivative_specs([derivative_config])
+
+def make_image_file(width:int, height:int, mode:str="RGB", image_format:str="JPEG") -> io.BytesIO:
+    img_file = io.BytesIO()
+    Image.new(mode, (width, height), (200, 30, 30, 128)[:len(mode)]).save(img_file, image_format)
+    return img_file
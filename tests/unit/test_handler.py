@@ -1,7 +1,9 @@
-import boto3, time, os, pytest
+import boto3, json, os, pytest
 
 from moto import mock_aws
-from moto.core.models import patch_client, patch_resource
+
+# Every test here adds a batch
+pytestmark = pytest.mark.usefixtures("batch_status_table")
 
 @mock_aws
 @pytest.mark.parametrize(
@@ -12,8 +14,6 @@ def test_payload_errors(load_event, event_file, expected_status):
     """Test that all error cases return appropriate status codes."""
     set_env_vars_and_aws_resources()
     from cardimg_add_batch import app as cardimg_add_batch_app
-    patch_client(cardimg_add_batch_app.sqs)
-    patch_resource(cardimg_add_batch_app.dynamodb)
     event = load_event(event_file)
     response = cardimg_add_batch_app.lambda_handler(event, {})
     assert response['statusCode'] == expected_status
@@ -31,29 +31,143 @@ def test_valid_csvs(load_event, event_file, expected_status):
     response = cardimg_add_batch_app.lambda_handler(event, {})
     assert response['statusCode'] == expected_status
 
+@mock_aws
+@pytest.mark.parametrize("body, expected_error", [
+    pytest.param("", "CSV is empty", id="empty_body"),
+    pytest.param("Card Page URL\nhttps://scryfall.com/card/mmq/1/embargo", "CSV headers missing or malformed", id="wrong_header"),
+])
+def test_header_errors_match_uploads(body, expected_error):
+    """Test that a bad header gets the same error inline as it does in a batch uploaded to S3."""
+    set_env_vars_and_aws_resources()
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    response = cardimg_add_batch_app.lambda_handler({"body": body}, {})
+    assert response['statusCode'] == 400
+    assert json.loads(response['body']) == {"bodyErrors": expected_error}
+
 def set_env_vars_and_aws_resources():
     os.environ['APPROVED_DOMAINS_TO_CARDIMG_SELECTORS'] = '{"scryfall.com": "card", "pkmncards.com": "card-image"}'
     sqs = boto3.client('sqs', region_name='us-east-1')
     queue_url = sqs.create_queue(QueueName='testq')['QueueUrl']
     os.environ['CARD_IMG_FETCH_QUEUE'] = queue_url
-    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
-    dynamodb.create_table( # type:ignore[reportAttributeAccessIssue]
-        TableName='CardImgBatchStatus',
-        KeySchema=[
-            { 'AttributeName': 'batchId', 'KeyType': 'HASH' }
-        ],
-        AttributeDefinitions=[
-            { 'AttributeName': 'batchId', 'AttributeType': 'S' }
-        ],
-        BillingMode='PAY_PER_REQUEST'
-    )
-    table_is_active = False
-    for _ in range(10):
-        table_description = dynamodb.describe_table(TableName='CardImgBatchStatus')
-        table_is_active = table_description['Table']['TableStatus'] == 'ACTIVE'
-        if table_is_active:
-            break
-        time.sleep(.05)
-    if not table_is_active:
-        raise Exception("CardImgBatchStatus table never activated during setup")
+    # Small batches go onto the priority queue; tests of the two lanes patch in a queue of its own
+    os.environ['PRIORITY_FETCH_QUEUE'] = queue_url
     
+
+@mock_aws
+def test_large_csv_enqueued_in_chunks(monkeypatch):
+    """Test that a csv spanning several enqueue chunks is fully registered in dynamo and queued."""
+    set_env_vars_and_aws_resources()
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    monkeypatch.setattr(cardimg_add_batch_app, 'ENQUEUE_CHUNK_ROWS', 7)
+    cardpage_uris = [f"https://scryfall.com/card/mmq/{i}/embargo" for i in range(30)]
+    # A repeated uri, in a different chunk than its first appearance
+    event = {"body": "Card Page URI\n" + "\n".join(cardpage_uris + cardpage_uris[:1])}
+    response = cardimg_add_batch_app.lambda_handler(event, {})
+    assert response['statusCode'] == 202
+    batch_id = json.loads(response['body'])['batchId']
+    batch_status_items = boto3.resource('dynamodb', region_name='us-east-1') \
+        .Table('CardImgBatchStatus').query(
+            KeyConditionExpression='batchId = :batch_id',
+            ExpressionAttributeValues={':batch_id': batch_id}
+        )['Items']
+    summary_item, uri_items = batch_status_items[0], batch_status_items[1:]
+    assert summary_item['totalCount'] == summary_item['pendingCount'] == 30
+    assert {item['cardpageUri']: item['status'] for item in uri_items} \
+        == {uri: "PENDING" for uri in cardpage_uris}
+
+@mock_aws
+def test_csv_rows_counted_once(capsys):
+    """Test that the body's rows are counted once, though they're parsed to validate them and again to queue them."""
+    set_env_vars_and_aws_resources()
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    event = {"body": "Card Page URI\n" + "\n".join(f"https://scryfall.com/card/mmq/{i}/embargo" for i in range(3))}
+    response = cardimg_add_batch_app.lambda_handler(event, {})
+    assert response['statusCode'] == 202
+    emf = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')][-1]
+    assert emf['csvRows'] == 3
+
+@mock_aws
+def test_refresh_batches_flag_their_messages():
+    """Test that ?refresh=true marks every queued message as a refresh."""
+    set_env_vars_and_aws_resources()
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    event = {
+        "body": "Card Page URI\nhttps://scryfall.com/card/mmq/1/embargo",
+        "queryStringParameters": {"refresh": "true"},
+    }
+    response = cardimg_add_batch_app.lambda_handler(event, {})
+    assert response['statusCode'] == 202
+    messages = boto3.client('sqs', region_name='us-east-1').receive_message(
+        QueueUrl=os.environ['CARD_IMG_FETCH_QUEUE'], MaxNumberOfMessages=10
+    )['Messages']
+    assert [json.loads(message['Body'])['refresh'] for message in messages] == [True]
+
+def receive_all_messages(queue_url:str|None=None) -> list[dict]:
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    queue_url = queue_url or os.environ['CARD_IMG_FETCH_QUEUE']
+    bodies = []
+    while messages := sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages'):
+        bodies.extend(json.loads(message['Body']) for message in messages)
+        sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': message['MessageId'], 'ReceiptHandle': message['ReceiptHandle']} for message in messages
+        ])
+    return bodies
+
+@mock_aws
+def test_big_batches_trickled_round_robin(monkeypatch):
+    """Test that small batches go straight to the priority queue, and big ones share the bulk queue evenly."""
+    set_env_vars_and_aws_resources()
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    from cardimg_schedule_fetches import app as cardimg_schedule_fetches_app
+    priority_queue_url = boto3.client('sqs', region_name='us-east-1').create_queue(QueueName='testpriorityq')['QueueUrl']
+    monkeypatch.setattr(cardimg_add_batch_app, 'PRIORITY_FETCH_QUEUE', priority_queue_url)
+    monkeypatch.setattr(cardimg_add_batch_app, 'PRIORITY_BATCH_MAX_ROWS', 5)
+    monkeypatch.setattr(cardimg_schedule_fetches_app, 'BULK_QUEUE_TARGET_DEPTH', 20)
+    batch_ids = {}
+    for (name, row_count) in [("big", 30), ("bigger", 40), ("small", 5)]:
+        event = {"body": "Card Page URI\n" + "\n".join(
+            f"https://scryfall.com/card/{name}/{i}/embargo" for i in range(row_count)
+        )}
+        response = cardimg_add_batch_app.lambda_handler(event, {})
+        assert response['statusCode'] == 202
+        batch_ids[name] = json.loads(response['body'])['batchId']
+
+    assert count_by_batch(receive_all_messages(priority_queue_url), batch_ids) == {"small": 5}
+    assert receive_all_messages() == []
+
+    first_run = cardimg_schedule_fetches_app.lambda_handler({}, {})
+    assert first_run == {"queuedRows": 20, "scheduledBatches": 2}
+    # The queue is full until the scraper catches up
+    assert cardimg_schedule_fetches_app.lambda_handler({}, {})["queuedRows"] == 0
+    assert count_by_batch(receive_all_messages(), batch_ids) == {"big": 10, "bigger": 10}
+
+    queued_uris = []
+    while cardimg_schedule_fetches_app.lambda_handler({}, {})["queuedRows"]:
+        queued_uris.extend(body['itemFromBatch']['Card Page URI'] for body in receive_all_messages())
+    assert len(queued_uris) == len(set(queued_uris)) == 50
+    assert cardimg_schedule_fetches_app.get_scheduled_batches() == []
+
+def count_by_batch(bodies:list[dict], batch_ids:dict[str, str]) -> dict[str, int]:
+    names_by_batch_id = {batch_id: name for (name, batch_id) in batch_ids.items()}
+    counts = {}
+    for body in bodies:
+        name = names_by_batch_id[body['batchId']]
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+@mock_aws
+def test_scheduled_batches_queue_whole_rows(monkeypatch):
+    """Test that the fetch scheduler queues a big batch's rows with all their columns, once per uri."""
+    set_env_vars_and_aws_resources()
+    from cardimg_add_batch import app as cardimg_add_batch_app
+    from cardimg_schedule_fetches import app as cardimg_schedule_fetches_app
+    monkeypatch.setattr(cardimg_add_batch_app, 'PRIORITY_BATCH_MAX_ROWS', 1)
+    event = {"body": "Card Name,Card Page URI\n"
+             "Embargo,https://scryfall.com/card/mmq/1/embargo\n"
+             "Thraben Charm,https://scryfall.com/card/mh3/45/thraben-charm\n"
+             "Embargo again,https://scryfall.com/card/mmq/1/embargo"}
+    response = cardimg_add_batch_app.lambda_handler(event, {})
+    assert response['statusCode'] == 202
+    assert cardimg_schedule_fetches_app.lambda_handler({}, {})["queuedRows"] == 2
+    assert sorted(body['itemFromBatch']['Card Name'] for body in receive_all_messages()) \
+        == ["Embargo", "Thraben Charm"]
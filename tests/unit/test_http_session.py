@@ -0,0 +1,59 @@
+import pytest, requests, threading, time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cardimg_common.http_session import ScraperSession
+
+class CardPageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(.5)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = b"<html></html>"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def card_site():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CardPageHandler)
+    server.statuses = []
+    server.handle_error = lambda request, client_address: None # e.g. the client timed out
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_connections_are_reused(card_site):
+    session = ScraperSession(pool_maxsize=2)
+    for i in range(4):
+        assert session.get(f"http://127.0.0.1:{card_site.server_port}/card/{i}").status_code == 200
+    stats = session.get_stats(reset=True)
+    assert stats['requests'] == 4
+    assert stats['newConnections'] == 1
+    assert stats['connectionReuseRate'] == .75
+    # Counts start over after a reset, as they do between invocations
+    session.get(f"http://127.0.0.1:{card_site.server_port}/card/5")
+    assert session.get_stats()['newConnections'] == 0
+
+def test_server_errors_are_retried(card_site):
+    card_site.statuses = [502, 500]
+    session = ScraperSession(pool_maxsize=1, max_retries=2)
+    assert session.get(f"http://127.0.0.1:{card_site.server_port}/card/1").status_code == 200
+
+def test_throttled_responses_are_not_retried(card_site):
+    card_site.statuses = [429]
+    session = ScraperSession(pool_maxsize=1)
+    assert session.get(f"http://127.0.0.1:{card_site.server_port}/card/1").status_code == 429
+
+def test_hung_server_times_out(card_site):
+    session = ScraperSession(pool_maxsize=1, read_timeout=.1, max_retries=0)
+    start = time.perf_counter()
+    # Surfaces as a ConnectionError wrapping the read timeout, since retries are configured
+    with pytest.raises(requests.RequestException, match="Read timed out"):
+        session.get(f"http://127.0.0.1:{card_site.server_port}/slow")
+    assert time.perf_counter() - start < .5
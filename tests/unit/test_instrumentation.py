@@ -0,0 +1,78 @@
+import json, pytest, types
+
+from cardimg_common import instrumentation
+from cardimg_common.instrumentation import (
+    instrumented_handler, log_event_sample, record_value, span, timed_iter
+)
+
+@pytest.fixture
+def instrumentation_time(clock, monkeypatch):
+    """Makes instrumentation read the clock fixture."""
+    monkeypatch.setattr(instrumentation, 'time', types.SimpleNamespace(perf_counter=clock, time=lambda: 1700000000.))
+
+def test_nested_spans_counted_once(clock, instrumentation_time, capsys):
+    """Test that time in a nested span or timed iterator isn't also counted in the span around it."""
+    @instrumented_handler("test_service")
+    def lambda_handler(event, context):
+        with span('htmlParse'):
+            clock.now += .010
+            for _ in timed_iter(make_slow_chunks(clock, 3, .100), 'pageFetch'):
+                clock.now += .001
+        with span('s3Put'):
+            clock.now += .020
+        with span('s3Put'):
+            clock.now += .030
+
+    lambda_handler({}, {})
+
+    emf = get_emf_lines(capsys)[-1]
+    assert (emf['htmlParseMs'], emf['htmlParseCount']) == (13., 1)
+    assert (emf['pageFetchMs'], emf['pageFetchCount']) == (300., 0)
+    assert (emf['s3PutMs'], emf['s3PutCount']) == (50., 2)
+    assert emf['durationMs'] == 363.
+
+def test_metrics_emitted_in_emf(capsys):
+    """Test that every invocation prints one EMF line that declares all of its metrics, even when it raises."""
+    @instrumented_handler("test_service", get_payload_bytes=lambda event: len(event['body']))
+    def lambda_handler(event, context):
+        record_value('records', 2)
+        record_value('records', 1)
+        if event.get('fail'):
+            raise RuntimeError("failed")
+
+    lambda_handler({'body': "12345"}, types.SimpleNamespace(aws_request_id="request-1"))
+    with pytest.raises(RuntimeError):
+        lambda_handler({'body': "", 'fail': True}, {})
+
+    (first_emf, second_emf) = get_emf_lines(capsys)[-2:]
+    directive = first_emf['_aws']['CloudWatchMetrics'][0]
+    assert directive['Dimensions'] == [['Service']]
+    assert all(metric['Name'] in first_emf for metric in directive['Metrics'])
+    assert {metric['Name']: metric['Unit'] for metric in directive['Metrics']}['payloadBytes'] == "Bytes"
+    assert (first_emf['Service'], first_emf['requestId']) == ("test_service", "request-1")
+    assert (first_emf['payloadBytes'], first_emf['records']) == (5, 3)
+    assert second_emf['coldStart'] == 0
+    assert second_emf['payloadBytes'] == 0
+
+def test_spans_outside_invocation_ignored():
+    """Test that code timed outside an instrumented handler (e.g. from a script) still runs."""
+    with span('s3Put'):
+        record_value('records', 1)
+    assert list(timed_iter([1, 2], 'pageFetch')) == [1, 2]
+
+@pytest.mark.parametrize("sample, expected_logged", [(.005, True), (.5, False)])
+def test_event_logging_sampled(capsys, sample, expected_logged):
+    """Test that whole events are only logged for the sampled fraction of invocations."""
+    assert log_event_sample({'Records': []}, sample_rate=.01, sample=lambda: sample) == expected_logged
+    assert ('sampledEvent' in capsys.readouterr().out) == expected_logged
+
+def make_slow_chunks(clock, chunk_count:int, seconds_per_chunk:float):
+    for i in range(chunk_count):
+        clock.now += seconds_per_chunk
+        yield i
+
+def get_emf_lines(capsys) -> list[dict]:
+    return [
+        json.loads(line) for line in capsys.readouterr().out.splitlines()
+        if line.startswith('{"_aws"')
+    ]
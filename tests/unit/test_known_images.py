@@ -0,0 +1,84 @@
+import boto3
+
+from moto import mock_aws
+
+from cardimg_common.known_images import KnownImagesIndex
+
+TEST_BUCKET = "test-card-img-bucket"
+TEST_TABLE = "CardImgKnownImages"
+
+@mock_aws
+def test_lookups_are_batched_and_cached():
+    """Test that a whole batch is looked up in bulk, and known prefixes are then served from memory."""
+    dynamodb, s3 = create_aws_resources()
+    known_prefixes = {f"scryfall.com/card/mmq/{i}/embargo/" for i in range(0, 150, 2)}
+    for s3_prefix in known_prefixes:
+        dynamodb.put_item(TableName=TEST_TABLE, Item={'s3Prefix': {'S': s3_prefix}})
+    all_prefixes = {f"scryfall.com/card/mmq/{i}/embargo/" for i in range(150)}
+    index = KnownImagesIndex(dynamodb, TEST_TABLE, s3, TEST_BUCKET)
+    calls = count_calls(dynamodb, s3)
+
+    assert index.find_known(all_prefixes) == known_prefixes
+    assert calls == {'BatchGetItem': 2}
+    calls.clear()
+    assert index.find_known(known_prefixes) == known_prefixes
+    assert calls == {}
+
+@mock_aws
+def test_cache_entries_expire_and_are_evicted(clock):
+    dynamodb, s3 = create_aws_resources()
+    index = KnownImagesIndex(dynamodb, TEST_TABLE, s3, TEST_BUCKET,
+                             max_entries=2, time_to_live_seconds=60, clock=clock)
+    for s3_prefix in ("a/", "b/", "c/"):
+        index.remember(s3_prefix, s3_prefix + "img.jpg")
+    calls = count_calls(dynamodb, s3)
+
+    # "a/" was evicted to make room for "c/", but is still in the table
+    assert index.find_known(["a/", "b/", "c/"]) == {"a/", "b/", "c/"}
+    assert calls == {'BatchGetItem': 1}
+    calls.clear()
+    clock.now += 61
+    assert index.find_known(["b/", "c/"]) == {"b/", "c/"}
+    assert calls == {'BatchGetItem': 1}
+
+@mock_aws
+def test_without_table_falls_back_to_listing_bucket():
+    dynamodb, s3 = create_aws_resources()
+    s3.put_object(Bucket=TEST_BUCKET, Key="scryfall.com/card/mmq/1/embargo/img.jpg", Body=b"jpg")
+    index = KnownImagesIndex(dynamodb, None, s3, TEST_BUCKET)
+    assert index.find_known(["scryfall.com/card/mmq/1/embargo/", "scryfall.com/card/mmq/2/embargo/"]) \
+        == {"scryfall.com/card/mmq/1/embargo/"}
+
+@mock_aws
+def test_rebuild_from_s3():
+    """Test that rebuilding indexes every card image already in the bucket."""
+    dynamodb, s3 = create_aws_resources()
+    for i in range(30):
+        s3.put_object(Bucket=TEST_BUCKET, Key=f"scryfall.com/card/mmq/{i}/embargo/img.jpg", Body=b"jpg")
+    s3.put_object(Bucket=TEST_BUCKET, Key="README.txt", Body=b"not a card")
+    index = KnownImagesIndex(dynamodb, TEST_TABLE, s3, TEST_BUCKET)
+
+    assert index.rebuild_from_s3() == 30
+    assert KnownImagesIndex(dynamodb, TEST_TABLE, s3, TEST_BUCKET).find_known(
+        [f"scryfall.com/card/mmq/{i}/embargo/" for i in range(31)]
+    ) == {f"scryfall.com/card/mmq/{i}/embargo/" for i in range(30)}
+
+def create_aws_resources():
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    dynamodb.create_table(
+        TableName=TEST_TABLE,
+        KeySchema=[{'AttributeName': 's3Prefix', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 's3Prefix', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket=TEST_BUCKET)
+    return dynamodb, s3
+
+def count_calls(*clients) -> dict[str, int]:
+    calls = {}
+    def count_call(model, **kwargs):
+        calls[model.name] = calls.get(model.name, 0) + 1
+    for client in clients:
+        client.meta.events.register("before-call", count_call)
+    return calls
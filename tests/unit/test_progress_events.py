@@ -0,0 +1,136 @@
+import boto3, json, pytest
+
+from moto import mock_aws
+
+TEST_BATCH_ID = "7bbf9329-bad0-4be6-89e1-0490b99330d6"
+TEST_CARDPAGE_URIS = ["https://scryfall.com/card/mmq/1/embargo", "https://pkmncards.com/card/machoke-1/"]
+
+@mock_aws
+def test_stream_records_become_deltas_since_cursor(batch_status_table, load_event, monkeypatch):
+    """Test that polling returns the changes read from the stream, once, and then nothing new."""
+    set_env_vars_and_aws_resources(batch_status_table, {uri: "PENDING" for uri in TEST_CARDPAGE_URIS})
+    from cardimg_progress_events import app as cardimg_progress_events_app
+    monkeypatch.setattr(cardimg_progress_events_app, 'BATCH_COMPLETED_TOPIC', None)
+    # Only the uris' statuses change, and one is still left to do
+    stream_records = load_event("progressevents/stream-records.json")
+    stream_records['Records'] = stream_records['Records'][:1]
+
+    assert cardimg_progress_events_app.lambda_handler(stream_records, {}) == {"batchItemFailures": []}
+
+    first_poll = poll(cardimg_progress_events_app, {'wait': '0'})
+    assert first_poll['statusCode'] == 200
+    first_body = json.loads(first_poll['body'])
+    assert first_body == {
+        "batchId": TEST_BATCH_ID,
+        "cursor": stream_records['Records'][0]['dynamodb']['SequenceNumber'],
+        "statusChanges": {TEST_CARDPAGE_URIS[0]: "SUCCESS"},
+    }
+    repeat_body = json.loads(poll(cardimg_progress_events_app, {'cursor': first_body['cursor'], 'wait': '0'})['body'])
+    assert repeat_body == {"batchId": TEST_BATCH_ID, "cursor": first_body['cursor'], "statusChanges": {}}
+
+@mock_aws
+def test_batch_completed_notification_published_once(batch_status_table, load_event, monkeypatch):
+    """Test that a batch with nothing left to do is announced, once however often its records are read."""
+    set_env_vars_and_aws_resources(batch_status_table, {uri: "PENDING" for uri in TEST_CARDPAGE_URIS})
+    from cardimg_progress_events import app as cardimg_progress_events_app
+    sns = boto3.client('sns', region_name='us-east-1')
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    topic_arn = sns.create_topic(Name='CardImgBatchCompleted')['TopicArn']
+    queue_url = sqs.create_queue(QueueName='BatchCompletedSubscriber')['QueueUrl']
+    queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    sns.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn, Attributes={'RawMessageDelivery': 'true'})
+    monkeypatch.setattr(cardimg_progress_events_app, 'BATCH_COMPLETED_TOPIC', topic_arn)
+    stream_records = load_event("progressevents/stream-records.json")
+
+    # Redelivered, as after a failed invocation
+    for _ in range(2):
+        assert cardimg_progress_events_app.lambda_handler(stream_records, {}) == {"batchItemFailures": []}
+
+    notifications = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
+    assert len(notifications) == 1
+    notification = json.loads(notifications[0]['Body'])
+    assert notification['batchId'] == TEST_BATCH_ID
+    assert notification['statusCounts'] == {"PENDING": 0, "RETRYING": 0, "SUCCESS": 1, "FAILURE": 1}
+    body = json.loads(poll(cardimg_progress_events_app, {'wait': '0'})['body'])
+    assert body['statusChanges'] == {TEST_CARDPAGE_URIS[0]: "SUCCESS", TEST_CARDPAGE_URIS[1]: "FAILURE"}
+    assert body['summary']['statusCounts'] == notification['statusCounts']
+    assert body['completedAt'] == notification['completedAt']
+    # A complete batch has nothing more to wait for
+    final_body = json.loads(poll(cardimg_progress_events_app, {'cursor': body['cursor'], 'wait': '25'})['body'])
+    assert final_body['statusChanges'] == {}
+    assert final_body['completedAt'] == notification['completedAt']
+
+@mock_aws
+def test_unfinished_ingestion_not_completed(batch_status_table, load_event, monkeypatch):
+    """Test that an uploaded batch isn't complete while its uris are still being queued."""
+    set_env_vars_and_aws_resources(batch_status_table, {uri: "PENDING" for uri in TEST_CARDPAGE_URIS})
+    from cardimg_progress_events import app as cardimg_progress_events_app
+    monkeypatch.setattr(cardimg_progress_events_app, 'BATCH_COMPLETED_TOPIC', None)
+    stream_records = load_event("progressevents/stream-records.json")
+    stream_records['Records'][-1]['dynamodb']['NewImage']['ingestStatus'] = {'S': "QUEUEING"}
+
+    cardimg_progress_events_app.lambda_handler(stream_records, {})
+
+    body = json.loads(poll(cardimg_progress_events_app, {'wait': '0'})['body'])
+    assert body['summary']['ingest'] == {"status": "QUEUEING", "processedRows": 0}
+    assert 'completedAt' not in body
+
+@mock_aws
+def test_unwritable_batch_reported_from_its_first_record(batch_status_table, load_event, monkeypatch):
+    """Test that a batch whose event can't be written is retried from its first stream record."""
+    set_env_vars_and_aws_resources(batch_status_table, {uri: "PENDING" for uri in TEST_CARDPAGE_URIS})
+    from cardimg_progress_events import app as cardimg_progress_events_app
+    monkeypatch.setattr(cardimg_progress_events_app, 'BATCH_COMPLETED_TOPIC', None)
+    def fail_put_item(**kwargs):
+        raise RuntimeError("dynamo is down")
+    monkeypatch.setattr(cardimg_progress_events_app.dynamodb, 'put_item', fail_put_item)
+    stream_records = load_event("progressevents/stream-records.json")
+
+    response = cardimg_progress_events_app.lambda_handler(stream_records, {})
+
+    assert response == {
+        "batchItemFailures": [{"itemIdentifier": stream_records['Records'][0]['dynamodb']['SequenceNumber']}]
+    }
+
+@pytest.mark.parametrize("query_params", [
+    {'cursor': 'abc'},
+    {'cursor': '1' * 41},
+    {'wait': 'forever'},
+    {'wait': '30'},
+])
+@mock_aws
+def test_invalid_poll_parameters(batch_status_table, query_params):
+    """Test that malformed query parameters are a 400."""
+    set_env_vars_and_aws_resources(batch_status_table, {TEST_CARDPAGE_URIS[0]: "PENDING"})
+    from cardimg_progress_events import app as cardimg_progress_events_app
+    assert poll(cardimg_progress_events_app, query_params)['statusCode'] == 400
+
+@mock_aws
+def test_poll_nonexistent_batch(batch_status_table):
+    """Test that polling a batchId with no summary item is a 404."""
+    set_env_vars_and_aws_resources(batch_status_table, {})
+    from cardimg_progress_events import app as cardimg_progress_events_app
+    assert poll(cardimg_progress_events_app, {'wait': '0'})['statusCode'] == 404
+
+def poll(app, query_params:dict[str, str]) -> dict:
+    return app.poll_handler({'pathParameters': {'batchId': TEST_BATCH_ID}, 'queryStringParameters': query_params}, {})
+
+def set_env_vars_and_aws_resources(batch_status_table, statuses_by_uri:dict[str, str]):
+    if not statuses_by_uri:
+        return
+    statuses = list(statuses_by_uri.values())
+    batch_status_table.put_item(Item={
+        "batchId": TEST_BATCH_ID,
+        "itemKey": "#SUMMARY",
+        "totalCount": len(statuses_by_uri),
+        "statusVersion": 1,
+        **{status.lower() + "Count": statuses.count(status)
+           for status in ("PENDING", "RETRYING", "SUCCESS", "FAILURE")},
+    })
+    for (uri, status) in statuses_by_uri.items():
+        batch_status_table.put_item(Item={
+            "batchId": TEST_BATCH_ID,
+            "itemKey": "URI#" + uri,
+            "cardpageUri": uri,
+            "status": status,
+        })
@@ -0,0 +1,57 @@
+import boto3, pytest
+
+from datetime import datetime, UTC
+from moto import mock_aws
+
+from cardimg_common.rate_limit import DynamoTokenBucket, TokenBucket, parse_retry_after
+
+def test_token_bucket_spends_burst_then_paces_requests(clock):
+    bucket = TokenBucket(rate_per_second=10, burst=2, clock=clock, sleep=clock.sleep)
+    acquire_times = []
+    for _ in range(4):
+        bucket.acquire()
+        acquire_times.append(round(clock.now - 1000, 3))
+    assert acquire_times == [0, 0, .1, .2]
+
+def test_token_bucket_pause_delays_next_token(clock):
+    bucket = TokenBucket(rate_per_second=10, burst=5, clock=clock, sleep=clock.sleep)
+    bucket.pause_for(2)
+    bucket.acquire()
+    assert clock.now - 1000 == pytest.approx(2.1)
+
+@mock_aws
+def test_dynamo_token_bucket_shares_budget_between_instances(clock):
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    dynamodb.create_table(
+        TableName='CardImgRateLimits',
+        KeySchema=[{'AttributeName': 'domain', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'domain', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    # Two buckets for the same domain, as if in two different lambda containers
+    buckets = [
+        DynamoTokenBucket(dynamodb, 'CardImgRateLimits', 'scryfall.com', 10, burst=2,
+                          clock=clock, sleep=clock.sleep)
+        for _ in range(2)
+    ]
+    buckets[0].acquire()
+    buckets[1].acquire()
+    assert clock.now == 1000
+    buckets[0].acquire()
+    assert clock.now - 1000 == pytest.approx(.1)
+    buckets[1].pause_for(5)
+    buckets[0].acquire()
+    assert clock.now - 1000 == pytest.approx(5.1)
+
+@pytest.mark.parametrize(
+        "retry_after, expected_seconds",
+        [
+            pytest.param(None, None, id="missing"),
+            pytest.param("3", 3, id="delay_seconds"),
+            pytest.param("Wed, 21 Oct 2015 07:28:30 GMT", 30, id="http_date"),
+            pytest.param("soon", None, id="unreadable"),
+        ]
+    )
+def test_parse_retry_after(retry_after, expected_seconds):
+    now = datetime(2015, 10, 21, 7, 28, 0, tzinfo=UTC)
+    assert parse_retry_after(retry_after, now) == expected_seconds
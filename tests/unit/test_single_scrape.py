@@ -0,0 +1,436 @@
+import boto3, hashlib, io, json, os, requests, threading, time, pytest
+
+from moto import mock_aws
+from urllib.parse import urlparse
+
+TEST_BUCKET = "test-card-img-bucket"
+TEST_BATCH_ID = "7bbf9329-bad0-4be6-89e1-0490b99330d6"
+
+@mock_aws
+def test_records_scraped_concurrently_within_domain_limit(batch_status_table, monkeypatch):
+    """Test that every record is scraped, and no domain sees more than its worker limit at once."""
+    cardpage_uris = \
+        [f"https://scryfall.com/card/mmq/{i}/embargo" for i in range(6)] \
+        + [f"https://pkmncards.com/card/machoke-{i}/" for i in range(6)]
+    set_env_vars_and_aws_resources(batch_status_table, cardpage_uris)
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    monkeypatch.setattr(cardimg_single_scrape_app, 'SCRAPE_MAX_WORKERS', 6)
+
+    lock = threading.Lock()
+    in_flight_by_domain, max_in_flight_by_domain = {}, {}
+    def fake_locate_and_upload_img(parsed_cardpage_uri, make_extractor, rate_limiter, http_session):
+        domain = parsed_cardpage_uri.netloc
+        with lock:
+            in_flight_by_domain[domain] = in_flight_by_domain.get(domain, 0) + 1
+            max_in_flight_by_domain[domain] = \
+                max(max_in_flight_by_domain.get(domain, 0), in_flight_by_domain[domain])
+        time.sleep(.02)
+        with lock:
+            in_flight_by_domain[domain] -= 1
+    monkeypatch.setattr(cardimg_single_scrape_app, 'locate_and_upload_img', fake_locate_and_upload_img)
+
+    response = cardimg_single_scrape_app.lambda_handler(make_sqs_event(cardpage_uris), {})
+
+    assert response == {"batchItemFailures": []}
+    assert max_in_flight_by_domain == {
+        "scryfall.com": cardimg_single_scrape_app.SCRAPE_MAX_WORKERS_PER_DOMAIN,
+        "pkmncards.com": cardimg_single_scrape_app.SCRAPE_MAX_WORKERS_PER_DOMAIN,
+    }
+    assert get_uri_statuses() == {uri: "SUCCESS" for uri in cardpage_uris}
+
+@mock_aws
+@pytest.mark.parametrize(
+        "receive_count, expected_failure_status",
+        [
+            pytest.param(1, "RETRYING", id="first_receive"),
+            pytest.param(3, "FAILURE", id="last_receive"),
+        ]
+    )
+def test_only_failed_records_are_reported(batch_status_table, monkeypatch, receive_count, expected_failure_status):
+    """Test that a failing record is reported back to SQS on its own, without failing the others."""
+    cardpage_uris = [f"https://scryfall.com/card/mmq/{i}/embargo" for i in range(3)]
+    set_env_vars_and_aws_resources(batch_status_table, cardpage_uris)
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    def fake_locate_and_upload_img(parsed_cardpage_uri, make_extractor, rate_limiter, http_session):
+        if parsed_cardpage_uri.path.endswith("/1/embargo"):
+            raise RuntimeError("status code was 500")
+    monkeypatch.setattr(cardimg_single_scrape_app, 'locate_and_upload_img', fake_locate_and_upload_img)
+
+    event = make_sqs_event(cardpage_uris, receive_count)
+    event['Records'].append({"messageId": "malformed", "body": "not json"})
+    response = cardimg_single_scrape_app.lambda_handler(event, {})
+
+    assert sorted(failure['itemIdentifier'] for failure in response['batchItemFailures']) \
+        == ["malformed", "message-1"]
+    assert get_uri_statuses() == {
+        cardpage_uris[0]: "SUCCESS",
+        cardpage_uris[1]: expected_failure_status,
+        cardpage_uris[2]: "SUCCESS",
+    }
+    assert get_status_counts() == {
+        "totalCount": 3,
+        "pendingCount": 0,
+        "retryingCount": 1 if expected_failure_status == "RETRYING" else 0,
+        "successCount": 2,
+        "failureCount": 1 if expected_failure_status == "FAILURE" else 0,
+    }
+
+@mock_aws
+def test_cards_with_known_images_are_skipped(batch_status_table, monkeypatch):
+    """Test that cards already in the bucket aren't scraped, and new uploads are remembered."""
+    cardpage_uris = [f"https://scryfall.com/card/mmq/{i}/embargo" for i in range(3)]
+    set_env_vars_and_aws_resources(batch_status_table, cardpage_uris)
+    boto3.client('s3', region_name='us-east-1').put_object(
+        Bucket=TEST_BUCKET, Key="scryfall.com/card/mmq/0/embargo/img.jpg", Body=b"jpg"
+    )
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    from cardimg_common.known_images import KnownImagesIndex
+    known_images = KnownImagesIndex(None, None, cardimg_single_scrape_app.s3, TEST_BUCKET)
+    monkeypatch.setattr(cardimg_single_scrape_app, 'KNOWN_IMAGES', known_images)
+    scraped_paths = []
+    def fake_locate_and_upload_img(parsed_cardpage_uri, make_extractor, rate_limiter, http_session):
+        scraped_paths.append(parsed_cardpage_uri.path)
+        s3_prefix = cardimg_single_scrape_app.get_s3_prefix_for_cardimg(parsed_cardpage_uri)
+        known_images.remember(s3_prefix, s3_prefix + "img.jpg")
+    monkeypatch.setattr(cardimg_single_scrape_app, 'locate_and_upload_img', fake_locate_and_upload_img)
+
+    response = cardimg_single_scrape_app.lambda_handler(make_sqs_event(cardpage_uris), {})
+
+    assert response == {"batchItemFailures": []}
+    assert sorted(scraped_paths) == ["/card/mmq/1/embargo", "/card/mmq/2/embargo"]
+    assert get_uri_statuses() == {uri: "SUCCESS" for uri in cardpage_uris}
+    assert known_images.find_known(
+        [f"scryfall.com/card/mmq/{i}/embargo/" for i in range(3)]
+    ) == {f"scryfall.com/card/mmq/{i}/embargo/" for i in range(3)}
+
+def make_sqs_event(cardpage_uris:list[str], receive_count:int=1) -> dict:
+    return {
+        "Records": [
+            {
+                "messageId": f"message-{i}",
+                "body": json.dumps({"batchId": TEST_BATCH_ID, "itemFromBatch": {"Card Page URI": uri}}),
+                "attributes": {"ApproximateReceiveCount": str(receive_count)},
+            }
+            for (i, uri) in enumerate(cardpage_uris)
+        ]
+    }
+
+def get_uri_statuses() -> dict:
+    uri_items = boto3.resource('dynamodb', region_name='us-east-1').Table('CardImgBatchStatus').query(
+        KeyConditionExpression='batchId = :batch_id AND begins_with(itemKey, :uri_prefix)',
+        ExpressionAttributeValues={':batch_id': TEST_BATCH_ID, ':uri_prefix': 'URI#'}
+    )['Items']
+    return {item['cardpageUri']: item['status'] for item in uri_items}
+
+def get_status_counts() -> dict:
+    summary_item = boto3.resource('dynamodb', region_name='us-east-1').Table('CardImgBatchStatus') \
+        .get_item(Key={'batchId': TEST_BATCH_ID, 'itemKey': '#SUMMARY'})['Item']
+    return {attribute: count for (attribute, count) in summary_item.items() if attribute.endswith('Count')}
+
+def set_env_vars_and_aws_resources(batch_status_table, cardpage_uris:list[str]):
+    os.environ['APPROVED_DOMAINS_TO_CARDIMG_SELECTORS'] = '{"scryfall.com": "card", "pkmncards.com": "card-image"}'
+    os.environ['CARDIMG_BUCKET'] = TEST_BUCKET
+    os.environ['SCRAPER_APP_VERSION'] = "test0"
+    boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=TEST_BUCKET)
+    batch_status_table.put_item(Item={
+        "batchId": TEST_BATCH_ID,
+        "itemKey": "#SUMMARY",
+        "totalCount": len(cardpage_uris),
+        "pendingCount": len(cardpage_uris),
+        "retryingCount": 0,
+        "successCount": 0,
+        "failureCount": 0,
+    })
+    for uri in cardpage_uris:
+        batch_status_table.put_item(Item={
+            "batchId": TEST_BATCH_ID,
+            "itemKey": "URI#" + uri,
+            "cardpageUri": uri,
+            "status": "PENDING",
+        })
+
+@mock_aws
+def test_throttled_requests_pause_domain_and_retry(batch_status_table):
+    """Test that a 429 pauses the domain's rate limiter for Retry-After seconds before retrying."""
+    set_env_vars_and_aws_resources(batch_status_table, [])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+
+    class FakeResponse:
+        def __init__(self, status_code, headers):
+            self.status_code, self.headers = status_code, headers
+        def close(self):
+            pass
+    responses = [FakeResponse(429, {'Retry-After': '2'}), FakeResponse(200, {})]
+    class FakeSession:
+        def get(self, uri, **get_kwargs):
+            return responses.pop(0)
+    class FakeRateLimiter:
+        acquire_count, pauses = 0, []
+        def acquire(self):
+            self.acquire_count += 1
+        def pause_for(self, seconds):
+            self.pauses.append(seconds)
+    rate_limiter = FakeRateLimiter()
+
+    resp = cardimg_single_scrape_app.rate_limited_get(
+        "https://scryfall.com/card/mmq/77/embargo", rate_limiter, FakeSession()
+    )
+
+    assert resp.status_code == 200
+    assert rate_limiter.acquire_count == 2
+    assert rate_limiter.pauses == [2]
+
+@mock_aws
+def test_cardimg_uri_streamed_from_cardpage(batch_status_table):
+    """Test that the card image is found in a streamed card page, and relative srcs are resolved."""
+    set_env_vars_and_aws_resources(batch_status_table, [])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    from cardimg_common.cardimg_extraction import ImgClassExtractor
+    cardpage_html = (
+        '<html><head><title>Embargo</title></head><body>'
+        + '<div class="nav"><img class="logo" src="/logo.png"></div>' * 2000
+        + '<img class="card border" src="/large/front/embargo.jpg?1562" alt="Embargo">'
+        + '<p>Flavor text</p>' * 2000
+        + '</body></html>'
+    ).encode('utf-8')
+    class FakeSession:
+        def get(self, uri, **get_kwargs):
+            resp = requests.Response()
+            resp.status_code, resp.raw, resp.encoding = 200, io.BytesIO(cardpage_html), 'utf-8'
+            return resp
+
+    cardimg_uri = cardimg_single_scrape_app.get_cardimg_uri(
+        urlparse("https://scryfall.com/card/mmq/77/embargo"),
+        lambda: ImgClassExtractor("card"), FakeRateLimiter(), FakeSession()
+    )
+
+    assert cardimg_uri == "https://scryfall.com/large/front/embargo.jpg"
+
+@mock_aws
+@pytest.mark.parametrize(
+        "image_size, transfer_config, expected_multipart_uploads",
+        [
+            pytest.param(1024, None, 0, id="single_put"),
+            pytest.param(11 * 1024 * 1024, {"multipart_threshold": 5 * 1024 * 1024,
+                                             "multipart_chunksize": 5 * 1024 * 1024}, 1, id="multipart"),
+        ]
+    )
+def test_cardimg_stored_by_content(batch_status_table, monkeypatch, image_size, transfer_config, expected_multipart_uploads):
+    """Test that the image is stored under its sha256, with a pointer at the card page's prefix."""
+    set_env_vars_and_aws_resources(batch_status_table, [])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    from boto3.s3.transfer import TransferConfig
+    if transfer_config:
+        monkeypatch.setattr(cardimg_single_scrape_app, 'CARDIMG_TRANSFER_CONFIG', TransferConfig(**transfer_config))
+    image_bytes = os.urandom(image_size)
+    content_key = f"sha256/{hashlib.sha256(image_bytes).hexdigest()}.png"
+    multipart_uploads = count_s3_calls(cardimg_single_scrape_app.s3, 'CreateMultipartUpload')
+    card_site = FakeCardSite({"/large/front/embargo.png": (image_bytes, {
+        'Content-Type': 'image/png; charset=binary', 'ETag': '"v1"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'
+    })})
+
+    cardimg_single_scrape_app.locate_and_upload_img(
+        urlparse("https://scryfall.com/card/mmq/77/embargo"),
+        lambda: FakeExtractor("https://cards.scryfall.io/large/front/embargo.png?1562"),
+        FakeRateLimiter(), card_site
+    )
+
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3_object = s3.get_object(Bucket=TEST_BUCKET, Key=content_key)
+    assert s3_object['Body'].read() == image_bytes
+    assert s3_object['ContentType'] == 'image/png'
+    assert {"https://cards.scryfall.io/large/front/embargo.png", '"v1"'} <= set(s3_object['Metadata'].values())
+    assert multipart_uploads['count'] == expected_multipart_uploads
+    pointer = json.loads(s3.get_object(
+        Bucket=TEST_BUCKET, Key="scryfall.com/card/mmq/77/embargo/img.json"
+    )['Body'].read())
+    assert pointer['contentKey'] == content_key
+    assert (pointer['etag'], pointer['lastModified']) == ('"v1"', 'Wed, 21 Oct 2015 07:28:00 GMT')
+
+@mock_aws
+def test_identical_images_stored_once(batch_status_table):
+    """Test that the same image reached from two card pages is uploaded once, with two pointers."""
+    set_env_vars_and_aws_resources(batch_status_table, [])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    image_bytes = os.urandom(1024)
+    card_site = FakeCardSite({"/large/front/embargo.jpg": (image_bytes, {'Content-Type': 'image/jpeg'})})
+    uploads = count_s3_calls(cardimg_single_scrape_app.s3, 'PutObject')
+
+    for cardpage_uri in ("https://scryfall.com/card/mmq/77/embargo", "https://scryfall.com/card/pmmq/77/embargo"):
+        cardimg_single_scrape_app.locate_and_upload_img(
+            urlparse(cardpage_uri),
+            lambda: FakeExtractor("https://cards.scryfall.io/large/front/embargo.jpg"),
+            FakeRateLimiter(), card_site
+        )
+
+    s3_keys = [
+        s3_object['Key'] for s3_object in
+        boto3.client('s3', region_name='us-east-1').list_objects_v2(Bucket=TEST_BUCKET)['Contents']
+    ]
+    assert sorted(s3_keys) == [
+        "scryfall.com/card/mmq/77/embargo/img.json",
+        "scryfall.com/card/pmmq/77/embargo/img.json",
+        f"sha256/{hashlib.sha256(image_bytes).hexdigest()}.jpg",
+    ]
+    assert uploads['count'] == 3 # one image, two pointers
+
+@mock_aws
+@pytest.mark.parametrize("image_changed", [False, True])
+def test_refresh_sends_conditional_get(batch_status_table, image_changed):
+    """Test that a refresh re-checks the image with the saved validators, and only stores a changed image."""
+    set_env_vars_and_aws_resources(batch_status_table, [])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    cardpage_uri = urlparse("https://scryfall.com/card/mmq/77/embargo")
+    make_extractor = lambda: FakeExtractor("https://cards.scryfall.io/large/front/embargo.jpg")
+    old_bytes, new_bytes = os.urandom(1024), os.urandom(1024)
+    card_site = FakeCardSite({"/large/front/embargo.jpg": (old_bytes, {'Content-Type': 'image/jpeg', 'ETag': '"v1"'})})
+    cardimg_single_scrape_app.locate_and_upload_img(cardpage_uri, make_extractor, FakeRateLimiter(), card_site)
+    if image_changed:
+        card_site.files["/large/front/embargo.jpg"] = (new_bytes, {'Content-Type': 'image/jpeg', 'ETag': '"v2"'})
+    card_site.requests.clear()
+
+    cardimg_single_scrape_app.refresh_img(cardpage_uri, make_extractor, FakeRateLimiter(), card_site)
+
+    # Straight to the image, without the card page
+    assert card_site.requests == [("/large/front/embargo.jpg", {'If-None-Match': '"v1"'})]
+    pointer = json.loads(boto3.client('s3', region_name='us-east-1').get_object(
+        Bucket=TEST_BUCKET, Key="scryfall.com/card/mmq/77/embargo/img.json"
+    )['Body'].read())
+    expected_bytes = new_bytes if image_changed else old_bytes
+    assert pointer['sha256'] == hashlib.sha256(expected_bytes).hexdigest()
+    assert pointer['etag'] == ('"v2"' if image_changed else '"v1"')
+
+@mock_aws
+def test_invocation_timings_logged_without_event(batch_status_table, monkeypatch, capsys):
+    """Test that the handler logs one metrics line with each stage's time, and not the whole event."""
+    # A card no other test scrapes, so that it isn't already in the container's known images
+    cardpage_uri = "https://scryfall.com/card/mmq/4242/embargo"
+    set_env_vars_and_aws_resources(batch_status_table, [cardpage_uri])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    card_site = FakeCardSite({"/large/front/embargo.jpg": (os.urandom(1024), {'Content-Type': 'image/jpeg'})})
+    monkeypatch.setitem(cardimg_single_scrape_app.HTTP_SESSIONS, "scryfall.com", card_site)
+    monkeypatch.setitem(cardimg_single_scrape_app.RATE_LIMITERS, "scryfall.com", FakeRateLimiter())
+    monkeypatch.setitem(cardimg_single_scrape_app.CARDIMG_EXTRACTORS, "scryfall.com",
+                        lambda: FakeExtractor("https://cards.scryfall.io/large/front/embargo.jpg"))
+    monkeypatch.setattr(cardimg_single_scrape_app, 'log_session_stats', lambda sessions_by_domain: None)
+    event = make_sqs_event([cardpage_uri])
+
+    assert cardimg_single_scrape_app.lambda_handler(event, {}) == {"batchItemFailures": []}
+
+    output = capsys.readouterr().out
+    assert event['Records'][0]['body'] not in output
+    emf_lines = [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+    assert len(emf_lines) == 1
+    assert emf_lines[0]['Service'] == "cardimg_single_scrape"
+    assert emf_lines[0]['records'] == 1
+    assert emf_lines[0]['payloadBytes'] == len(event['Records'][0]['body'])
+    for stage in ("knownImagesLookup", "pageFetch", "htmlParse", "imageFetch", "s3Check", "s3Put", "dynamoWrite"):
+        assert emf_lines[0][stage + "Ms"] >= 0
+
+@mock_aws
+def test_derivatives_stored_next_to_image(batch_status_table, monkeypatch):
+    """Test that derivatives are made once per image, and listed with their dimensions in each pointer."""
+    Image = pytest.importorskip("PIL.Image")
+    set_env_vars_and_aws_resources(batch_status_table, [])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    from cardimg_common.derivatives import parse_derivative_specs
+    monkeypatch.setattr(cardimg_single_scrape_app, 'CARDIMG_DERIVATIVE_SPECS', parse_derivative_specs([
+        {"width": 146, "format": "webp"}, {"width": 488, "format": "avif"}
+    ]))
+    img_file = io.BytesIO()
+    Image.new("RGB", (745, 1040), "red").save(img_file, "JPEG")
+    image_bytes = img_file.getvalue()
+    content_key_stem = f"sha256/{hashlib.sha256(image_bytes).hexdigest()}"
+    card_site = FakeCardSite({"/large/front/embargo.jpg": (image_bytes, {'Content-Type': 'image/jpeg'})})
+    uploads = count_s3_calls(cardimg_single_scrape_app.s3, 'PutObject')
+
+    pointers = []
+    for cardpage_uri in ("https://scryfall.com/card/mmq/77/embargo", "https://scryfall.com/card/pmmq/77/embargo"):
+        cardimg_single_scrape_app.locate_and_upload_img(
+            urlparse(cardpage_uri),
+            lambda: FakeExtractor("https://cards.scryfall.io/large/front/embargo.jpg"),
+            FakeRateLimiter(), card_site
+        )
+        pointers.append(json.loads(boto3.client('s3', region_name='us-east-1').get_object(
+            Bucket=TEST_BUCKET, Key=urlparse(cardpage_uri).netloc + urlparse(cardpage_uri).path + "/img.json"
+        )['Body'].read()))
+
+    assert uploads['count'] == 5 # one image, two derivatives, two pointers
+    assert pointers[0]['derivatives'] == pointers[1]['derivatives']
+    assert [
+        (derivative['key'], derivative['format'], derivative['width'], derivative['height'])
+        for derivative in pointers[0]['derivatives']
+    ] == [
+        (content_key_stem + "-146w.webp", "webp", 146, 204),
+        (content_key_stem + "-488w.avif", "avif", 488, 681),
+    ]
+    s3_object = boto3.client('s3', region_name='us-east-1').get_object(
+        Bucket=TEST_BUCKET, Key=content_key_stem + "-146w.webp"
+    )
+    assert s3_object['ContentType'] == "image/webp"
+    assert s3_object['ContentLength'] == pointers[0]['derivatives'][0]['bytes']
+    assert (s3_object['Metadata']['width'], s3_object['Metadata']['height']) == ("146", "204")
+
+@mock_aws
+@pytest.mark.parametrize("sends_content_length", [True, False])
+def test_oversized_cardimg_rejected(batch_status_table, monkeypatch, sends_content_length):
+    """Test that an image over MAX_CARDIMG_BYTES is rejected, whether or not its size is known up front."""
+    set_env_vars_and_aws_resources(batch_status_table, [])
+    from cardimg_single_scrape import app as cardimg_single_scrape_app
+    monkeypatch.setattr(cardimg_single_scrape_app, 'MAX_CARDIMG_BYTES', 100 * 1024)
+    image_bytes = os.urandom(200 * 1024)
+    headers = {'Content-Type': 'image/png'}
+    if sends_content_length:
+        headers['Content-Length'] = str(len(image_bytes))
+
+    with pytest.raises(cardimg_single_scrape_app.CardImgTooLargeException):
+        cardimg_single_scrape_app.locate_and_upload_img(
+            urlparse("https://scryfall.com/card/mmq/77/embargo"),
+            lambda: FakeExtractor("https://cards.scryfall.io/large/front/embargo.png"),
+            FakeRateLimiter(),
+            FakeCardSite({"/large/front/embargo.png": (image_bytes, headers)})
+        )
+
+    assert 'Contents' not in boto3.client('s3', region_name='us-east-1').list_objects_v2(Bucket=TEST_BUCKET)
+
+class FakeExtractor:
+    def __init__(self, cardimg_uri):
+        self.cardimg_uri = cardimg_uri
+    def extract(self, html_chunks):
+        return self.cardimg_uri
+
+class FakeRateLimiter:
+    def acquire(self):
+        pass
+
+class FakeCardSite:
+    """
+    Stands in for a session to a card site. Serves files by path (as (body, headers) pairs),
+    an empty card page for any other path, and 304s to matching If-None-Match headers.
+    """
+    def __init__(self, files:dict[str, tuple[bytes, dict[str, str]]]):
+        self.files = files
+        self.requests = []
+    def get(self, uri, headers=None, **get_kwargs):
+        path = urlparse(uri).path
+        self.requests.append((path, headers or {}))
+        resp = requests.Response()
+        resp.status_code = 200
+        if path not in self.files:
+            resp.encoding, resp.raw = 'utf-8', io.BytesIO(b'<html></html>')
+            return resp
+        body, file_headers = self.files[path]
+        if headers and headers.get('If-None-Match') == file_headers.get('ETag'):
+            resp.status_code, resp.raw = 304, io.BytesIO(b'')
+            return resp
+        resp.headers.update(file_headers)
+        resp.raw = io.BytesIO(body)
+        return resp
+
+def count_s3_calls(s3_client, operation_name:str) -> dict:
+    calls = {'count': 0}
+    def count_call(model, **kwargs):
+        if model.name == operation_name:
+            calls['count'] += 1
+    s3_client.meta.events.register("before-call.s3", count_call)
+    return calls
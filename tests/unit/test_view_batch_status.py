@@ -0,0 +1,167 @@
+import boto3, json, pytest
+
+from moto import mock_aws
+
+TEST_BATCH_ID = "7bbf9329-bad0-4be6-89e1-0490b99330d6"
+
+@mock_aws
+def test_progress_pages_follow_cursor(batch_status_table):
+    """Test that following nextCursor visits every uri of the batch exactly once."""
+    cardpage_uris = [f"https://scryfall.com/card/mmq/{i}/embargo" for i in range(5)]
+    set_env_vars_and_aws_resources(batch_status_table, {uri: "PENDING" for uri in cardpage_uris})
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+
+    progress = {}
+    query_params = {'limit': '2'}
+    page_count = 0
+    while True:
+        response = cardimg_view_batch_status_app.lambda_handler(make_event(query_params), {})
+        assert response['statusCode'] == 200
+        body = json.loads(response['body'])
+        assert len(body['progress']) <= 2
+        assert progress.keys().isdisjoint(body['progress'].keys())
+        progress.update(body['progress'])
+        page_count += 1
+        if body['nextCursor'] is None:
+            break
+        query_params = {'limit': '2', 'cursor': body['nextCursor']}
+
+    assert page_count == 3
+    assert progress == {uri: "PENDING" for uri in cardpage_uris}
+    assert body['totalCount'] == 5
+    assert body['statusCounts'] == {"PENDING": 5, "RETRYING": 0, "SUCCESS": 0, "FAILURE": 0}
+
+@mock_aws
+def test_summary_only(batch_status_table, monkeypatch):
+    """Test that ?summary=true returns the counts without reading any uri items."""
+    set_env_vars_and_aws_resources(batch_status_table, {
+        "https://scryfall.com/card/mmq/1/embargo": "SUCCESS",
+        "https://scryfall.com/card/mmq/2/embargo": "FAILURE",
+    })
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+    monkeypatch.setattr(cardimg_view_batch_status_app.dynamodb, 'query', None)
+
+    response = cardimg_view_batch_status_app.lambda_handler(make_event({'summary': 'true'}), {})
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {
+        "batchId": TEST_BATCH_ID,
+        "totalCount": 2,
+        "statusCounts": {"PENDING": 0, "RETRYING": 0, "SUCCESS": 1, "FAILURE": 1},
+    }
+
+@mock_aws
+def test_status_filter(batch_status_table):
+    """Test that ?status= only returns the uris with that status."""
+    set_env_vars_and_aws_resources(batch_status_table, {
+        "https://scryfall.com/card/mmq/1/embargo": "SUCCESS",
+        "https://scryfall.com/card/mmq/2/embargo": "FAILURE",
+        "https://scryfall.com/card/mmq/3/embargo": "FAILURE",
+    })
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+
+    response = cardimg_view_batch_status_app.lambda_handler(make_event({'status': 'failure'}), {})
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['progress'] == {
+        "https://scryfall.com/card/mmq/2/embargo": "FAILURE",
+        "https://scryfall.com/card/mmq/3/embargo": "FAILURE",
+    }
+
+@mock_aws
+def test_not_modified_until_status_changes(batch_status_table):
+    """Test that a matching If-None-Match is a 304, until a status change bumps the ETag."""
+    cardpage_uri = "https://scryfall.com/card/mmq/1/embargo"
+    set_env_vars_and_aws_resources(batch_status_table, {cardpage_uri: "PENDING"})
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+    from cardimg_common.batch_status import record_status_changes
+
+    first_response = cardimg_view_batch_status_app.lambda_handler(make_event({'summary': 'true'}), {})
+    etag = first_response['headers']['ETag']
+    repeat_response = cardimg_view_batch_status_app.lambda_handler(
+        make_event({'summary': 'true'}, {'if-none-match': etag}), {}
+    )
+    assert repeat_response['statusCode'] == 304
+    assert repeat_response['body'] == ''
+
+    record_status_changes(boto3.client('dynamodb'), TEST_BATCH_ID, {cardpage_uri: "SUCCESS"})
+    changed_response = cardimg_view_batch_status_app.lambda_handler(
+        make_event({'summary': 'true'}, {'If-None-Match': etag}), {}
+    )
+    assert changed_response['statusCode'] == 200
+    assert changed_response['headers']['ETag'] != etag
+    assert json.loads(changed_response['body'])['statusCounts']['SUCCESS'] == 1
+
+@mock_aws
+def test_completion_estimated_from_throughput(batch_status_table):
+    """Test that the estimated completion extrapolates from how fast uris have finished so far."""
+    set_env_vars_and_aws_resources(batch_status_table, {
+        "https://scryfall.com/card/mmq/1/embargo": "SUCCESS",
+        "https://scryfall.com/card/mmq/2/embargo": "FAILURE",
+        "https://scryfall.com/card/mmq/3/embargo": "RETRYING",
+        "https://scryfall.com/card/mmq/4/embargo": "PENDING",
+    })
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+    # 2 of 4 uris done 10 minutes after the batch was created
+    boto3.client('dynamodb', region_name='us-east-1').update_item(
+        TableName='CardImgBatchStatus',
+        Key={'batchId': {'S': TEST_BATCH_ID}, 'itemKey': {'S': "#SUMMARY"}},
+        UpdateExpression="SET createdAt = :created_at, statusUpdatedAt = :status_updated_at",
+        ExpressionAttributeValues={':created_at': {'N': "1760000000"}, ':status_updated_at': {'N': "1760000600"}}
+    )
+
+    response = cardimg_view_batch_status_app.lambda_handler(make_event({'summary': 'true'}), {})
+
+    assert json.loads(response['body'])['estimatedCompletionAt'] == "2025-10-09T09:13:20+00:00"
+
+@pytest.mark.parametrize("query_params", [
+    {'status': 'DONE'},
+    {'limit': '0'},
+    {'limit': 'ten'},
+    {'cursor': 'not base64!'},
+    {'cursor': 'I1NVTU1BUlk='}, # "#SUMMARY"
+])
+@mock_aws
+def test_invalid_query_parameters(batch_status_table, query_params):
+    """Test that malformed query parameters are a 400."""
+    set_env_vars_and_aws_resources(batch_status_table, {"https://scryfall.com/card/mmq/1/embargo": "PENDING"})
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+    response = cardimg_view_batch_status_app.lambda_handler(make_event(query_params), {})
+    assert response['statusCode'] == 400
+
+@mock_aws
+def test_nonexistent_batch(batch_status_table, load_event):
+    """Test that a batchId with no summary item is a 404."""
+    set_env_vars_and_aws_resources(batch_status_table, {})
+    from cardimg_view_batch_status import app as cardimg_view_batch_status_app
+    response = cardimg_view_batch_status_app.lambda_handler(
+        load_event("viewstatus/usererror/nonexistent-record.json"), {}
+    )
+    assert response['statusCode'] == 404
+
+def make_event(query_params:dict[str, str], headers:dict[str, str]|None=None) -> dict:
+    return {
+        'pathParameters': {'batchId': TEST_BATCH_ID},
+        'queryStringParameters': query_params,
+        'headers': headers,
+    }
+
+def set_env_vars_and_aws_resources(batch_status_table, statuses_by_uri:dict[str, str]):
+    if not statuses_by_uri:
+        return
+    statuses = list(statuses_by_uri.values())
+    batch_status_table.put_item(Item={
+        "batchId": TEST_BATCH_ID,
+        "itemKey": "#SUMMARY",
+        "totalCount": len(statuses_by_uri),
+        "statusVersion": 1,
+        **{status.lower() + "Count": statuses.count(status)
+           for status in ("PENDING", "RETRYING", "SUCCESS", "FAILURE")},
+    })
+    for (uri, status) in statuses_by_uri.items():
+        batch_status_table.put_item(Item={
+            "batchId": TEST_BATCH_ID,
+            "itemKey": "URI#" + uri,
+            "cardpageUri": uri,
+            "status": status,
+        })